@@ -0,0 +1,279 @@
+# encoding=utf8
+
+"""
+关键字索引
+
+按 Robot Framework 的规则(忽略大小写、空格和下划线)建立关键字名称到各关键字库
+方法的索引, 可以按 Robot 风格的名称查找和执行关键字:
+
+    from Core.KeywordRegistry import run_keyword
+    run_keyword('Should Be Equal', 1, 1)
+    run_keyword('selenium.Wait Until Element Is Visible', 'id=kw')
+
+索引只在第一次使用时建立, 并按已安装的关键字库版本缓存到 .crf_cache 目录,
+之后直接读取缓存, 执行关键字时才会加载对应的关键字库。
+"""
+
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import json
+import os
+import threading
+
+try:
+    from importlib import metadata
+except ImportError:
+    metadata = None
+
+# 工程目录, 缓存放在这里, 与从哪个目录启动无关
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 缓存文件
+CACHE_FILE = os.path.join(PROJECT_DIR, '.crf_cache', 'keywords.json')
+# 影响关键字索引的第三方库, 版本变化后重新建立索引
+DISTRIBUTIONS = (
+    'robotframework',
+    'robotframework-seleniumlibrary',
+    'robotframework-requests',
+    'robotframework-databaselibrary',
+    'robotframework-appiumlibrary',
+    'robotframework-archivelibrary',
+    'robotframework-difflibrary',
+    'selenium',
+)
+# 关键字重名时的优先级, 与 Robot Framework 一样 BuiltIn 优先
+PRIORITY = ('builtIn',)
+
+
+def normalize(name):
+    """ Robot Framework 的关键字名称规则: 忽略大小写、空格和下划线 """
+    return name.lower().replace(' ', '').replace('_', '')
+
+
+def _version(distribution):
+    if metadata is None:
+        return None
+    try:
+        return metadata.version(distribution)
+    except Exception:
+        return None
+
+
+def _is_keyword(value):
+    if isinstance(value, (staticmethod, classmethod)):
+        value = value.__func__
+    return inspect.isfunction(value)
+
+
+def scan_library(cls):
+    """
+    扫描关键字库类的 MRO, 返回 `(keywords, names, conflicts)`:
+    keywords 为 {规范化名称: 方法名}, names 为 {方法名: 显示的关键字名称},
+    conflicts 为互不继承的多个父类定义了同名方法的情况, 实际生效的是 MRO 中最靠前的定义
+    """
+    keywords = {}
+    names = {}
+    owners = {}
+    for klass in cls.__mro__:
+        if klass is object:
+            continue
+        for attr, value in vars(klass).items():
+            if not _is_keyword(value):
+                continue
+            function = value.__func__ if hasattr(value, '__func__') else value
+            # @keyword('Name') 指定的名称, 私有方法也可以用它声明为关键字
+            robot_name = getattr(function, 'robot_name', None)
+            if attr.startswith('_') and not robot_name:
+                continue
+            owners.setdefault(attr, []).append(klass)
+            if attr in names:
+                continue
+            names[attr] = robot_name or attr.replace('_', ' ').title()
+            keywords.setdefault(normalize(attr), attr)
+            if robot_name:
+                keywords.setdefault(normalize(robot_name), attr)
+    conflicts = []
+    for attr, classes in sorted(owners.items()):
+        # 子类覆盖父类的方法是正常的, 只有互不继承的类定义了同名方法才算冲突
+        siblings = [klass for klass in classes[1:]
+                    if not issubclass(classes[0], klass)]
+        if siblings:
+            conflicts.append((attr, [klass.__qualname__ for klass in classes[:1] + siblings]))
+    return keywords, names, conflicts
+
+
+def _is_proxy(library):
+    from Core import Keywords
+    return isinstance(library, Keywords.LazyLibrary)
+
+
+class KeywordRegistry(object):
+    """ 关键字名称到关键字库方法的索引 """
+
+    def __init__(self, libraries=None, cache_file=CACHE_FILE):
+        if libraries is None:
+            from Core import Keywords
+            libraries = dict((name, value) for name, value in vars(Keywords).items()
+                             if isinstance(value, Keywords.LazyLibrary))
+        # 按优先级排序的 {库名: 关键字库实例或代理}
+        self.libraries = dict(libraries)
+        self.order = ([name for name in PRIORITY if name in libraries] +
+                      [name for name in libraries if name not in PRIORITY])
+        self.cache_file = cache_file
+        self._index = None
+        self._bound = {}
+        self._lock = threading.Lock()
+
+    def _classes(self):
+        """ 关键字库的 `(模块名, 类名)`, 代理对象不会因此被加载 """
+        classes = {}
+        for name, library in self.libraries.items():
+            if _is_proxy(library):
+                classes[name] = (library._module, library._class_name)
+            else:
+                cls = type(library)
+                classes[name] = (cls.__module__, cls.__name__)
+        return classes
+
+    def cache_key(self):
+        """ 由已安装的第三方库版本和关键字库源文件的修改时间生成 """
+        parts = ['{}=={}'.format(name, _version(name)) for name in DISTRIBUTIONS]
+        for name, (module, class_name) in sorted(self._classes().items()):
+            spec = importlib.util.find_spec(module)
+            origin = spec.origin if spec is not None else None
+            mtime = os.path.getmtime(origin) if origin and os.path.exists(origin) else None
+            parts.append('{}={}.{}@{}'.format(name, module, class_name, mtime))
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def _build(self):
+        libraries = {}
+        names = {}
+        conflicts = []
+        for name, (module, class_name) in self._classes().items():
+            cls = getattr(importlib.import_module(module), class_name)
+            keywords, names[name], library_conflicts = scan_library(cls)
+            libraries[name] = keywords
+            conflicts.extend({'library': name, 'keyword': attr, 'owners': classes}
+                             for attr, classes in library_conflicts)
+        # 多个关键字库中的同名关键字
+        seen = {}
+        for name in self.order:
+            for keyword, attr in libraries[name].items():
+                seen.setdefault(keyword, []).append(name)
+        conflicts.extend({'library': None, 'keyword': keyword, 'owners': owners}
+                         for keyword, owners in sorted(seen.items()) if len(owners) > 1)
+        return {'libraries': libraries, 'names': names, 'conflicts': conflicts}
+
+    def _load_index(self):
+        key = self.cache_key()
+        try:
+            with open(self.cache_file, encoding='utf8') as cache:
+                index = json.load(cache)
+            if index.get('key') == key:
+                return index
+        except (OSError, ValueError):
+            pass
+        index = self._build()
+        index['key'] = key
+        try:
+            directory = os.path.dirname(self.cache_file)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.cache_file, 'w', encoding='utf8') as cache:
+                json.dump(index, cache)
+        except OSError:
+            pass
+        return index
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._load_index()
+        return self._index
+
+    def _resolve(self, name):
+        """ 返回 `(库名, 方法名)`, 支持 `库名.关键字` 的写法 """
+        libraries = self.index['libraries']
+        if '.' in name:
+            library, keyword = name.split('.', 1)
+            attr = libraries.get(library, {}).get(normalize(keyword))
+            if attr is not None:
+                return library, attr
+        keyword = normalize(name)
+        for library in self.order:
+            attr = libraries[library].get(keyword)
+            if attr is not None:
+                return library, attr
+        raise KeyError("No keyword with name '{}' found.".format(name))
+
+    def get(self, name):
+        """ 按关键字名称返回绑定到关键字库实例的方法 """
+        bound = self._bound.get(name)
+        if bound is None:
+            library, attr = self._resolve(name)
+            bound = getattr(self.libraries[library], attr)
+            self._bound[name] = bound
+        return bound
+
+    def run_keyword(self, name, *args, **kwargs):
+        return self.get(name)(*args, **kwargs)
+
+    def keywords(self, library=None):
+        """ 返回 `(关键字名称, 库名)` 列表 """
+        result = []
+        for name in self.order:
+            if library is not None and name != library:
+                continue
+            for keyword in sorted(self.index['names'][name].values()):
+                result.append((keyword, name))
+        return result
+
+    def conflicts(self):
+        """
+        返回重名的关键字: library 为库名时是同一个库中多个父类定义了同名方法,
+        为 None 时是多个关键字库中有同名关键字
+        """
+        return list(self.index['conflicts'])
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """ Core.Keywords 中所有关键字库的索引, 第一次使用时建立 """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = KeywordRegistry()
+    return _registry
+
+
+def run_keyword(name, *args, **kwargs):
+    """ 按 Robot 风格的名称执行关键字, 如 run_keyword('Should Be Equal', 1, 1) """
+    return get_registry().run_keyword(name, *args, **kwargs)
+
+
+def main():
+    """ python -m Core.KeywordRegistry [--list], 输出重名的关键字 """
+    import sys
+    registry = get_registry()
+    if '--list' in sys.argv[1:]:
+        for keyword, library in registry.keywords():
+            print('{:<12} {}'.format(library, keyword))
+    for conflict in registry.conflicts():
+        if conflict['library']:
+            print('{}: {} 在 {} 中都有定义, 生效的是 {}'.format(
+                conflict['library'], conflict['keyword'], ', '.join(conflict['owners']),
+                conflict['owners'][0]))
+        else:
+            print('关键字 {} 在 {} 中都有定义, 生效的是 {}'.format(
+                conflict['keyword'], ', '.join(conflict['owners']), conflict['owners'][0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,79 @@
 # encoding=utf8
 
+import importlib
+import threading
 
-from Core.CRFKeywords.Appium import CRFAppium
-from Core.CRFKeywords.Archive import CRFArchive
-from Core.CRFKeywords.BuiltIn import CRFBuiltIn
-from Core.CRFKeywords.Database import CRFDatabase
-from Core.CRFKeywords.Diff import CRFDiff
-# from Core.CRFKeywords.Ftp import CRFFtp
-# from Core.CRFKeywords.Mongo import CRFMongo
-# from Core.CRFKeywords.QT import CRFQT
-from Core.CRFKeywords.Requests import CRFRequests
-from Core.CRFKeywords.Selenium import CRFSelenium
+
+class LazyLibrary(object):
+    """
+    关键字库代理, 第一次使用时才导入并初始化对应的库,
+    只用到接口关键字的用例不再需要加载 Selenium/Appium 等库
+    """
+
+    def __init__(self, name, module, class_name):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', module)
+        object.__setattr__(self, '_class_name', class_name)
+        object.__setattr__(self, '_instance', None)
+
+    def _load(self):
+        instance = self._instance
+        if instance is None:
+            with _lock:
+                instance = self._instance
+                if instance is None:
+                    cls = getattr(importlib.import_module(self._module), self._class_name)
+                    instance = cls()
+                    object.__setattr__(self, '_instance', instance)
+                    _loaded.append(self._name)
+        return instance
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self._instance is None:
+            return '<{} {}.{} (not loaded)>'.format(
+                type(self).__name__, self._module, self._class_name)
+        return repr(self._instance)
+
+
+_lock = threading.RLock()
+# 已加载的关键字库, 按加载顺序
+_loaded = []
+
+
+def loaded_libraries():
+    """ 返回本进程中已加载的关键字库名称 """
+    with _lock:
+        return list(_loaded)
+
+
+def preload(ignore_errors=True):
+    """ 加载所有关键字库, 如常驻进程启动时预热 """
+    for library in list(globals().values()):
+        if isinstance(library, LazyLibrary):
+            try:
+                library._load()
+            except ImportError:
+                if not ignore_errors:
+                    raise
 
 
 # 初始化关键字
-selenium = CRFSelenium()
-requests = CRFRequests()
-# qt = CRFQT()
-# mongo = CRFMongo()
-# ftp = CRFFtp()
-diff = CRFDiff()
-database = CRFDatabase()
-archive = CRFArchive()
-appium = CRFAppium()
-builtIn = CRFBuiltIn()
+selenium = LazyLibrary('selenium', 'Core.CRFKeywords.Selenium', 'CRFSelenium')
+requests = LazyLibrary('requests', 'Core.CRFKeywords.Requests', 'CRFRequests')
+# qt = LazyLibrary('qt', 'Core.CRFKeywords.QT', 'CRFQT')
+# mongo = LazyLibrary('mongo', 'Core.CRFKeywords.Mongo', 'CRFMongo')
+# ftp = LazyLibrary('ftp', 'Core.CRFKeywords.Ftp', 'CRFFtp')
+diff = LazyLibrary('diff', 'Core.CRFKeywords.Diff', 'CRFDiff')
+database = LazyLibrary('database', 'Core.CRFKeywords.Database', 'CRFDatabase')
+archive = LazyLibrary('archive', 'Core.CRFKeywords.Archive', 'CRFArchive')
+appium = LazyLibrary('appium', 'Core.CRFKeywords.Appium', 'CRFAppium')
+builtIn = LazyLibrary('builtIn', 'Core.CRFKeywords.BuiltIn', 'CRFBuiltIn')
@@ -6,9 +6,15 @@ import traceback
 import re
 import six
 import html
-from unittest import TestResult, _TextTestResult
+import json
+from unittest import TestResult, TestSuite, _TextTestResult
+from collections import OrderedDict
 from unittest.result import failfast
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, TemplateError
+from ..aggregate import Counts, aggregate
+from ..records import OutputStore, error_strings, load_output
+from ..store import OUTCOME_LISTS, ResultStore
+from ..testdoc import get_test_doc
 
 
 DEFAULT_TEMPLATE = os.path.join(os.path.dirname(__file__), "template",
@@ -33,11 +39,148 @@ def load_template(template):
         return file
 
 
+# Compiled templates are kept by the jinja Environment of their directory,
+# which recompiles a template only when its file changed. The compiled code
+# is also cached on disk in the project directory, whichever directory the
+# runner starts from; set to None to disable.
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))))
+BYTECODE_CACHE = os.path.join(PROJECT_DIR, '.crf_cache', 'jinja')
+_environments = {}
+
+
+def _environment(directory):
+    environment = _environments.get(directory)
+    if environment is None:
+        bytecode_cache = None
+        if BYTECODE_CACHE:
+            try:
+                if not os.path.exists(BYTECODE_CACHE):
+                    os.makedirs(BYTECODE_CACHE)
+                bytecode_cache = FileSystemBytecodeCache(BYTECODE_CACHE)
+            except OSError:
+                pass
+        environment = Environment(loader=FileSystemLoader(directory),
+                                  bytecode_cache=bytecode_cache)
+        _environments[directory] = environment
+    return environment
+
+
+def get_template(template=None):
+    """ Compiled template of the given path, or of the default one. """
+    if template:
+        path = os.path.abspath(template)
+        try:
+            return _environment(os.path.dirname(path)).get_template(
+                os.path.basename(path))
+        except (OSError, TemplateError) as err:
+            # Missing or invalid (e.g. TemplateSyntaxError) user template
+            print("Error: Your Template wasn't loaded", err,
+                  "Loading Default Template", sep="\n")
+    return _environment(os.path.dirname(DEFAULT_TEMPLATE)).get_template(
+        os.path.basename(DEFAULT_TEMPLATE))
+
+
 def render_html(template, **kwargs):
-    template_file = load_template(template)
-    if template_file:
-        template = Template(template_file)
-        return template.render(**kwargs)
+    return get_template(template).render(**kwargs)
+
+
+def stream_html(template, **kwargs):
+    """ Like render_html, but yields the report in chunks as it is rendered. """
+    return get_template(template).generate(**kwargs)
+
+
+STATUS = ('success', 'danger', 'warning', 'info')
+
+# Page of the data report, for runs too large for one html table
+DATA_TEMPLATE = os.path.join(os.path.dirname(__file__), "template",
+                             "report_data_template.html")
+# report_mode 'auto' switches to the data report above this many tests
+AUTO_DATA_ROWS = 2000
+# Failure details per lazily loaded file of the data report
+DETAIL_CHUNK = 500
+
+
+def use_data_report(report_mode, count):
+    """ Whether report_mode ('table', 'data' or 'auto') gives the data
+        report for a run of `count` tests. """
+    if report_mode == 'auto':
+        return count > AUTO_DATA_ROWS
+    return report_mode == 'data'
+
+
+def _write_js(path, prefix, parts, suffix):
+    """ Writes `prefix JSON.parse("...") suffix`, the JSON text being the
+        concatenation of `parts`, escaped piece by piece. JSON.parse of a
+        string loads much faster than the same object as a JS literal. """
+    with open(path, 'w', encoding='utf8') as js_file:
+        js_file.write(prefix + 'JSON.parse("')
+        for part in parts:
+            js_file.write(json.dumps(part)[1:-1])
+        js_file.write('")' + suffix)
+
+
+def write_data_report(output, report_name, rows, title, headers, total_tests):
+    """
+    Writes the report of a large run: `report_name` is a small page which
+    renders the table in the browser, a page of rows at a time. The rows
+    (`make_report_row` lists) go to `<name>_data/rows.js`, the failure
+    details to `details_<n>.js`, loaded only when a row is expanded.
+    """
+    base = report_name[:-5] if report_name.endswith('.html') else report_name
+    data_dir = base + '_data'
+    path = os.path.join(output, data_dir)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for name in os.listdir(path):
+        if name.endswith('.js'):
+            os.remove(os.path.join(path, name))
+
+    classes = OrderedDict()
+    compact = []
+    details = []
+    for desc, class_name, expected, status, error_type, error_message, \
+            times, rerun, screenshot in rows:
+        detail = -1
+        if status != 'success':
+            detail = len(details)
+            details.append([error_type, error_message])
+        compact.append(json.dumps([
+            desc, classes.setdefault(class_name, len(classes)), expected,
+            STATUS.index(status), times, rerun, screenshot or '', detail],
+            ensure_ascii=False, separators=(',', ':')))
+
+    def rows_parts():
+        yield '{{"chunk":{},"classes":{},"rows":['.format(
+            DETAIL_CHUNK, json.dumps(list(classes), ensure_ascii=False, separators=(',', ':')))
+        for index, row in enumerate(compact):
+            yield ',' + row if index else row
+        yield ']}'
+    _write_js(os.path.join(path, 'rows.js'), 'window.CRF_REPORT_DATA = ',
+              rows_parts(), ';\n')
+    for chunk in range(0, len(details), DETAIL_CHUNK):
+        _write_js(os.path.join(path, 'details_{}.js'.format(chunk // DETAIL_CHUNK)),
+                  'CRF_REPORT_DETAILS({}, '.format(chunk // DETAIL_CHUNK),
+                  [json.dumps(details[chunk:chunk + DETAIL_CHUNK], ensure_ascii=False,
+                              separators=(',', ':'))],
+                  ');\n')
+
+    with open(os.path.join(output, report_name), 'w', encoding='utf8') as report_file:
+        report_file.writelines(stream_html(
+            DATA_TEMPLATE, title=title, headers=headers, total_tests=total_tests,
+            data_dir=data_dir))
+
+
+def make_report_row(desc, class_name, detail_step, expected, outcome,
+                    error_name, error_message, elapsed_time, rerun, screenshot):
+    """ Build one row of the html report table. """
+    error_type = "{}\n\n<br><b>ErrorType:</b>&nbsp;".format('<br>'.join(detail_step.split('\n'))).strip()
+    error_type += error_name
+    times = "%.6f" % elapsed_time
+    error_message = error_message if not error_message else html.escape(str(error_message))
+    screenshot = screenshot if screenshot is not None else ''
+    return [desc, class_name, expected, STATUS[outcome], error_type,
+            error_message, times, rerun, screenshot]
 
 
 def testcase_name(test_method):
@@ -53,38 +196,53 @@ def testcase_name(test_method):
 class _TestInfo(object):
     """" Keeps information about the execution of a test method. """
 
+    __slots__ = ('test_result', 'outcome', 'elapsed_time', 'error_type',
+                 'error_message', '_stdout', '_stderr', 'screenshot', 'rerun',
+                 'test_description', 'test_exception_info', 'doc', 'test_name',
+                 'test_id')
+
     (SUCCESS, FAILURE, ERROR, SKIP) = range(4)
 
     def __init__(self, test_result, test_method, outcome=SUCCESS, err=None, subTest=None):
         self.test_result = test_result
         self.outcome = outcome
         self.elapsed_time = 0
-        self.err = err
-        self.stdout = test_result._stdout_data
-        self.stderr = test_result._stderr_data
+        self.error_type, self.error_message = error_strings(outcome, err)
+        store = test_result.output_store
+        self._stdout = store.add(test_result._stdout_data)
+        self._stderr = store.add(test_result._stderr_data)
         self.screenshot = ''
         self.rerun = 0
-        test_description = self.test_result.getDescription(test_method)
-        self.test_description = test_description.split()[0] if len(test_description.split())<3 else test_description.split()[-1]
+        words = self.test_result.getDescription(test_method).split()
+        self.test_description = words[0] if len(words) < 3 else words[-1]
 
         self.test_exception_info = (
             '' if outcome in (self.SUCCESS, self.SKIP)
             else self.test_result._exc_info_to_string(
-                self.err, test_method)
+                err, test_method)
         )
         
-        self.test_doc = test_method._testMethodDoc
-        self.test_name = testcase_name(test_method)
+        self.doc = get_test_doc(test_method)
+        self.test_name = sys.intern(testcase_name(test_method))
         self.test_id = test_method.id()
         if subTest:
             self.test_id = subTest.id()
 
+    @property
+    def stdout(self):
+        return load_output(self._stdout)
+
+    @property
+    def stderr(self):
+        return load_output(self._stderr)
+
     def id(self):
         return self.test_id
 
     def test_finished(self):
         self.elapsed_time = \
             self.test_result.stop_time - self.test_result.start_time
+        self.test_result = None
 
     def get_description(self):
         return self.test_description
@@ -100,13 +258,21 @@ class _HtmlTestResult(_TextTestResult):
         elapsed_times=True, properties=None, infoclass=None):
         _TextTestResult.__init__(self, stream, descriptions, verbosity)
         self.rerun = 0
-        self.retry = 0
+        # failed tests waiting to be rerun once the suite has finished
+        self.rerun_queue = []
+        # test id -> attempt being run, missing means first attempt
+        self._attempts = {}
+        # every recorded attempt and the outcome lists, indexed by test id
+        self.store = ResultStore()
+        self.attempts = self.store.attempts
+        self.successes, self.failures, self.errors, self.skipped = (
+            self.store.view(kind) for kind in OUTCOME_LISTS)
         self.tb_locals = False
         self.buffer = True
         self._stdout_data = None
         self._stderr_data = None
-        self.successes = []
-        self.tested_fail_error = []
+        # captured output of every recorded test
+        self.output_store = OutputStore()
         self.callback = None
         self.properties = properties
         self.elapsed_times = elapsed_times
@@ -138,11 +304,15 @@ class _HtmlTestResult(_TextTestResult):
 
     def startTest(self, test):
         """ Called before execute each method. """
-        if self.retry == 0:
+        attempt = self._attempt(test)
+        if attempt == 0:
             self.testRun += 1
         self.start_time = time.time()
         TestResult.startTest(self, test)
 
+        if attempt and (self.showAll or self.dots):
+            self.stream.write('Rerun {} time...'.format(attempt))
+
         if self.showAll:
             self.stream.write(" " + self.getDescription(test))
             self.stream.write(" ... ")
@@ -164,23 +334,52 @@ class _HtmlTestResult(_TextTestResult):
             self.callback()
             self.callback = None
 
-        if self.rerun > self.retry:
-            self.retry += 1
-            self.stream.write('Rerun {} time...'.format(self.retry))
-            test(self)
-        else:
-            self.retry = 0
+    def _attempt(self, test):
+        """ Return the attempt number of a test, 0 for the first run. """
+        return self._attempts.get(test.id(), 0)
+
+    def _rerun_budget(self, test):
+        """ Number of reruns a failed test gets. """
+        return self.rerun
+
+    def _schedule_rerun(self, test):
+        """ Queue a failed test to be rerun after the suite has finished. """
+        if self._attempt(test) >= self._rerun_budget(test):
+            return
+        if any(queued.id() == test.id() for queued in self.rerun_queue):
+            return
+        self.rerun_queue.append(test)
+
+    def run_reruns(self):
+        """
+        Rerun the queued failed tests, round by round, until they pass or
+        run out of attempts. Tests of the same class are grouped so their
+        class fixtures are set up again once per round.
+        """
+        while self.rerun_queue and not self.shouldStop:
+            tests, self.rerun_queue = self.rerun_queue, []
+            by_class = OrderedDict()
+            for test in tests:
+                self._attempts[test.id()] = self._attempt(test) + 1
+                by_class.setdefault(type(test), []).append(test)
+            # The class fixtures were torn down at the end of the last round
+            self._previousTestClass = None
+            self._moduleSetUpFailed = False
+            self._run_suite(
+                TestSuite([test for group in by_class.values() for test in group]))
+
+    def _run_suite(self, suite):
+        """ Run a suite against this result, hook for other execution modes. """
+        suite(self)
 
     def addSuccess(self, test):
         """ Called when a test executes successfully. """
         self._save_output_data()
         testinfo = self.infoclass(self, test)
-        testinfo.rerun = self.retry
+        testinfo.rerun = self._attempt(test)
+        self._record(testinfo)
         self._prepare_callback(
             testinfo, self.successes, "OK", ".")
-        self.retry = self.rerun
-        if testinfo.test_id in self.tested_fail_error:
-            self._remove_test(testinfo.test_id)
 
     @failfast
     def addFailure(self, test, err):
@@ -188,17 +387,15 @@ class _HtmlTestResult(_TextTestResult):
         self._save_output_data()
         testinfo = self.infoclass(
             self, test, self.infoclass.FAILURE, err)
-        if testinfo.test_id in self.tested_fail_error:
-            self._remove_test(testinfo.test_id)
         try:
             testinfo.screenshot = test.driver.capture_page_screenshot()
             test.driver.close_browser()
         except Exception as e:
             pass
-        testinfo.rerun = self.retry
-        self.failures.append((testinfo,
-            self._exc_info_to_string(err, test)))
-        self.tested_fail_error.append(testinfo.test_id)
+        testinfo.rerun = self._attempt(test)
+        self._record(testinfo)
+        self.failures.append((testinfo, testinfo.get_error_info()))
+        self._schedule_rerun(test)
         self._prepare_callback(testinfo, [], "FAIL", "F")
 
     @failfast
@@ -207,17 +404,15 @@ class _HtmlTestResult(_TextTestResult):
         self._save_output_data()
         testinfo = self.infoclass(
             self, test, self.infoclass.ERROR, err)
-        if testinfo.test_id in self.tested_fail_error:
-            self._remove_test(testinfo.test_id)
         try:
             testinfo.screenshot = test.driver.capture_page_screenshot()
             test.driver.close_browser()
         except Exception as e:
             pass
-        testinfo.rerun = self.retry
-        self.errors.append((testinfo,
-            self._exc_info_to_string(err, test)))
-        self.tested_fail_error.append(testinfo.test_id)
+        testinfo.rerun = self._attempt(test)
+        self._record(testinfo)
+        self.errors.append((testinfo, testinfo.get_error_info()))
+        self._schedule_rerun(test)
         self._prepare_callback(testinfo, [], 'ERROR', 'E')
 
     def addSubTest(self, testcase, test, err):
@@ -226,19 +421,18 @@ class _HtmlTestResult(_TextTestResult):
             self._save_output_data()
             testinfo = self.infoclass(
                 self, testcase, self.infoclass.ERROR, err, subTest=test)
-            if testinfo.test_id in self.tested_fail_error:
-                self._remove_test(testinfo.test_id)
             try:
                 testinfo.screenshot = test.driver.capture_page_screenshot()
                 test.driver.close_browser()
             except Exception as e:
                 pass
-            testinfo.rerun = self.retry
+            testinfo.rerun = self._attempt(testcase)
+            self._record(testinfo)
             self.errors.append((
                 testinfo,
-                self._exc_info_to_string(err, testcase)
+                testinfo.get_error_info()
             ))
-            self.tested_fail_error.append(testinfo.test_id)
+            self._schedule_rerun(testcase)
             self._prepare_callback(testinfo, [], "ERROR", "E")
 
     def addSkip(self, test, reason):
@@ -246,17 +440,19 @@ class _HtmlTestResult(_TextTestResult):
         self._save_output_data()
         testinfo = self.infoclass(
             self, test, self.infoclass.SKIP, reason)
+        testinfo.rerun = self._attempt(test)
+        self.store.record(testinfo)
         self.skipped.append((testinfo, reason))
         self._prepare_callback(testinfo, [], "SKIP", "S")
-        self.retry = self.rerun
 
-    def _remove_test(self, test_id):
-        for test in self.failures:
-            if test[0].test_id == test_id:
-                self.failures.remove(test)
-        for test in self.errors:
-            if test[0].test_id == test_id:
-                self.errors.remove(test)
+    def _record(self, testinfo):
+        """ Records an attempt, it supersedes the failures of the earlier attempts. """
+        self.store.record(testinfo)
+        self._remove_test(testinfo.test_id, testinfo.rerun)
+
+    def _remove_test(self, test_id, attempt=None):
+        """ Drops the failures and errors of the test recorded before `attempt`. """
+        self.store.supersede(test_id, attempt)
 
     def printErrorList(self, flavour, errors):
         """
@@ -273,52 +469,24 @@ class _HtmlTestResult(_TextTestResult):
 
     def _get_info_by_testcase(self):
         """ Organize test results  by TestCase module. """
+        return aggregate(self).classes
 
-        tests_by_testcase = {}
-        for tests in (self.successes, self.failures, self.errors, self.skipped):
-            for test_info in tests:
-                if isinstance(test_info, tuple):
-                    test_info = test_info[0]
-                testcase_name = test_info.test_name
-                if testcase_name not in tests_by_testcase:
-                    tests_by_testcase[testcase_name] = []
-                tests_by_testcase[testcase_name].append(test_info)
-
-        return tests_by_testcase
-
-    def get_report_attributes(self, tests, start_time, elapsed_time):
-        """ Setup the header info for the report. """
-
-        failures = errors = skips = success = 0
-        for test in tests:
-            outcome = test.outcome
-            if outcome == test.ERROR:
-                errors += 1
-            elif outcome == test.FAILURE:
-                failures += 1
-            elif outcome == test.SKIP:
-                skips += 1
-            elif outcome == test.SUCCESS:
-                success += 1
-        status = []
-
-        if success:
-            status.append('Pass: {}'.format(success))
-        if failures:
-            status.append('Fail: {}'.format(failures))
-        if errors:
-            status.append('Error: {}'.format(errors))
-        if skips:
-            status.append('Skip: {}'.format(skips))
-        result = ', '.join(status)
+    def get_report_attributes(self, tests, start_time, elapsed_time, counts=None):
+        """ Setup the header info for the report, `counts` are the
+            `aggregate.Counts` of the tests if already known. """
+        if counts is None:
+            counts = Counts()
+            for test in tests:
+                counts.add(test)
 
         hearders = {
             "start_time": str(start_time)[:19],
             "duration": str(elapsed_time),
-            "status": result
+            "status": counts.status(),
+            # regression.Slowdown of the tests slower than their history
+            "slowdowns": getattr(self, 'slowdowns', ())
         }
-        total_runned_test = success + skips + errors + failures
-        return hearders, total_runned_test
+        return hearders, counts.tests
 
     def _test_method_name(self, test_id):
         """ Return a test name of the test id. """
@@ -333,25 +501,12 @@ class _HtmlTestResult(_TextTestResult):
         desc = "{} ({})".format(test_description, test_name)
         class_name = re.sub(r'^__main__.', '', testCase.id())
         class_name = class_name.rpartition('.')[0]
-        status = ('success', 'danger', 'warning', 'info')[testCase.outcome]
-        test_doc = testCase.test_doc        
-        test_doc = test_doc if test_doc else '======'
-        test_doc = test_doc.split('\n', 1)[-1]
-        sep = re.findall(r'(======+)', test_doc)[0] if len(re.findall(r'(======+)', test_doc)) != 0 else '======'
-        test_doc = test_doc.split(sep, 1)
-        detail_step = test_doc[0]
-        expect_result = test_doc[1] if len(test_doc) > 1 else ''
-        error_type = "{}\n\n<br><b>ErrorType:</b>&nbsp;".format('<br>'.join(detail_step.split('\n'))).strip()
-        if testCase.outcome != testCase.SKIP and testCase.outcome != testCase.SUCCESS:
-            error_type += testCase.err[0].__name__
-            error_message = testCase.err[1]
-        else:
-            error_message = testCase.err
-        times = "%.6f" % testCase.elapsed_time
-        error_message = error_message if not error_message else html.escape(str(error_message))
-        rerun = testCase.rerun
-        screenshot = testCase.screenshot if testCase.screenshot is not None else ''
-        return test_cases_list.append([desc, class_name, expect_result, status, error_type, error_message, times, rerun, screenshot])
+        error_name = testCase.error_type or ''
+        error_message = testCase.error_message
+        return test_cases_list.append(make_report_row(
+            desc, class_name, testCase.doc.steps, testCase.doc.expected, testCase.outcome,
+            error_name, error_message, testCase.elapsed_time, testCase.rerun,
+            testCase.screenshot))
 
     def get_test_number(self, test):
         """ Return the number of a test case or 0. """
@@ -368,13 +523,14 @@ class _HtmlTestResult(_TextTestResult):
         """ Try to sort a list of test runned by numbers if have. """
         return sorted(test_list, key=self.get_test_number)
 
-    def report_tests(self, test_class_name, tests, testRunner):
+    def report_tests(self, test_class_name, tests, testRunner, counts=None):
         """ Generate a html file for a given suite.  """
         report_name = testRunner.report_title
         start_time = testRunner.start_time
         elapsed_time = testRunner.time_taken
 
-        report_headers, total_test = self.get_report_attributes(tests, start_time, elapsed_time)
+        report_headers, total_test = self.get_report_attributes(
+            tests, start_time, elapsed_time, counts)
         testcase_name = ''
         test_cases_list = []
 
@@ -384,36 +540,60 @@ class _HtmlTestResult(_TextTestResult):
         for test in tests:
             self.report_testcase(test, test_cases_list)
 
-        html_file = render_html(testRunner.template, title=report_name,
-                                headers=report_headers,
-                                testcase_name=testcase_name,
-                                tests_results=test_cases_list,
-                                total_tests=total_test)
-        return html_file
-
-    def generate_reports(self, testRunner):
-        """ Generate report for all given runned test object. """
-        all_results = self._get_info_by_testcase()
-        all_tests = list()
-        for testcase_class_name, all_test in all_results.items():
-            all_tests += all_test
-            if testRunner.outsuffix:
-                testcase_class_name = "report.html"
-
-        tests = self.report_tests(testcase_class_name, all_tests,
-                                   testRunner)
-        self.generate_file(testRunner.output, testcase_class_name,
-                           tests)
+        # Rendered while generate_file writes it
+        return stream_html(testRunner.template, title=report_name,
+                           headers=report_headers,
+                           testcase_name=testcase_name,
+                           tests_results=test_cases_list,
+                           total_tests=total_test)
+
+    def generate_data_report(self, report_name, tests, testRunner, counts=None):
+        """ Generate the report of a large run, its rows in data files. """
+        report_headers, total_test = self.get_report_attributes(
+            tests, testRunner.start_time, testRunner.time_taken, counts)
+        test_cases_list = []
+        for test in self.sort_test_list(tests):
+            self.report_testcase(test, test_cases_list)
+        write_data_report(os.path.join(os.getcwd(), testRunner.output),
+                          report_name, test_cases_list,
+                          testRunner.report_title, report_headers, total_test)
+
+    def write_html_report(self, report_name, tests, testRunner, counts=None):
+        """ Write the table report, or the data report for a large run. """
+        report_mode = getattr(testRunner, 'report_mode', 'table')
+        if use_data_report(report_mode, len(tests)):
+            self.generate_data_report(report_name, tests, testRunner, counts)
+        else:
+            report = self.report_tests(report_name, tests, testRunner, counts)
+            self.generate_file(testRunner.output, report_name, report)
+
+    def generate_reports(self, testRunner, model=None):
+        """ Generate report for all given runned test object. `model` is
+            the `aggregate.ResultModel` of this result, built if not given. """
+        if model is None:
+            model = aggregate(self)
+        # Without a suffix the report is named after the last test class
+        if testRunner.outsuffix or not model.classes:
+            report_name = "report.html"
+        else:
+            report_name = next(reversed(model.classes))
+
+        self.write_html_report(report_name, model.class_tests(), testRunner,
+                               model.totals)
 
     def generate_file(self, output, report_name, report):
-        """ Generate the report file in the given path. """
+        """ Generate the report file in the given path, `report` is the
+            html or an iterable of its chunks. """
         current_dir = os.getcwd()
         dir_to = os.path.join(current_dir, output)
         if not os.path.exists(dir_to):
             os.makedirs(dir_to)
         path_file = os.path.join(dir_to, report_name)
         with open(path_file, 'w', encoding='utf8') as report_file:
-            report_file.write(report)
+            if isinstance(report, str):
+                report_file.write(report)
+            else:
+                report_file.writelines(report)
 
     def _exc_info_to_string(self, err, test):
         """ Converts a sys.exc_info()-style tuple of values into a string."""
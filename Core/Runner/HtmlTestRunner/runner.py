@@ -54,6 +54,7 @@ class HTMLTestRunner(TextTestRunner):
 
             self.start_time = datetime.now()
             test(result)
+            result.run_reruns()
             stop_time = datetime.now()
             self.time_taken = stop_time - self.start_time
 
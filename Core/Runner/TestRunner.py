@@ -1,28 +1,147 @@
 # coding=utf8
 
+import os
+import sqlite3
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import chain
 from unittest import TextTestRunner, _TextTestResult
 from .xmlrunner import XMLTestRunner
 from .xmlrunner.result import _XMLTestResult
 from .HtmlTestRunner.result import _HtmlTestResult
+from .aggregate import aggregate
+from .aio import DEFAULT_LIMIT, run_suite
+from .flaky import Quarantine
+from .history import add_result
+from .impact import ImpactRecorder
+from .regression import RegressionCheck, describe
+from .journal import Journal
+from .parallel import run_in_processes, run_in_threads
+from .scheduler import Schedule
+from .threadsafe import ThreadSafeResult
+from .utils import loaded_libraries
+from .watchdog import Watchdog, timeout_exc_info
 
 
-class _TestResult(_XMLTestResult, _HtmlTestResult):
-    def generate_html_reports(self, testRunner):
+class _TestResult(ThreadSafeResult, _XMLTestResult, _HtmlTestResult):
+    # Enforces the time budgets while the runner is running
+    watchdog = None
+    # Journal the finished tests are appended to, see journal.py
+    journal = None
+    # Ids of the quarantined flaky tests and their reruns, see flaky.py
+    quarantined = frozenset()
+    quarantine_rerun = 0
+    # Records the files used by every test, see impact.py
+    impact = None
+    # Tests slower than their baseline, see regression.py
+    slowdowns = ()
+
+    def __init__(self, *args, **kwargs):
+        super(_TestResult, self).__init__(*args, **kwargs)
+        # keyword libraries loaded by parallel workers
+        self.libraries = set()
+
+    def loaded_libraries(self):
+        """ Keyword libraries loaded in this process and in the workers. """
+        libraries = loaded_libraries()
+        return libraries + sorted(self.libraries.difference(libraries))
+
+    def generate_html_reports(self, testRunner, model=None):
         """ Generate report for all given runned test object. """
-        all_results = self._get_info_by_testcase()
-        all_tests = list()
-        for testcase_class_name, all_test in all_results.items():
-            all_tests += all_test
-            if testRunner.outsuffix:
-                testcase_class_name = "report.html"
+        _HtmlTestResult.generate_reports(self, testRunner, model)
+
+    def _run_suite(self, suite):
+        run_suite(suite, self)
+
+    def _rerun_budget(self, test):
+        if test.id() in self.quarantined:
+            return self.quarantine_rerun
+        return self.rerun
+
+    def blocking(self, entries):
+        """ The failures or errors not of quarantined tests. """
+        return [entry for entry in entries
+                if entry[0].test_id not in self.quarantined]
+
+    def wasSuccessful(self):
+        """ Failures of quarantined tests do not fail the run. """
+        if not self.quarantined:
+            return super(_TestResult, self).wasSuccessful()
+        return (not self.blocking(self.failures) and not self.blocking(self.errors)
+                and not self.unexpectedSuccesses)
 
-        tests = self.report_tests(testcase_class_name, all_tests,
-                                   testRunner)
-        self.generate_file(testRunner.output, testcase_class_name,
-                           tests)
+    def startTest(self, test):
+        super(_TestResult, self).startTest(test)
+        if self.watchdog is not None:
+            self.watchdog.test_started(test)
+        if self.impact is not None:
+            self.impact.test_started(test)
+
+    def stopTest(self, test):
+        if self.impact is not None:
+            self.impact.test_stopped(test)
+        if self.watchdog is not None:
+            self.watchdog.test_stopped(test)
+        super(_TestResult, self).stopTest(test)
+
+    def _prepare_callback(self, test_info, target_list, verbose_str,
+                          short_str):
+        super(_TestResult, self)._prepare_callback(
+            test_info, target_list, verbose_str, short_str)
+        if self.journal is None:
+            return
+        callback = self.callback
+
+        def journaled():
+            # The times are only final once the test has finished
+            callback()
+            self.journal.write_test(test_info)
+        self.callback = journaled
+
+    def _timed_out(self, test):
+        return self.watchdog is not None and self.watchdog.timed_out(test)
+
+    def addSuccess(self, test):
+        if self._timed_out(test):
+            # The browser was closed under a test which then still passed
+            self.addError(test, None)
+        else:
+            super(_TestResult, self).addSuccess(test)
+
+    def addFailure(self, test, err):
+        if self._timed_out(test):
+            self.addError(test, err)
+        else:
+            super(_TestResult, self).addFailure(test, err)
+
+    def addError(self, test, err):
+        timeout = self.watchdog.pop_timeout(test) if self.watchdog else None
+        if timeout is None:
+            super(_TestResult, self).addError(test, err)
+            return
+        reason, screenshot = timeout
+        with self._lock:
+            super(_TestResult, self).addError(test, timeout_exc_info(reason, err))
+            self.errors[-1][0].screenshot = screenshot
+
+    def merge(self, exported):
+        """ Merges the outcomes exported by a parallel worker. """
+        # A rerun job supersedes the failures of the previous attempt
+        for info in exported['attempts']:
+            info.attach(self.output_store)
+            self.store.replay(info)
+        self.testRun += exported['testRun']
+        self.testsRun += exported['testsRun']
+        self.expectedFailures.extend(exported['expectedFailures'])
+        self.unexpectedSuccesses.extend(exported['unexpectedSuccesses'])
+        self.libraries.update(exported['libraries'])
+        if self.journal is not None:
+            for info in exported['attempts']:
+                self.journal.write_test(info)
+        if exported['shouldStop']:
+            self.shouldStop = True
 
 
 class TestRunner(XMLTestRunner):
@@ -32,9 +151,45 @@ class TestRunner(XMLTestRunner):
     def __init__(self, output='.', outsuffix=None, stream=sys.stderr,
                  descriptions=True, verbosity=1, elapsed_times=True,
                  failfast=False, report_title=None, template=None, tb_locals=False,
-                 buffer=False, encoding='UTF-8', resultclass=None, rerun=0):
+                 buffer=False, encoding='UTF-8', resultclass=None, rerun=0, workers=1,
+                 threads=1, timings=None, async_limit=DEFAULT_LIMIT,
+                 test_timeout=None, run_timeout=None, kill_grace=30,
+                 journal=None, report_mode='auto', history=None,
+                 quarantine=None, quarantine_rerun=None, impact=None):
         TextTestRunner.__init__(self, stream, descriptions, verbosity)
         self.rerun = rerun
+        # workers > 1: every test class runs in a pool of processes
+        # threads > 1: classes marked threadsafe run in a pool of threads
+        self.workers = workers
+        self.threads = threads
+        # max number of async test methods in flight on the event loop
+        self.async_limit = async_limit
+        # seconds a test / the whole run may take, None means no limit
+        self.test_timeout = test_timeout
+        self.run_timeout = run_timeout
+        self.run_deadline = None
+        # seconds a worker gets to recover on its own before it is killed
+        self.kill_grace = kill_grace
+        # output.xml of a previous run, used to schedule parallel jobs
+        if timings is None and isinstance(output, str):
+            timings = os.path.join(output, 'output.xml')
+        self.timings = timings
+        # file every finished test is appended to, to recover the
+        # results of a run which died before writing its reports
+        self.journal = journal
+        # SQLite database every run is added to, see history.py
+        self.history = history
+        # flaky tests run after the others, with quarantine_rerun reruns
+        if quarantine is not None and not isinstance(quarantine, Quarantine):
+            quarantine = Quarantine(quarantine)
+        self.quarantine = quarantine
+        if quarantine_rerun is None:
+            quarantine_rerun = rerun + 2
+        self.quarantine_rerun = quarantine_rerun
+        # impact map updated with the files every test used, the tests
+        # then run one at a time
+        self.impact = impact
+        self.schedule = None
         self.tb_locals = tb_locals
         self.verbosity = verbosity
         self.output = output
@@ -52,14 +207,93 @@ class TestRunner(XMLTestRunner):
 
         self.report_title = report_title or "Test Report"
         self.template = template
+        # 'table': every test a row of report.html, 'data': the rows in
+        # data files rendered a page at a time, 'auto': data for big runs
+        self.report_mode = report_mode
+
+    def worker_options(self):
+        """ Settings needed to build a result object inside a worker. """
+        return {
+            'resultclass': self.resultclass,
+            'descriptions': self.descriptions,
+            'verbosity': self.verbosity,
+            'elapsed_times': self.elapsed_times,
+            'failfast': self.failfast,
+            'tb_locals': self.tb_locals,
+            'rerun': self.rerun,
+            'quarantined': self.quarantine.tests if self.quarantine else frozenset(),
+            'quarantine_rerun': self.quarantine_rerun,
+            'async_limit': self.async_limit,
+            'test_timeout': self.test_timeout,
+            'run_deadline': self.run_deadline,
+        }
+
+    def write_reports(self, result):
+        """
+        Writes the HTML and XML reports at the same time, both read one
+        aggregation of the result.
+        """
+        model = aggregate(result)
+        if isinstance(self.output, str) and not os.path.exists(self.output):
+            # Both reporters would create it, the second one failing
+            os.makedirs(self.output)
+        with ThreadPoolExecutor(2) as executor:
+            futures = [executor.submit(result.generate_html_reports, self, model),
+                       executor.submit(result.generate_reports, self, model)]
+        for future in futures:
+            future.result()
+
+    def check_durations(self, result):
+        """ Compares the durations of the passed tests with the history. """
+        try:
+            slowdowns = RegressionCheck.from_history(self.history).check_result(result)
+        except sqlite3.Error as e:
+            self.stream.writeln('Could not read the history {}: {}'.format(self.history, e))
+            return
+        result.slowdowns = slowdowns
+        if not slowdowns:
+            return
+        self.stream.writeln("Duration regressions: {}".format(len(slowdowns)))
+        for slowdown in slowdowns:
+            self.stream.writeln("  " + describe(slowdown))
+        result.properties = dict(result.properties or {},
+                                 duration_regressions=str(len(slowdowns)))
+
+    def add_history(self, result):
+        """ Adds the attempts of the run to the history database. """
+        try:
+            add_result(self.history, result, self.report_title,
+                       self.start_time.timestamp(),
+                       (self.start_time + self.time_taken).timestamp())
+        except sqlite3.Error as e:
+            # The results are in the reports, the history is a bonus
+            self.stream.writeln('Could not update the history {}: {}'.format(
+                self.history, e))
+
+    def _run_lane(self, test, result):
+        """ Runs a suite in the configured mode, then the reruns of its failed tests. """
+        if result.impact is not None:
+            run_suite(test, result)
+        elif self.workers > 1:
+            run_in_processes(test, result, self)
+        elif self.threads > 1:
+            run_in_threads(test, result, self)
+        else:
+            run_suite(test, result)
+        result.run_reruns()
 
     def run(self, test):
         """ Runs the given testcase or testsuite. """
+        watchdog = None
+        journal = None
+        recorder = None
         try:
             result = self._make_result()
             result.failfast = self.failfast
             result.tb_locals = self.tb_locals
             result.rerun = self.rerun
+            result.async_limit = self.async_limit
+            result.test_timeout = self.test_timeout
             if hasattr(test, 'properties'):
                 # junit testsuite properties
                 result.properties = test.properties
@@ -69,7 +303,39 @@ class TestRunner(XMLTestRunner):
             self.stream.writeln(result.separator2)
 
             self.start_time = datetime.now()
-            test(result)
+            if self.run_timeout is not None:
+                self.run_deadline = time.time() + self.run_timeout
+            watchdog = Watchdog(self.test_timeout, self.run_deadline)
+            result.watchdog = watchdog
+            watchdog.start(result)
+            if self.journal:
+                journal = Journal(self.journal).open(
+                    self.report_title, self.outsuffix, result.properties)
+                result.journal = journal
+            lanes = [test]
+            if self.quarantine:
+                main, quarantined = self.quarantine.split(test)
+                if quarantined.countTestCases():
+                    lanes = [main, quarantined]
+                    result.quarantined = self.quarantine.tests
+                    result.quarantine_rerun = self.quarantine_rerun
+                    self.stream.writeln(
+                        "Quarantined flaky tests: {}, run last with up to {} reruns".format(
+                            quarantined.countTestCases(), self.quarantine_rerun))
+            if self.impact:
+                self.stream.writeln("Recording the files used by every test, "
+                                    "the tests run one at a time")
+                recorder = result.impact = ImpactRecorder(self.impact)
+                result.async_limit = 1
+                recorder.start()
+            if not self.impact and (self.workers > 1 or self.threads > 1):
+                # One schedule for every lane, the makespans of the lanes add up
+                self.schedule = Schedule.from_output(self.timings)
+            for lane in lanes:
+                self._run_lane(lane, result)
+            if recorder is not None:
+                recorder.save()
+            watchdog.stop()
             stop_time = datetime.now()
             self.time_taken = stop_time - self.start_time
             
@@ -78,6 +344,23 @@ class TestRunner(XMLTestRunner):
             run = result.testRun
             self.stream.writeln("Ran {} test{} in {}".format(run,
                                 run != 1 and "s" or "", str(self.time_taken)))
+            if self.schedule is not None:
+                self.stream.writeln(self.schedule.report(
+                    self.time_taken.total_seconds()))
+            libraries = result.loaded_libraries()
+            self.stream.writeln("Keyword libraries loaded: {}".format(
+                ", ".join(libraries) or "none"))
+            if libraries:
+                result.properties = dict(result.properties or {},
+                                         keyword_libraries=",".join(libraries))
+            if self.history:
+                self.check_durations(result)
+            if result.quarantined:
+                result.properties = dict(result.properties or {}, quarantined=",".join(
+                    sorted(info.test_id for info in result.attempts
+                           if info.test_id in result.quarantined and not info.rerun)))
+            if journal is not None:
+                journal.close(result.properties)
             self.stream.writeln()
 
             expectedFails = len(result.expectedFailures)
@@ -87,13 +370,18 @@ class TestRunner(XMLTestRunner):
             infos = []
             if not result.wasSuccessful():
                 self.stream.write("FAILED")
-                failed, errors = map(len, (result.failures, result.errors))
+                failed, errors = map(len, (result.blocking(result.failures),
+                                           result.blocking(result.errors)))
                 if failed:
                     infos.append("Failures={0}".format(failed))
                 if errors:
                     infos.append("Errors={0}".format(errors))
             else:
                 self.stream.write("OK")
+            quarantined = sum(1 for info, _ in chain(result.failures, result.errors)
+                              if info.test_id in result.quarantined)
+            if quarantined:
+                infos.append("quarantined failures={}".format(quarantined))
 
             if skipped:
                 infos.append("Skipped={}".format(skipped))
@@ -108,10 +396,15 @@ class TestRunner(XMLTestRunner):
                 self.stream.writeln("\n")
 
             self.stream.writeln()
-            self.stream.writeln('Generating HTML reports... ')
-            result.generate_html_reports(self)
-            self.stream.writeln('Generating XML reports... ')
-            result.generate_reports(self)
+            self.stream.writeln('Generating HTML and XML reports... ')
+            self.write_reports(result)
+            if self.history:
+                self.add_history(result)
         finally:
-            pass
+            if watchdog is not None:
+                watchdog.stop()
+            if journal is not None:
+                journal.abort()
+            if recorder is not None:
+                recorder.stop()
         return result
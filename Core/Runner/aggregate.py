@@ -0,0 +1,96 @@
+# coding=utf8
+
+"""
+One pass over the recorded tests of a result, shared by the reporters.
+
+The XML report groups the tests by suite docstring (or class name), the
+HTML report by class name, and both used to build their grouping and
+count outcomes with their own passes over the result lists. `aggregate`
+builds both groupings and every counter at once; the reporters read the
+`ResultModel` it returns, which lets them run at the same time.
+"""
+
+from collections import OrderedDict
+
+from .records import SUCCESS, FAILURE, ERROR, SKIP
+
+
+class Counts(object):
+    """ Outcome counters and summed elapsed time of a group of tests. """
+
+    __slots__ = ('tests', 'successes', 'failures', 'errors', 'skipped', 'time')
+
+    def __init__(self):
+        self.tests = self.successes = self.failures = self.errors = self.skipped = 0
+        self.time = 0.0
+
+    def add(self, info):
+        self.tests += 1
+        self.time += info.elapsed_time
+        if info.outcome == SUCCESS:
+            self.successes += 1
+        elif info.outcome == FAILURE:
+            self.failures += 1
+        elif info.outcome == ERROR:
+            self.errors += 1
+        elif info.outcome == SKIP:
+            self.skipped += 1
+
+    def status(self):
+        """ The summary of the HTML report, e.g. 'Pass: 8, Fail: 1'. """
+        status = []
+        if self.successes:
+            status.append('Pass: {}'.format(self.successes))
+        if self.failures:
+            status.append('Fail: {}'.format(self.failures))
+        if self.errors:
+            status.append('Error: {}'.format(self.errors))
+        if self.skipped:
+            status.append('Skip: {}'.format(self.skipped))
+        return ', '.join(status)
+
+
+class ResultModel(object):
+    """
+    The finished tests of a run (the last attempt of each), grouped by
+    XML suite and by class, with the counters of every group.
+    """
+
+    def __init__(self):
+        self.tests = []
+        # suite docstring or class name -> tests, the suites of output.xml
+        self.suites = OrderedDict()
+        self.suite_counts = {}
+        # class name -> tests, the order of the HTML report
+        self.classes = OrderedDict()
+        self.totals = Counts()
+
+    def add(self, info):
+        self.tests.append(info)
+        # The records of the HTML-only result have no suite docstring
+        suite = getattr(info, 'suite_doc', None) or info.test_name
+        tests = self.suites.get(suite)
+        if tests is None:
+            tests = self.suites[suite] = []
+            self.suite_counts[suite] = Counts()
+        tests.append(info)
+        self.suite_counts[suite].add(info)
+        self.classes.setdefault(info.test_name, []).append(info)
+        self.totals.add(info)
+
+    def class_tests(self):
+        """ Every test, class by class. """
+        return [info for tests in self.classes.values() for info in tests]
+
+
+def aggregate(result):
+    """ Builds the `ResultModel` of a result object in one pass. """
+    model = ResultModel()
+    for tests in (result.successes, result.failures, result.errors,
+                  result.skipped):
+        for info in tests:
+            if isinstance(info, tuple):
+                # This is a skipped, error or a failure test case
+                info = info[0]
+            model.add(info)
+    return model
@@ -0,0 +1,169 @@
+# coding=utf8
+
+"""
+asyncio test support.
+
+Test methods written as `async def test_xxx` are driven on one event loop,
+at most `result.async_limit` at a time, so independent API checks overlap
+their network waits. `setUp`/`tearDown` may be coroutines as well. Every
+test runs in its own asyncio task, and the thread-safe result keeps the
+timing and captured output of each in-flight test apart.
+"""
+
+import asyncio
+import inspect
+import sys
+from collections import OrderedDict
+from unittest import IsolatedAsyncioTestCase, SkipTest, TestSuite
+
+from .threadsafe import capture_output
+from .utils import iter_tests, record_error
+from .watchdog import get_timeout, timeout_exc_info
+
+# Default number of async tests in flight at the same time
+DEFAULT_LIMIT = 10
+
+
+def is_async_test(test):
+    method = getattr(test, getattr(test, '_testMethodName', ''), None)
+    return (inspect.iscoroutinefunction(method) and
+            not isinstance(test, IsolatedAsyncioTestCase))
+
+
+def split_async(suite):
+    """
+    Split a suite into the tests that run synchronously and the classes
+    with async test methods, mapped class -> tests. A class with at least
+    one async test runs all of its tests on the event loop, so its class
+    fixtures are only set up once.
+    """
+    tests = list(iter_tests(suite))
+    async_classes = set(type(test) for test in tests if is_async_test(test))
+    sync_tests = []
+    async_tests = OrderedDict()
+    for test in tests:
+        if type(test) in async_classes:
+            async_tests.setdefault(type(test), []).append(test)
+        else:
+            sync_tests.append(test)
+    return sync_tests, async_tests
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        await value
+
+
+def _skip_reason(test, method):
+    for obj in (type(test), method):
+        if getattr(obj, '__unittest_skip__', False):
+            return getattr(obj, '__unittest_skip_why__', '')
+    return None
+
+
+async def run_test(test, result):
+    """ The TestCase.run protocol for a coroutine (or plain) test method. """
+    method = getattr(test, test._testMethodName)
+    result.reset_local_state()
+    if not inspect.iscoroutinefunction(method):
+        test(result)
+        return
+    result.startTest(test)
+    try:
+        reason = _skip_reason(test, method)
+        if reason is not None:
+            result.addSkip(test, reason)
+            return
+        expecting_failure = getattr(method, '__unittest_expecting_failure__', False)
+        try:
+            await _maybe_await(test.setUp())
+        except SkipTest as e:
+            result.addSkip(test, str(e))
+            return
+        except Exception:
+            result.addError(test, sys.exc_info())
+            return
+        passed = False
+        timeout = get_timeout(test, getattr(result, 'test_timeout', None))
+        try:
+            await asyncio.wait_for(method(), timeout)
+            passed = True
+        except asyncio.TimeoutError:
+            result.addError(test, timeout_exc_info(
+                'Test time budget of {}s exceeded'.format(timeout)))
+        except SkipTest as e:
+            result.addSkip(test, str(e))
+        except test.failureException:
+            if expecting_failure:
+                result.addExpectedFailure(test, sys.exc_info())
+            else:
+                result.addFailure(test, sys.exc_info())
+        except Exception:
+            result.addError(test, sys.exc_info())
+        try:
+            await _maybe_await(test.tearDown())
+        except Exception:
+            result.addError(test, sys.exc_info())
+            passed = False
+        test.doCleanups()
+        if passed:
+            if expecting_failure:
+                result.addUnexpectedSuccess(test)
+            else:
+                result.addSuccess(test)
+    finally:
+        result.stopTest(test)
+
+
+async def _run_class(cls, tests, result, semaphore):
+    result.reset_local_state()
+    # A skipped class doesn't get its fixtures, every test reports the skip
+    fixtures = not getattr(cls, '__unittest_skip__', False)
+    try:
+        if fixtures:
+            cls.setUpClass()
+    except Exception:
+        record_error(result, tests, sys.exc_info())
+        return
+
+    async def limited(test):
+        async with semaphore:
+            if not result.shouldStop:
+                await run_test(test, result)
+
+    try:
+        await asyncio.gather(*[limited(test) for test in tests])
+    finally:
+        if fixtures:
+            try:
+                cls.tearDownClass()
+            except Exception:
+                result.stream.writeln('tearDownClass of {} failed: {}'.format(
+                    cls.__name__, sys.exc_info()[1]))
+            cls.doClassCleanups()
+
+
+async def _run_classes(async_tests, result, limit):
+    semaphore = asyncio.Semaphore(limit)
+    await asyncio.gather(*[_run_class(cls, tests, result, semaphore)
+                           for cls, tests in async_tests.items()])
+
+
+def run_suite(suite, result):
+    """
+    Runs a suite like `suite(result)` does, except that classes with
+    async test methods are driven on an event loop.
+    """
+    if not isinstance(suite, TestSuite):
+        suite(result)
+        return
+    sync_tests, async_tests = split_async(suite)
+    if not async_tests:
+        suite(result)
+        return
+    if sync_tests:
+        TestSuite(sync_tests)(result)
+    if not result.shouldStop:
+        limit = getattr(result, 'async_limit', DEFAULT_LIMIT)
+        with capture_output(result):
+            asyncio.run(_run_classes(async_tests, result, limit))
@@ -0,0 +1,361 @@
+# coding=utf8
+
+"""
+Benchmarks of the time it takes to get to the first test.
+
+Every measurement runs in a fresh interpreter, so imports are cold:
+
+    import:Core.Keywords              import of the keyword proxies
+    import:<module> / init:<class>    import and construction of every
+                                      keyword library of Core.Keywords
+    import:RunTestSuites              import of the test modules
+    load:RunTestSuites                RunTestSuites.test_suites()
+    first_test                        interpreter ready -> first test done
+                                      (its body replaced by a no-op)
+    report:*                          with --reports N: output.xml and
+                                      report.html of N synthetic tests,
+                                      docstrings split per report (before)
+                                      or parsed once (after)
+
+Usage:
+    python -m Core.Runner.benchmark -o Results/benchmark.json
+    python -m Core.Runner.benchmark --save-baseline benchmark_baseline.json
+    python -m Core.Runner.benchmark --baseline benchmark_baseline.json
+    python -m Core.Runner.benchmark --only reports --reports 50000
+
+With --baseline the exit code is 1 when the median of a benchmark got
+slower than the baseline by more than --tolerance (relative) and
+--min-delta (seconds, keeps noise on tiny numbers from failing a build).
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import re
+import time
+from unittest import TestCase, TestSuite
+from unittest.runner import _WritelnDecorator
+
+
+def _import_keywords():
+    start = time.perf_counter()
+    import Core.Keywords
+    return {'import:Core.Keywords': time.perf_counter() - start}
+
+
+def _keyword_libraries():
+    """ `(module, class name)` of every keyword library of Core.Keywords. """
+    from Core import Keywords
+    return [(library._module, library._class_name)
+            for library in vars(Keywords).values()
+            if isinstance(library, Keywords.LazyLibrary)]
+
+
+def _library(module_name, class_name):
+    import importlib
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    imported = time.perf_counter()
+    getattr(module, class_name)()
+    return {'import:' + module_name: imported - start,
+            'init:' + class_name: time.perf_counter() - imported}
+
+
+def _load_suite():
+    start = time.perf_counter()
+    import RunTestSuites
+    imported = time.perf_counter()
+    RunTestSuites.test_suites()
+    return {'import:RunTestSuites': imported - start,
+            'load:RunTestSuites': time.perf_counter() - imported}
+
+
+def _first_test():
+    start = time.perf_counter()
+    import RunTestSuites
+    from .TestRunner import _TestResult
+    from .utils import iter_tests
+    test = next(iter_tests(RunTestSuites.test_suites()))
+    # Only the way to the test is measured, not what the test does
+    setattr(test, test._testMethodName, lambda: None)
+    stopped = []
+
+    class Result(_TestResult):
+        def stopTest(self, test):
+            super(Result, self).stopTest(test)
+            stopped.append(time.perf_counter())
+
+    result = Result(_WritelnDecorator(io.StringIO()), True, 0, True)
+    TestSuite([test]).run(result)
+    return {'first_test': stopped[0] - start}
+
+
+# Docstring of the synthetic tests, in the README format
+_SYNTHETIC_DOC = """{:05d}_synthetic test {}
+        操作步骤:
+        1、open page {}
+        2、click button
+        ======
+        预期结果:
+        1、page {} is shown
+        """
+
+
+def _legacy_doc_parsing(doc):
+    """ How both reports split a docstring before testdoc, for reference. """
+    test_doc = doc if doc else '======'
+    test_doc = test_doc.split('\n', 1)[-1]
+    sep = re.findall(r'(======+)', test_doc)[0] if len(re.findall(r'(======+)', test_doc)) != 0 else '======'
+    test_doc = test_doc.split(sep, 1)
+    return test_doc[0], test_doc[1] if len(test_doc) > 1 else ''
+
+
+class _LegacyDoc(object):
+    """ The doc of a record as the reports read it before testdoc: the raw
+        docstring split again by every report, for every row. """
+
+    def __init__(self, docstring):
+        self.docstring = docstring
+
+    @property
+    def steps(self):
+        # Read first by both reports, one split per row and report
+        self._split = _legacy_doc_parsing(self.docstring)
+        return self._split[0]
+
+    @property
+    def expected(self):
+        return self._split[1]
+
+
+def _write_reports(result, infos, runner):
+    """ Writes output.xml and report.html of the records, returns the time taken. """
+    from .aggregate import ResultModel
+    start = time.perf_counter()
+    model = ResultModel()
+    for info in infos:
+        model.add(info)
+    result.generate_html_reports(runner, model)
+    result.generate_reports(runner, model)
+    return time.perf_counter() - start
+
+
+def _reports(count):
+    """
+    output.xml and report.html of `count` synthetic tests, 1 in 10
+    failing, with the docstrings split by each report for each row as
+    before testdoc (report:before) and parsed once into a TestDoc
+    (report:after, the parsing included).
+    """
+    import shutil
+    import tempfile
+    from datetime import datetime, timedelta
+    from . import testdoc
+    from .TestRunner import TestRunner, _TestResult
+
+    def make_test(number):
+        def test(self):
+            pass
+        test.__doc__ = _SYNTHETIC_DOC.format(number, number, number, number)
+        return test
+    methods = dict(('test_{:05d}'.format(i), make_test(i)) for i in range(count))
+    cls = type('Synthetic', (TestCase,), methods)
+    tests = [cls(name) for name in sorted(methods)]
+
+    result = _TestResult(_WritelnDecorator(io.StringIO()), True, 0, True)
+    # No test is running, there is no captured output to add to errors
+    result.buffer = False
+    try:
+        raise AssertionError('synthetic failure')
+    except AssertionError:
+        err = sys.exc_info()
+    infos = []
+    for number, test in enumerate(tests):
+        if number % 10:
+            info = result.infoclass(result, test)
+        else:
+            info = result.infoclass(result, test, result.infoclass.FAILURE, err)
+        info.start_time = info.stop_time = 0.0
+        infos.append(info)
+
+    output = tempfile.mkdtemp(prefix='crf_benchmark_')
+    runner = TestRunner(output=output, stream=_WritelnDecorator(io.StringIO()))
+    runner.start_time, runner.time_taken = datetime.now(), timedelta(0)
+    timings = {}
+    try:
+        for info, test in zip(infos, tests):
+            info.doc = _LegacyDoc(test._testMethodDoc)
+        # The templates are compiled by whichever run comes first
+        _write_reports(result, infos, runner)
+        timings['report:before'] = _write_reports(result, infos, runner)
+
+        testdoc._cache.clear()
+        start = time.perf_counter()
+        for info, test in zip(infos, tests):
+            info.doc = testdoc.get_test_doc(test)
+        timings['report:load_docs'] = time.perf_counter() - start
+        timings['report:after'] = timings['report:load_docs'] + _write_reports(
+            result, infos, runner)
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+    return timings
+
+
+def _run_child(args, root):
+    """ Run one measurement in a fresh interpreter, returns its timings. """
+    process = subprocess.run(
+        [sys.executable, '-m', 'Core.Runner.benchmark', '--child'] + args,
+        cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if process.returncode != 0:
+        lines = process.stderr.strip().splitlines() or ['exit code {}'.format(
+            process.returncode)]
+        raise RuntimeError(lines[-1])
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def _children(reports=0):
+    children = [['keywords']]
+    children.extend(['library', module, cls] for module, cls in _keyword_libraries())
+    children.extend([['suite'], ['first_test']])
+    if reports:
+        children.append(['reports', str(reports)])
+    return children
+
+
+def run_benchmarks(repeat=5, root='.', only=None, reports=0):
+    """ Returns `{name: {'median', 'min', 'runs'} or {'error'}}`. """
+    runs = {}
+    errors = {}
+    for child in _children(reports):
+        if only and not any(part.startswith(only) for part in child):
+            continue
+        for _ in range(repeat):
+            try:
+                timings = _run_child(child, root)
+            except RuntimeError as e:
+                errors[':'.join(child)] = str(e)
+                break
+            for name, value in timings.items():
+                runs.setdefault(name, []).append(value)
+    benchmarks = {}
+    for name, values in runs.items():
+        benchmarks[name] = {'median': statistics.median(values),
+                            'min': min(values), 'runs': values}
+    for name, error in errors.items():
+        benchmarks[name] = {'error': error}
+    return benchmarks
+
+
+def compare(benchmarks, baseline, tolerance=0.2, min_delta=0.05):
+    """ Returns a message for every benchmark slower than its baseline. """
+    regressions = []
+    for name, expected in sorted(baseline.items()):
+        if 'median' not in expected:
+            continue
+        actual = benchmarks.get(name)
+        if actual is None:
+            regressions.append('{}: not measured, see the errors above'.format(name))
+            continue
+        if 'error' in actual:
+            regressions.append('{}: failed ({})'.format(name, actual['error']))
+            continue
+        delta = actual['median'] - expected['median']
+        if delta > min_delta and delta > expected['median'] * tolerance:
+            regressions.append('{}: {:.3f}s, baseline {:.3f}s (+{:.0f}%)'.format(
+                name, actual['median'], expected['median'],
+                100.0 * delta / expected['median'] if expected['median'] else 100.0))
+    return regressions
+
+
+def _load(filename):
+    with open(filename, encoding='utf8') as json_file:
+        return json.load(json_file)['benchmarks']
+
+
+def _save(filename, benchmarks):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(filename, 'w', encoding='utf8') as json_file:
+        json.dump({'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'benchmarks': benchmarks}, json_file, indent=2, sort_keys=True)
+
+
+def _child_main(args):
+    kind = args[0]
+    if kind == 'keywords':
+        timings = _import_keywords()
+    elif kind == 'library':
+        timings = _library(args[1], args[2])
+    elif kind == 'suite':
+        timings = _load_suite()
+    elif kind == 'reports':
+        timings = _reports(int(args[1]))
+    else:
+        timings = _first_test()
+    print(json.dumps(timings))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == '--child':
+        sys.path.insert(0, os.getcwd())
+        _child_main(argv[1:])
+        return 0
+    parser = argparse.ArgumentParser(description='Startup benchmarks.')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='runs of every benchmark, the median is kept')
+    parser.add_argument('-o', '--output', default='Results/benchmark.json',
+                        help='result file')
+    parser.add_argument('--only', help='only benchmarks starting with this')
+    parser.add_argument('--reports', type=int, default=0, metavar='N',
+                        help='also benchmark the reports of N synthetic tests, e.g. 50000')
+    parser.add_argument('--baseline', help='fail on a regression against this file')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='also store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown, default 0.2')
+    parser.add_argument('--min-delta', type=float, default=0.05,
+                        help='slowdowns below this many seconds are ignored')
+    args = parser.parse_args(argv)
+
+    benchmarks = run_benchmarks(args.repeat, only=args.only, reports=args.reports)
+    for name in sorted(benchmarks):
+        value = benchmarks[name]
+        if 'error' in value:
+            print('{:<45} ERROR {}'.format(name, value['error']))
+        else:
+            print('{:<45} {:8.3f}s (min {:.3f}s)'.format(
+                name, value['median'], value['min']))
+    before = benchmarks.get('report:before', {}).get('median')
+    after = benchmarks.get('report:after', {}).get('median')
+    if before and after:
+        print('output.xml and report.html of {} tests: {:.3f}s with the docstrings split '
+              'by every report before, {:.3f}s with one TestDoc now ({:.2f}x)'.format(
+                  args.reports, before, after, before / after))
+    _save(args.output, benchmarks)
+    if args.save_baseline:
+        _save(args.save_baseline, benchmarks)
+    if args.baseline:
+        baseline = _load(args.baseline)
+        if args.only:
+            baseline = dict((name, value) for name, value in baseline.items()
+                            if name in benchmarks)
+        regressions = compare(benchmarks, baseline, args.tolerance, args.min_delta)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+# coding=utf8
+
+"""
+A resident runner that keeps the keyword libraries and test modules
+imported between runs.
+
+Importing `Core.Keywords` pulls in Selenium, Appium, the Robot standard
+libraries... which takes seconds before the first test starts. The daemon
+pays that once; every run submitted to it only reloads the project modules
+changed on disk since the previous run, then streams the console output
+back to the client.
+
+    python -m Core.Runner.daemon serve            # start the daemon
+    python -m Core.Runner.daemon run [options]    # same options as RunTestSuites.py
+    python -m Core.Runner.daemon stop
+
+Runs are executed one at a time in the daemon process. The runner itself
+(`Core.Runner`) is never reloaded, restart the daemon after updating it.
+"""
+
+import binascii
+import importlib
+import inspect
+import json
+import os
+import sys
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing.connection import Client, Listener
+
+# Address and key of the running daemon, written in the project root
+INFO_FILE = '.crf_daemon'
+# Modules never reloaded: the daemon itself and the runner it uses
+EXCLUDED = ('__main__', 'Core.Runner')
+
+
+class ModuleWatcher(object):
+    """ Tracks the project modules on disk and reloads the changed ones. """
+
+    def __init__(self, root, excluded=EXCLUDED):
+        self.root = os.path.normcase(os.path.abspath(root)) + os.sep
+        self.excluded = excluded
+        self.mtimes = {}
+
+    def _is_excluded(self, name):
+        return any(name == prefix or name.startswith(prefix + '.')
+                   for prefix in self.excluded)
+
+    def project_modules(self):
+        """ `(name, module, filename)` of the modules imported from the project. """
+        for name, module in list(sys.modules.items()):
+            filename = getattr(module, '__file__', None)
+            if not filename or self._is_excluded(name):
+                continue
+            filename = os.path.normcase(os.path.abspath(filename))
+            if filename.startswith(self.root):
+                yield name, module, filename
+
+    @staticmethod
+    def _mtime(filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def snapshot(self):
+        """ Remember the modification time of every project module. """
+        for name, _, filename in self.project_modules():
+            self.mtimes[name] = self._mtime(filename)
+
+    def _dependents(self, modules, changed):
+        """ Modules holding names imported from a changed module. """
+        dependents = set()
+        for name, module, _ in modules:
+            if name in changed:
+                continue
+            for value in list(vars(module).values()):
+                owner = getattr(value, '__name__' if inspect.ismodule(value)
+                                else '__module__', None)
+                if owner in changed:
+                    dependents.add(name)
+                    break
+        return dependents
+
+    def reload_changed(self):
+        """
+        Reload the modules changed since the last snapshot, and the modules
+        which did `from changed import name`, so they don't keep stale
+        objects. Returns the reloaded module names in import order.
+        """
+        modules = list(self.project_modules())
+        changed = set(name for name, _, filename in modules
+                      if name in self.mtimes and
+                      self._mtime(filename) != self.mtimes[name])
+        while changed:
+            dependents = self._dependents(modules, changed)
+            if not dependents:
+                break
+            changed |= dependents
+        reloaded = []
+        # sys.modules is in import order, dependencies come first
+        for name, module, _ in modules:
+            if name in changed:
+                importlib.reload(module)
+                reloaded.append(name)
+        self.snapshot()
+        return reloaded
+
+
+class _ClientStream(object):
+    """ Console output of a run, sent to the client. """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pid = os.getpid()
+        self.closed = False
+
+    def write(self, text):
+        if self.closed or os.getpid() != self.pid:
+            # Client gone, or written from a forked worker process
+            return sys.__stderr__.write(text)
+        try:
+            self.conn.send(('out', text))
+        except (OSError, EOFError):
+            self.closed = True
+
+    def flush(self):
+        pass
+
+
+def _read_info(root):
+    with open(os.path.join(root, INFO_FILE)) as info_file:
+        info = json.load(info_file)
+    return tuple(info['address']), binascii.unhexlify(info['authkey'])
+
+
+def _write_info(root, address, authkey):
+    path = os.path.join(root, INFO_FILE)
+    with open(path, 'w') as info_file:
+        json.dump({'address': list(address), 'authkey': binascii.hexlify(authkey).decode(),
+                   'pid': os.getpid()}, info_file)
+    os.chmod(path, 0o600)
+    return path
+
+
+def _run(argv, conn, watcher):
+    stream = _ClientStream(conn)
+    with redirect_stdout(stream), redirect_stderr(stream):
+        reloaded = watcher.reload_changed()
+        if reloaded:
+            stream.write('Reloaded {}\n'.format(', '.join(reloaded)))
+        import RunTestSuites
+        result = None
+        try:
+            result = RunTestSuites.run(RunTestSuites.parse_args(argv), stream)
+        except SystemExit:
+            # argparse errors and --help
+            pass
+        except Exception:
+            import traceback
+            stream.write(traceback.format_exc())
+        watcher.snapshot()
+    return result is not None and result.wasSuccessful()
+
+
+def serve(root='.', host='127.0.0.1', port=0):
+    """ Import the project once, then run every submitted selection. """
+    root = os.path.abspath(root)
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    watcher = ModuleWatcher(root)
+    # The expensive part: keyword libraries and every test module
+    import RunTestSuites
+    RunTestSuites.test_suites()
+    importlib.import_module('Core.Keywords').preload()
+    watcher.snapshot()
+
+    authkey = os.urandom(16)
+    listener = Listener((host, port), authkey=authkey)
+    path = _write_info(root, listener.address, authkey)
+    print('Runner daemon listening on {}:{}'.format(*listener.address))
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                # Bad authkey or client gone before the handshake
+                continue
+            with conn:
+                try:
+                    command, argv = conn.recv()
+                except (OSError, EOFError):
+                    continue
+                if command == 'stop':
+                    conn.send(('done', True))
+                    break
+                success = _run(argv, conn, watcher)
+                try:
+                    conn.send(('done', success))
+                except (OSError, EOFError):
+                    pass
+    finally:
+        listener.close()
+        os.remove(path)
+
+
+def submit(argv, root='.', command='run'):
+    """ Send a run to the daemon and print its output. Returns the exit code. """
+    try:
+        address, authkey = _read_info(root)
+        conn = Client(address, authkey=authkey)
+    except (OSError, ValueError, KeyError):
+        sys.stderr.write('Runner daemon is not running, start it with: '
+                         'python -m Core.Runner.daemon serve\n')
+        return 2
+    with conn:
+        conn.send((command, argv))
+        while True:
+            try:
+                kind, value = conn.recv()
+            except EOFError:
+                return 2
+            if kind == 'out':
+                sys.stderr.write(value)
+                sys.stderr.flush()
+            elif kind == 'done':
+                return 0 if value else 1
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else ''
+    if command == 'serve':
+        serve()
+    elif command == 'run':
+        return submit(argv[1:])
+    elif command == 'stop':
+        return submit([], command='stop')
+    else:
+        sys.stderr.write('usage: python -m Core.Runner.daemon serve|run [options]|stop\n')
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
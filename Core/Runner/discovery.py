@@ -0,0 +1,335 @@
+# coding=utf8
+
+"""
+Test discovery without importing the test modules.
+
+The files under `TestCase/` are parsed (not imported) into an index of
+module -> TestCase classes -> test methods -> test ids (the `U0001` part
+of the `U0001_标题` docstring line). The index is cached in
+`.crf_cache/discovery.json` and a file is only parsed again when its
+mtime or size changed. A selection is resolved against the index, then
+only the modules it needs are imported.
+
+Test methods inherited from a class of the index (same module or another
+one, followed through the imports of the module) are indexed with the
+class. A class with a base the index can't see (not a unittest class,
+e.g. a mixin of Library/ or a star import) is imported and its tests are
+found by the loader.
+
+A selection item matches a test by any of:
+    TestCase.UserSystem.UserGUI          module (or any dotted prefix)
+    UserGUI / UserGUI.test_U0001         class, class.method
+    test_U0001 / U0001 / U02*            method, test id, glob patterns
+
+List what a selection resolves to:
+    python -m Core.Runner.discovery U0001 UserGUI
+"""
+
+import ast
+import fnmatch
+import importlib
+import json
+import os
+import sys
+from collections import OrderedDict
+from unittest import TestCase, TestLoader, TestSuite
+from unittest.loader import _make_failed_import_test
+
+from .testdoc import get_test_doc, parse_doc
+
+CACHE_FILE = os.path.join('.crf_cache', 'discovery.json')
+# Bump when the index layout changes
+INDEX_VERSION = 2
+# Bases which add no test methods
+UNITTEST_BASES = ('object', 'unittest.TestCase', 'unittest.case.TestCase',
+                  'unittest.IsolatedAsyncioTestCase',
+                  'unittest.async_case.IsolatedAsyncioTestCase')
+
+
+def _is_test_method(node, prefix):
+    return (isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and
+            node.name.startswith(prefix))
+
+
+def _dotted_name(node):
+    """ 'a.b.C' of a Name/Attribute expression, None for anything else. """
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        value = _dotted_name(node.value)
+        return value + '.' + node.attr if value else None
+    return None
+
+
+def _imported_names(tree, module):
+    """ {name: qualified name} of the module level imports of a module. """
+    names = {}
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.asname:
+                    names[alias.asname] = alias.name
+                else:
+                    name = alias.name.split('.', 1)[0]
+                    names[name] = name
+        elif isinstance(node, ast.ImportFrom):
+            source = node.module or ''
+            if node.level:
+                package = (module or '').split('.')[:-node.level]
+                source = '.'.join(package + ([source] if source else []))
+            for alias in node.names:
+                if alias.name != '*':
+                    names[alias.asname or alias.name] = source + '.' + alias.name
+    return names
+
+
+def parse_module(filename, prefix='test', module=None):
+    """
+    `[{'name', 'bases', 'tests': [[method, id], ...]}]` of the classes of
+    a test file, `module` is its module name. A base is the name of a class
+    of the file, a qualified name through the imports, or as written.
+    """
+    with open(filename, 'rb') as source:
+        tree = ast.parse(source.read(), filename)
+    imported = _imported_names(tree, module)
+    local = set(node.name for node in tree.body if isinstance(node, ast.ClassDef))
+    classes = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        tests = [[item.name, parse_doc(ast.get_docstring(item)).id]
+                 for item in node.body if _is_test_method(item, prefix)]
+        bases = []
+        for base in node.bases:
+            name = _dotted_name(base) or ''
+            first, dot, rest = name.partition('.')
+            if name not in local and first in imported:
+                name = imported[first] + dot + rest
+            bases.append(name)
+        classes.append({'name': node.name, 'bases': bases, 'tests': tests})
+    return classes
+
+
+class TestIndex(object):
+    """ Cached index of the tests under a directory. """
+
+    def __init__(self, root='TestCase', cache_file=CACHE_FILE, prefix='test'):
+        self.root = root
+        self.cache_file = cache_file
+        self.prefix = prefix
+        self.files = {}
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file, encoding='utf8') as cache:
+                data = json.load(cache)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != INDEX_VERSION or data.get('prefix') != self.prefix:
+            return {}
+        return data.get('files', {})
+
+    def _save_cache(self):
+        directory = os.path.dirname(self.cache_file)
+        try:
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.cache_file, 'w', encoding='utf8') as cache:
+                json.dump({'version': INDEX_VERSION, 'prefix': self.prefix,
+                           'files': self.files}, cache, ensure_ascii=False)
+        except OSError:
+            pass
+
+    def _module_name(self, filename):
+        path = os.path.splitext(os.path.relpath(filename))[0]
+        return path.replace(os.sep, '.')
+
+    def refresh(self):
+        """ Update the index, parsing only new and changed files. """
+        cached = self._load_cache()
+        files = {}
+        changed = False
+        for directory, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+            for name in sorted(filenames):
+                if not name.endswith('.py'):
+                    continue
+                filename = os.path.join(directory, name)
+                stat = os.stat(filename)
+                entry = cached.get(filename)
+                if (entry is None or entry['mtime'] != stat.st_mtime_ns or
+                        entry['size'] != stat.st_size):
+                    try:
+                        classes = parse_module(filename, self.prefix,
+                                               self._module_name(filename))
+                    except (SyntaxError, ValueError):
+                        # Imported anyway, so the loader reports the error
+                        classes = None
+                    entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+                             'module': self._module_name(filename),
+                             'classes': classes}
+                    changed = True
+                files[filename] = entry
+        self.files = files
+        if changed or set(files) != set(cached):
+            self._save_cache()
+        self._resolve()
+        return self
+
+    def _resolve(self):
+        """ Adds the inherited tests to the classes, finds the unresolved ones. """
+        classes = OrderedDict()
+        for entry in self.files.values():
+            for cls in entry['classes'] or []:
+                classes[(entry['module'], cls['name'])] = cls
+        resolved = {}
+
+        def resolve(key, seen):
+            if key in resolved:
+                return resolved[key]
+            tests = OrderedDict((name, id_) for name, id_ in classes[key]['tests'])
+            unresolved = False
+            for base in classes[key]['bases']:
+                if base in UNITTEST_BASES:
+                    continue
+                base_key = tuple(base.rsplit('.', 1)) if '.' in base else (key[0], base)
+                if base_key not in classes or base_key in seen:
+                    unresolved = True
+                    continue
+                base_tests, base_unresolved = resolve(base_key, seen | {key})
+                unresolved = unresolved or base_unresolved
+                for name, id_ in base_tests.items():
+                    tests.setdefault(name, id_)
+            resolved[key] = tests, unresolved
+            return resolved[key]
+
+        # (module, class, [[method, id], ...]) of the classes with tests
+        self.classes = []
+        # (module, class) of the classes whose tests the loader has to find
+        self.unresolved = set()
+        for key in classes:
+            tests, unresolved = resolve(key, frozenset())
+            if unresolved:
+                self.unresolved.add(key)
+            if tests or unresolved:
+                self.classes.append(key + (sorted(tests.items()),))
+
+    def entries(self):
+        """ `(module, class, method, test id)` of every indexed test. """
+        for module, class_name, tests in self.classes:
+            for method, id_ in tests:
+                yield module, class_name, method, id_
+
+    def broken_modules(self):
+        """ Modules which could not be parsed. """
+        return [entry['module'] for entry in self.files.values()
+                if entry['classes'] is None]
+
+    def select(self, selection=None):
+        """
+        Returns `[(module, class, methods)]` in index order, methods is None
+        when every test of the class is selected.
+        """
+        groups = OrderedDict()
+        totals = {}
+        for module, class_name, tests in self.classes:
+            key = (module, class_name)
+            totals[key] = len(tests)
+            if key in self.unresolved:
+                # Its tests are only known once imported, see discover()
+                groups[key] = None
+                continue
+            for method, id_ in tests:
+                if selection and not any(_matches(pattern, module, class_name, method, id_)
+                                         for pattern in selection):
+                    continue
+                groups.setdefault(key, []).append(method)
+        return [(module, class_name, None if methods is None or
+                 len(methods) == totals[(module, class_name)] else methods)
+                for (module, class_name), methods in groups.items()]
+
+
+def _matches(pattern, module, class_name, method, id_):
+    full = '{}.{}.{}'.format(module, class_name, method)
+    if full.startswith(pattern + '.'):
+        return True
+    candidates = [full, '{}.{}'.format(class_name, method), class_name, method,
+                  method.split('_', 1)[-1]]
+    if id_:
+        candidates.append(id_)
+    return any(fnmatch.fnmatchcase(candidate, pattern) for candidate in candidates)
+
+
+def _import_tests(module_name, loader):
+    """ Imports a test module, or returns a suite reporting why it can't. """
+    try:
+        return importlib.import_module(module_name)
+    except Exception:
+        # Same failing test as the loader makes for a module it can't import
+        test, error = _make_failed_import_test(module_name, loader.suiteClass)
+        loader.errors.append(error)
+        return test
+
+
+def _selected(tests, selection):
+    """ The tests of a suite matching the selection. """
+    return [test for test in tests if any(
+        _matches(pattern, *test.id().rsplit('.', 2) + [get_test_doc(test).id])
+        for pattern in selection)]
+
+
+def discover(root='TestCase', selection=None, loader=None, cache_file=CACHE_FILE):
+    """
+    Builds the suite of the selected tests under `root` (all of them
+    without a selection), importing only the modules it needs.
+    """
+    loader = loader or TestLoader()
+    index = TestIndex(root, cache_file, loader.testMethodPrefix).refresh()
+    suite = TestSuite()
+    # module name -> module, or the suite reporting its import error once
+    modules = {}
+
+    def load(module_name):
+        if module_name not in modules:
+            modules[module_name] = _import_tests(module_name, loader)
+            if isinstance(modules[module_name], TestSuite):
+                suite.addTest(modules[module_name])
+        return modules[module_name]
+
+    if not selection:
+        # Nothing filtered: modules which failed to parse still get reported
+        for module in index.broken_modules():
+            load(module)
+    for module_name, class_name, methods in index.select(selection):
+        module = load(module_name)
+        if isinstance(module, TestSuite):
+            continue
+        cls = getattr(module, class_name, None)
+        if not (isinstance(cls, type) and issubclass(cls, TestCase)):
+            continue
+        if (module_name, class_name) in index.unresolved:
+            # Inherits from a class outside the index, the loader finds its tests
+            tests = loader.loadTestsFromTestCase(cls)
+            suite.addTests(_selected(tests, selection) if selection else tests)
+        elif methods is None:
+            suite.addTest(loader.loadTestsFromTestCase(cls))
+        else:
+            suite.addTests(cls(method) for method in methods)
+    return suite
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    index = TestIndex().refresh()
+    for module, class_name, methods in index.select(argv):
+        if (module, class_name) in index.unresolved:
+            print('{:<8} {}.{}: base class outside the index, its tests are found '
+                  'by importing it'.format('?', module, class_name))
+        for entry in index.entries():
+            if entry[:2] == (module, class_name) and (
+                    methods is None or entry[2] in methods):
+                print('{:<8} {}.{}.{}'.format(entry[3] or '', *entry[:3]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+# coding=utf8
+
+"""
+Flaky test detection from the results history, and their quarantine.
+
+Over the last `runs` runs of the history database (see history.py) the
+flakiness of a test is the highest of:
+
+    retry rate  share of its runs where it only passed after a rerun
+    flip rate   share of consecutive runs whose final outcome changed
+                between pass and fail/error (skips are ignored)
+
+Tests scoring `threshold` or more, with at least `min_runs` runs, are
+quarantined: `TestRunner(quarantine=...)` runs them in a lane of their
+own after the other tests and their reruns, with `quarantine_rerun`
+reruns instead of `rerun`. They are still run and reported, but their
+failures do not fail the run.
+
+    python -m Core.Runner.flaky --runs 20 --threshold 0.3
+"""
+
+import argparse
+import os
+import sys
+from collections import namedtuple
+from unittest import TestSuite
+
+from .history import HISTORY_FILE, History
+from .records import SUCCESS, SKIP
+from .utils import iter_tests
+
+FlakyScore = namedtuple('FlakyScore', 'test_id runs retried flips score')
+
+
+def _score(test_id, finals, retried):
+    """ `FlakyScore` of a test from the `(first, final)` outcomes of its runs. """
+    passed = [final == SUCCESS for _, final in finals if final != SKIP]
+    flips = sum(1 for previous, current in zip(passed, passed[1:])
+                if previous != current)
+    runs = len(finals)
+    score = max(retried / float(runs),
+                flips / float(len(passed) - 1) if len(passed) > 1 else 0.0)
+    return FlakyScore(test_id, runs, retried, flips, score)
+
+
+def score_tests(history, runs=20):
+    """ {test_id: FlakyScore} of every test run in the last `runs` runs. """
+    scores = {}
+    current, finals, retried, run = None, [], 0, None
+    for test_id, run_id, attempt, outcome in history.attempts(runs):
+        if test_id != current:
+            if current is not None:
+                scores[current] = _score(current, finals, retried)
+            current, finals, retried, run = test_id, [], 0, None
+        if run_id != run:
+            run = run_id
+            finals.append([outcome, outcome])
+        else:
+            finals[-1][1] = outcome
+            if outcome == SUCCESS and finals[-1][0] != SUCCESS:
+                retried += 1
+    if current is not None:
+        scores[current] = _score(current, finals, retried)
+    return scores
+
+
+class Quarantine(object):
+    """ The quarantined test ids, and the split of a suite into lanes. """
+
+    def __init__(self, tests=(), scores=None):
+        self.tests = frozenset(tests)
+        self.scores = scores or {}
+
+    @classmethod
+    def from_history(cls, filename=HISTORY_FILE, threshold=0.3, runs=20, min_runs=3):
+        """ Quarantines the flaky tests of a history database, if there is one. """
+        if not filename or not os.path.isfile(filename):
+            return cls()
+        with History(filename) as history:
+            scores = score_tests(history, runs)
+        return cls([test_id for test_id, score in scores.items()
+                    if score.runs >= min_runs and score.score >= threshold], scores)
+
+    def __contains__(self, test_id):
+        return test_id in self.tests
+
+    def __len__(self):
+        return len(self.tests)
+
+    def split(self, suite):
+        """ `(main, quarantined)` suites of the tests of a suite, in loader order. """
+        main, quarantined = TestSuite(), TestSuite()
+        for test in iter_tests(suite):
+            (quarantined if test.id() in self.tests else main).addTest(test)
+        return main, quarantined
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Flakiness of the tests in the results history.')
+    parser.add_argument('--db', default=HISTORY_FILE, help='history database')
+    parser.add_argument('--runs', type=int, default=20, help='last N runs considered')
+    parser.add_argument('--min-runs', type=int, default=3,
+                        help='runs a test needs before it can be quarantined')
+    parser.add_argument('--threshold', type=float, default=0.3,
+                        help='flakiness from which a test is quarantined')
+    parser.add_argument('--all', action='store_true', help='also list the stable tests')
+    args = parser.parse_args(argv)
+    if not os.path.isfile(args.db):
+        parser.error('no history database {}'.format(args.db))
+    quarantine = Quarantine.from_history(args.db, args.threshold, args.runs, args.min_runs)
+    print('  score  runs  retried  flips')
+    for score in sorted(quarantine.scores.values(), key=lambda score: (-score.score, score.test_id)):
+        if score.score or args.all:
+            print('{:7.2f} {:5d} {:8d} {:6d}  {}{}'.format(
+                score.score, score.runs, score.retried, score.flips, score.test_id,
+                '  (quarantined)' if score.test_id in quarantine else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
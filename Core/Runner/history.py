@@ -0,0 +1,243 @@
+# coding=utf8
+
+"""
+History of the test results of every run, in a local SQLite database.
+
+`output.xml` and `report.html` are overwritten by every run. With
+`TestRunner(history=filename)` every recorded attempt of a run (rerun
+attempts included) is added to the database once the run has finished:
+
+    runs     id, title, start_time, stop_time, tests
+    results  run_id, test_id, doc_id, class_name, outcome, elapsed,
+             attempt, error_type, start_time
+
+and can be queried:
+
+    python -m Core.Runner.history slowest --limit 20 --runs 10
+    python -m Core.Runner.history p95 --runs 10
+    python -m Core.Runner.history last -n 5 U0001 'TestCase.UserGUI.*'
+
+`last` also accepts docstring IDs; test ids and IDs may use wildcards.
+"""
+
+import argparse
+import math
+import os
+import sqlite3
+import sys
+import time
+
+from .records import SUCCESS, FAILURE, ERROR, SKIP
+
+HISTORY_FILE = os.path.join('Results', 'history.db')
+# Rows per executemany of the results of a run
+BATCH_SIZE = 1000
+OUTCOMES = {SUCCESS: 'PASS', FAILURE: 'FAIL', ERROR: 'ERROR', SKIP: 'SKIP'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    start_time REAL,
+    stop_time REAL,
+    tests INTEGER
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    test_id TEXT NOT NULL,
+    doc_id TEXT,
+    class_name TEXT,
+    outcome INTEGER,
+    elapsed REAL,
+    attempt INTEGER,
+    error_type TEXT,
+    start_time REAL
+);
+CREATE INDEX IF NOT EXISTS results_test ON results (test_id, start_time);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+CREATE INDEX IF NOT EXISTS runs_start ON runs (start_time);
+"""
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a sorted list. """
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(fraction * len(values))))
+    return values[rank - 1]
+
+
+def result_row(info):
+    """ The `results` columns of a _TestInfo, without the run id. """
+    return (info.test_id, info.doc.id or None, info.test_name, info.outcome,
+            info.elapsed_time, info.rerun, info.error_type or None,
+            info.start_time)
+
+
+class History(object):
+    """ The results history database, one connection per object. """
+
+    def __init__(self, filename=HISTORY_FILE):
+        self.filename = filename
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_run(self, attempts, title=None, start_time=None, stop_time=None):
+        """
+        Adds the attempts (_TestInfo) of a run in one transaction, returns
+        the id of the run.
+        """
+        attempts = list(attempts)
+        if start_time is None:
+            start_time = min([info.start_time for info in attempts] or [time.time()])
+        if stop_time is None:
+            stop_time = max([info.stop_time for info in attempts] or [start_time])
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (title, start_time, stop_time, tests) VALUES (?, ?, ?, ?)',
+                (title, start_time, stop_time,
+                 sum(1 for info in attempts if info.rerun == 0)))
+            run_id = cursor.lastrowid
+            for start in range(0, len(attempts), BATCH_SIZE):
+                self.connection.executemany(
+                    'INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(run_id,) + result_row(info)
+                     for info in attempts[start:start + BATCH_SIZE]])
+        return run_id
+
+    def _since(self, runs):
+        """ Id of the first of the last `runs` runs, 0 for all of them. """
+        if not runs:
+            return 0
+        row = self.connection.execute(
+            'SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET ?',
+            (runs - 1,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def attempts(self, runs=None):
+        """ `(test_id, run_id, attempt, outcome)` of the last `runs` runs, test by test. """
+        return self.connection.execute(
+            'SELECT test_id, run_id, attempt, outcome FROM results WHERE run_id >= ? '
+            'ORDER BY test_id, run_id, attempt', (self._since(runs),))
+
+    def durations(self, runs=None, skip=0):
+        """
+        {test_id: [elapsed, ...]} of the passed attempts of the last `runs`
+        runs, the newest `skip` runs left out.
+        """
+        ids = [row[0] for row in self.connection.execute(
+            'SELECT id FROM runs ORDER BY id DESC LIMIT ? OFFSET ?', (runs or -1, skip))]
+        durations = {}
+        if not ids:
+            return durations
+        for test_id, elapsed in self.connection.execute(
+                'SELECT test_id, elapsed FROM results '
+                'WHERE run_id BETWEEN ? AND ? AND outcome = ?', (ids[-1], ids[0], SUCCESS)):
+            durations.setdefault(test_id, []).append(elapsed)
+        return durations
+
+    def slowest(self, limit=20, runs=None):
+        """
+        `(test_id, doc_id, count, mean, max)` of the tests with the highest
+        mean duration over the last `runs` runs, skipped attempts excluded.
+        """
+        return self.connection.execute(
+            'SELECT test_id, MAX(doc_id), COUNT(*), AVG(elapsed), MAX(elapsed) '
+            'FROM results WHERE run_id >= ? AND outcome != ? '
+            'GROUP BY test_id ORDER BY AVG(elapsed) DESC LIMIT ?',
+            (self._since(runs), SKIP, limit)).fetchall()
+
+    def class_percentile(self, fraction=0.95, runs=None):
+        """
+        `(class_name, count, percentile)` of the test durations of every
+        class over the last `runs` runs, slowest first.
+        """
+        durations = {}
+        for class_name, elapsed in self.connection.execute(
+                'SELECT class_name, elapsed FROM results '
+                'WHERE run_id >= ? AND outcome != ? ORDER BY class_name, elapsed',
+                (self._since(runs), SKIP)):
+            durations.setdefault(class_name, []).append(elapsed)
+        rows = [(class_name, len(values), percentile(values, fraction))
+                for class_name, values in durations.items()]
+        return sorted(rows, key=lambda row: -row[2])
+
+    def last_outcomes(self, n=10, patterns=None):
+        """
+        {test_id: [(run_id, attempt, outcome, elapsed, error_type), ...]}
+        with the last `n` attempts of every test, newest first. `patterns`
+        are test ids or docstring IDs, wildcards allowed.
+        """
+        where, parameters = '', []
+        if patterns:
+            # GLOB has the wildcards of fnmatch and is case sensitive
+            where = ' WHERE ' + ' OR '.join(
+                'test_id GLOB ? OR doc_id GLOB ?' for _ in patterns)
+            for pattern in patterns:
+                parameters.extend((pattern, pattern))
+        outcomes = {}
+        for row in self.connection.execute(
+                'SELECT test_id, run_id, attempt, outcome, elapsed, error_type FROM ('
+                ' SELECT *, ROW_NUMBER() OVER ('
+                '  PARTITION BY test_id ORDER BY run_id DESC, attempt DESC) AS position'
+                ' FROM results' + where + ') WHERE position <= ? ORDER BY test_id, position',
+                parameters + [n]):
+            outcomes.setdefault(row[0], []).append(row[1:])
+        return outcomes
+
+
+def add_result(filename, result, title=None, start_time=None, stop_time=None):
+    """ Adds the attempts of a result object to the history database. """
+    with History(filename) as history:
+        return history.add_run(result.attempts, title, start_time, stop_time)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query the test results history.')
+    parser.add_argument('--db', default=HISTORY_FILE, help='history database')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    slowest = commands.add_parser('slowest', help='tests with the highest mean duration')
+    slowest.add_argument('--limit', type=int, default=20)
+    slowest.add_argument('--runs', type=int, default=None, help='only the last N runs')
+    p95 = commands.add_parser('p95', help='95th percentile of the test durations per class')
+    p95.add_argument('--runs', type=int, default=None, help='only the last N runs')
+    last = commands.add_parser('last', help='last outcomes of every test')
+    last.add_argument('-n', type=int, default=10, help='number of attempts per test')
+    last.add_argument('tests', nargs='*', help='test ids or docstring IDs, wildcards allowed')
+    args = parser.parse_args(argv)
+    if not os.path.isfile(args.db):
+        parser.error('no history database {}'.format(args.db))
+    with History(args.db) as history:
+        if args.command == 'slowest':
+            for test_id, doc_id, count, mean, longest in history.slowest(args.limit, args.runs):
+                print('{:9.3f}s {:9.3f}s {:5d}  {} {}'.format(
+                    mean, longest, count, test_id, doc_id or ''))
+        elif args.command == 'p95':
+            for class_name, count, value in history.class_percentile(0.95, args.runs):
+                print('{:9.3f}s {:5d}  {}'.format(value, count, class_name))
+        else:
+            for test_id, rows in sorted(history.last_outcomes(args.n, args.tests).items()):
+                print('{}  {}'.format(test_id, ' '.join(
+                    '{}{}'.format(OUTCOMES.get(outcome, outcome),
+                                  '(rerun {})'.format(attempt) if attempt else '')
+                    for _, attempt, outcome, _, _ in rows)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+# coding=utf8
+
+"""
+Test impact analysis: which tests to run for a set of changed files.
+
+Recording: with `TestRunner(impact=filename)` the runner records the
+project files every test used and updates the impact map `filename`
+(JSON, test id -> files relative to the project directory):
+
+    python files    any function of the file was called during the test
+    other files     opened during the test, e.g. Resource/TestData/...
+
+Files used by class or module fixtures count for every test of the
+class, the module of a test always counts. Recording traces every call,
+so the tests of a recording run run one at a time (no workers, threads
+or concurrent async tests); only the recorded tests are updated in the
+map.
+
+Selection: `select_impacted` keeps the tests which used one of the
+changed files, and those never recorded:
+
+    git diff --name-only origin/master | python RunTestSuites.py --changed-files -
+    python -m Core.Runner.impact Results/impact.json Library/CommonLibrary.py
+"""
+
+import argparse
+import inspect
+import json
+import os
+import sys
+import threading
+from unittest import TestSuite
+
+from .utils import iter_tests
+
+IMPACT_VERSION = 1
+# Directories of the project whose files are never mapped
+IGNORED_DIRS = ('.git', '.crf_cache', '__pycache__', 'Results')
+
+
+def project_path(filename, root=None):
+    """ Path of a file relative to the project directory with '/', None outside of it. """
+    root = os.path.abspath(root or os.getcwd())
+    try:
+        path = os.path.relpath(os.path.abspath(filename), root)
+    except ValueError:
+        # Another drive on Windows
+        return None
+    if path == os.curdir or path.startswith(os.pardir):
+        return None
+    path = path.replace(os.sep, '/')
+    if any(part in IGNORED_DIRS for part in path.split('/')[:-1]):
+        return None
+    return path
+
+
+def load_map(filename):
+    """ {test_id: [files]} of an impact map file, empty when there is none. """
+    if not filename or not os.path.isfile(filename):
+        return {}
+    try:
+        with open(filename, encoding='utf8') as impact_file:
+            data = json.load(impact_file)
+    except ValueError:
+        return {}
+    if data.get('version') != IMPACT_VERSION:
+        return {}
+    return data.get('tests', {})
+
+
+def save_map(filename, tests):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    temporary = filename + '.tmp'
+    with open(temporary, 'w', encoding='utf8') as impact_file:
+        json.dump({'version': IMPACT_VERSION,
+                   'tests': dict((test_id, sorted(files)) for test_id, files in tests.items())},
+                  impact_file, ensure_ascii=False, indent=0, sort_keys=True)
+    os.replace(temporary, filename)
+
+
+# The recorder the audit hook reports opened files to, audit hooks
+# cannot be removed once added
+_recorder = None
+_hook_added = False
+
+
+def _audit(event, args):
+    recorder = _recorder
+    if recorder is not None and event == 'open' and isinstance(args[0], (str, bytes)):
+        recorder.used(os.fsdecode(args[0]))
+
+
+class ImpactRecorder(object):
+    """ Records the project files used by every test, one test at a time. """
+
+    def __init__(self, filename, root=None):
+        self.filename = filename
+        self.root = os.path.abspath(root or os.getcwd())
+        # test id -> (test class, files used by the test)
+        self.tests = {}
+        # files of the class / module fixtures, by test class
+        self.fixtures = {}
+        # files used while no test was running
+        self._pending = set()
+        self._current = None
+        self._last_class = None
+        # co_filename -> project path, None for files outside the project
+        # and for the runner itself
+        self._paths = {}
+        self._runner = os.path.dirname(os.path.abspath(__file__)) + os.sep
+        self._lock = threading.Lock()
+
+    def _path(self, filename):
+        try:
+            return self._paths[filename]
+        except KeyError:
+            path = None
+            # '<frozen abc>', '<string>'... are not files
+            if not filename.startswith('<') and \
+                    not os.path.abspath(filename).startswith(self._runner):
+                path = project_path(filename, self.root)
+            self._paths[filename] = path
+            return path
+
+    def used(self, filename):
+        path = self._path(filename)
+        if path is None or path.endswith('.pyc'):
+            return
+        with self._lock:
+            (self._current if self._current is not None else self._pending).add(path)
+
+    def _trace(self, frame, event, arg):
+        # Only the call events: no local tracer, no line events
+        self.used(frame.f_code.co_filename)
+
+    def start(self):
+        global _recorder, _hook_added
+        _recorder = self
+        if not _hook_added:
+            sys.addaudithook(_audit)
+            _hook_added = True
+        threading.settrace(self._trace)
+        sys.settrace(self._trace)
+        return self
+
+    def stop(self):
+        global _recorder
+        sys.settrace(None)
+        threading.settrace(None)
+        _recorder = None
+
+    def test_started(self, test):
+        files = set()
+        try:
+            files.add(self._path(inspect.getsourcefile(type(test))))
+        except TypeError:
+            pass
+        files.discard(None)
+        with self._lock:
+            self.fixtures.setdefault(type(test), set()).update(self._pending)
+            self._pending = set()
+            self._current = files
+            self._last_class = type(test)
+
+    def test_stopped(self, test):
+        with self._lock:
+            files, self._current = self._current, None
+            if files is not None:
+                self.tests.setdefault(test.id(), (type(test), set()))[1].update(files)
+
+    def save(self):
+        """ Updates the map file with the recorded tests. """
+        self.stop()
+        if self._last_class is not None:
+            # e.g. tearDownClass of the last class
+            self.fixtures[self._last_class].update(self._pending)
+        tests = load_map(self.filename)
+        for test_id, (cls, files) in self.tests.items():
+            tests[test_id] = files.union(self.fixtures.get(cls, ()))
+        save_map(self.filename, tests)
+        return len(self.tests)
+
+
+def impacted(test_ids, changed, tests):
+    """ The ids of `test_ids` using a changed file or missing from the map `tests`. """
+    changed = set(path for path in (project_path(name) for name in changed) if path)
+    return [test_id for test_id in test_ids
+            if test_id not in tests or not changed.isdisjoint(tests[test_id])]
+
+
+def select_impacted(suite, changed, filename):
+    """ A suite of the tests of `suite` impacted by the changed files, in loader order. """
+    tests = list(iter_tests(suite))
+    selected = set(impacted([test.id() for test in tests], changed, load_map(filename)))
+    return TestSuite([test for test in tests if test.id() in selected])
+
+
+def read_changed(source):
+    """ Changed file names, one per line, from a file or '-' for stdin. """
+    if source == '-':
+        return [line.strip() for line in sys.stdin if line.strip()]
+    with open(source, encoding='utf8') as changed:
+        return [line.strip() for line in changed if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='List the recorded tests impacted by changed files.')
+    parser.add_argument('map', help='impact map, e.g. Results/impact.json')
+    parser.add_argument('files', nargs='*', help='changed files, default read from stdin')
+    parser.add_argument('--test', help='list the files used by a test instead')
+    args = parser.parse_args(argv)
+    tests = load_map(args.map)
+    if args.test:
+        for path in tests.get(args.test, ()):
+            print(path)
+        return 0
+    changed = args.files or read_changed('-')
+    for test_id in sorted(impacted(tests, changed, tests)):
+        print(test_id)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,487 @@
+# coding=utf8
+
+"""
+Crash-safe journal of the finished tests, the native results format.
+
+The reports are only written at the end of `TestRunner.run`, a run that
+is killed before (OOM killer, a browser hang killed after hours...) used
+to lose every result. With `TestRunner(journal=filename)` each attempt
+of a test is appended to a JSON-lines journal as soon as it has finished:
+
+    {"type":"run","version":2,"title":...,"start_time":...,"outsuffix":...}
+    {"type":"test","test_id":...,"test_name":...,"start_time":...,...}
+    ...
+    {"type":"end","stop_time":...,"properties":{...}}
+
+A test line has the `FIELDS` of a `_TestInfo`, `stdout`, `stderr` and
+`doc` ([id, title, steps, expected] of the docstring); the fields with
+their `DEFAULTS` value are left out, as is `elapsed_time` when it is
+`stop_time - start_time`. Other tools can read the results from it
+without parsing output.xml.
+
+Every line is flushed to the OS right away, so a killed process loses
+nothing. fsync, which also covers a crash of the machine, is batched
+every `sync_every` tests or `sync_interval` seconds. A run without the
+"end" line did not finish. The reports of one or more journals (e.g. of
+several shards/nodes), or one merged journal, are written with:
+
+    python -m Core.Runner.journal Results/journal.jsonl -o Results
+    python -m Core.Runner.journal node1.jsonl node2.jsonl -o Results
+    python -m Core.Runner.journal node1.jsonl node2.jsonl --merge all.jsonl
+
+output.xml and the merged journal are written a line at a time: the
+testcases of output.xml go to a temporary file as they are read, only
+their offsets and the counters of the suites are kept in memory.
+report.html sorts and counts every test before its first row, it is
+built from the records of all the tests, its memory grows with the
+number of tests (--no-html leaves it out).
+
+A truncated last line is ignored when reading.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+
+from .records import FAILURE, ERROR, SKIP
+from .testdoc import TestDoc
+
+# 2: compact lines, the fields with their default value left out
+JOURNAL_VERSION = 2
+# Attributes of a _TestInfo stored as they are
+FIELDS = ('test_id', 'test_name', 'test_description', 'outcome', 'rerun',
+          'start_time', 'stop_time', 'elapsed_time', 'error_type',
+          'error_message', 'test_exception_info', 'screenshot', 'suite_doc')
+# Values of the fields left out of a test line
+DEFAULTS = {'outcome': 0, 'rerun': 0, 'error_type': None, 'error_message': None,
+            'test_exception_info': '', 'screenshot': '', 'suite_doc': None,
+            'stdout': '', 'stderr': '', 'doc': [None, '', '', '']}
+
+
+def dump_test(info):
+    """ The journal entry of a finished `_TestInfo`. """
+    data = {'type': 'test'}
+    for field in FIELDS:
+        data[field] = getattr(info, field)
+    data['stdout'] = info.stdout
+    data['stderr'] = info.stderr
+    doc = info.doc
+    data['doc'] = [doc.id, doc.title, doc.steps, doc.expected]
+    for field, default in DEFAULTS.items():
+        if data[field] == default and type(data[field]) is type(default):
+            del data[field]
+    if data['elapsed_time'] == data['stop_time'] - data['start_time']:
+        del data['elapsed_time']
+    return data
+
+
+def load_test(data, infoclass=None, store=None):
+    """ Rebuilds a `_TestInfo` from its journal entry. """
+    if infoclass is None:
+        from .xmlrunner.result import _TestInfo as infoclass
+    info = infoclass.__new__(infoclass)
+    info.test_result = None
+    for field in FIELDS:
+        setattr(info, field, data.get(field, DEFAULTS.get(field)))
+    if 'elapsed_time' not in data:
+        info.elapsed_time = info.stop_time - info.start_time
+    info.doc = TestDoc(*data.get('doc', DEFAULTS['doc']))
+    info._stdout = data.get('stdout', '')
+    info._stderr = data.get('stderr', '')
+    if store is not None:
+        info.attach(store)
+    return info
+
+
+class Journal(object):
+    """ Append-only journal file of a run, safe to write from several threads. """
+
+    def __init__(self, filename, sync_every=50, sync_interval=2.0):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._file = None
+        self._unsynced = 0
+        self._synced_at = 0
+        self._lock = threading.Lock()
+
+    def open(self, title=None, outsuffix=None, properties=None):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(self.filename, 'w', encoding='utf8')
+        self._synced_at = time.time()
+        self._write({'type': 'run', 'version': JOURNAL_VERSION, 'title': title,
+                     'start_time': time.time(), 'outsuffix': outsuffix,
+                     'properties': properties, 'pid': os.getpid()}, sync=True)
+        return self
+
+    def _write(self, data, sync=False):
+        line = json.dumps(data, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            if (sync or self._unsynced >= self.sync_every or
+                    time.time() - self._synced_at >= self.sync_interval):
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+                self._synced_at = time.time()
+
+    def write_test(self, info):
+        """ Appends a finished test. """
+        self._write(dump_test(info))
+
+    def close(self, properties=None):
+        """ Marks the run as finished and closes the file. """
+        self._write({'type': 'end', 'stop_time': time.time(),
+                     'properties': properties}, sync=True)
+        self.abort()
+
+    def abort(self):
+        """ Closes the file without the end mark, e.g. on an exception. """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def iter_journal(filename):
+    """ Yields the records of a journal a line at a time, with the line. """
+    with open(filename, encoding='utf8') as journal:
+        for line in journal:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                # The line being written when the process died
+                continue
+            yield data, line
+
+
+def read_journal(filename):
+    """ Returns `(run, tests, end)` of a journal, end is None if the run did not finish. """
+    run, tests, end = {}, [], None
+    for data, _ in iter_journal(filename):
+        kind = data.get('type')
+        if kind == 'run':
+            run = data
+        elif kind == 'test':
+            tests.append(data)
+        elif kind == 'end':
+            end = data
+    return run, tests, end
+
+
+def _edge_records(filename):
+    """ The records of the first and the last line of a journal, None if not readable. """
+    with open(filename, 'rb') as journal:
+        first = journal.readline()
+        size = journal.seek(0, os.SEEK_END)
+        chunk = 4096
+        while True:
+            journal.seek(max(0, size - chunk))
+            lines = journal.read().splitlines()
+            if len(lines) > 1 or chunk >= size:
+                break
+            chunk *= 4
+    records = []
+    for line in (first, lines[-1] if lines else b''):
+        try:
+            records.append(json.loads(line.decode('utf8')))
+        except ValueError:
+            records.append(None)
+    return records
+
+
+def read_runs(filenames):
+    """
+    The run and end records of journals, merged: the first title, the
+    earliest start, the last stop, the properties of all of them. The end
+    is None unless every run finished. Only the first and the last line
+    of the journals are read.
+    """
+    run, end = {}, {'type': 'end', 'properties': {}}
+    finished = bool(filenames)
+    for filename in filenames:
+        first, last = _edge_records(filename)
+        if first is not None and first.get('type') == 'run':
+            for key, value in first.items():
+                if key == 'start_time' and value is not None:
+                    run[key] = min(value, run.get(key) or value)
+                elif key == 'properties':
+                    run[key] = dict(run.get(key) or {}, **(value or {}))
+                elif key != 'pid':
+                    run.setdefault(key, value)
+        if last is None or last.get('type') != 'end':
+            finished = False
+            continue
+        end['stop_time'] = max(last.get('stop_time') or 0, end.get('stop_time', 0))
+        end['properties'].update(last.get('properties') or {})
+    run['version'] = JOURNAL_VERSION
+    return run, end if finished else None
+
+
+def iter_tests(filenames):
+    """ The test records of journals, one journal after the other. """
+    for filename in filenames:
+        for data, _ in iter_journal(filename):
+            if data.get('type') == 'test':
+                yield data
+
+
+def replay(tests, result):
+    """ Records journal entries on a result object like the live run did. """
+    for data in tests:
+        info = load_test(data, result.infoclass, result.output_store)
+        result.store.replay(info)
+        if info.rerun == 0:
+            result.testRun += 1
+        result.testsRun += 1
+    return result
+
+
+def _without_output(tests):
+    """ The test records without their stdout/stderr, report.html does not show them. """
+    for data in tests:
+        data.pop('stdout', None)
+        data.pop('stderr', None)
+        yield data
+
+
+def last_attempts(filenames):
+    """
+    {test_id: last attempt} of the tests rerun in journals, skips left
+    out: their failures of the earlier attempts are superseded.
+    """
+    latest = {}
+    for filename in filenames:
+        with open(filename, encoding='utf8') as journal:
+            for line in journal:
+                # Version 2 leaves "rerun" out of the first attempts
+                if '"rerun"' not in line:
+                    continue
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    continue
+                attempt = data.get('rerun') or 0
+                if (attempt and data.get('type') == 'test' and
+                        data.get('outcome', 0) != SKIP):
+                    latest[data['test_id']] = max(attempt, latest.get(data['test_id'], 0))
+    return latest
+
+
+class _SpooledSuite(object):
+    """ The testcases of a suite in the spool file, by outcome. """
+
+    __slots__ = ('first', 'spans', 'elapsed')
+
+    def __init__(self):
+        # outcome -> position of the first testcase, for the suite order
+        self.first = {}
+        # outcome -> (offset, testcase, stdout, stderr lengths) of every testcase
+        self.spans = [array('q') for _ in range(4)]
+        self.elapsed = [array('d') for _ in range(4)]
+
+    def add(self, outcome, position, offset, lengths, elapsed):
+        self.first.setdefault(outcome, position)
+        self.spans[outcome].append(offset)
+        self.spans[outcome].extend(lengths)
+        self.elapsed[outcome].append(elapsed)
+
+    def counts(self):
+        """ The `aggregate.Counts` of the suite, summed in the report order. """
+        from .aggregate import Counts
+        counts = Counts()
+        counts.tests = sum(len(elapsed) for elapsed in self.elapsed)
+        counts.failures = len(self.elapsed[FAILURE])
+        counts.errors = len(self.elapsed[ERROR])
+        counts.skipped = len(self.elapsed[SKIP])
+        counts.successes = counts.tests - counts.failures - counts.errors - counts.skipped
+        for elapsed in self.elapsed:
+            for value in elapsed:
+                counts.time += value
+        return counts
+
+    def sections(self, part):
+        """ `(offset, length)` in the spool of the testcases (part 0), their
+            stdout (1) or stderr (2), in the report order. """
+        for spans in self.spans:
+            for index in range(0, len(spans), 4):
+                offset = spans[index]
+                for previous in range(part):
+                    offset += spans[index + 1 + previous]
+                yield offset, spans[index + 1 + part]
+
+
+def write_xml_report(filenames, stream, title=None, outsuffix=None, properties=None,
+                     encoding='UTF-8'):
+    """
+    Writes the output.xml of journals to a binary stream, the same as the
+    runner writes for the recorded tests, reading a line at a time.
+    Returns `(test entries, first start_time, last stop_time)`.
+    """
+    from .xmlrunner.result import _XMLTestResult, safe_unicode
+    from .xmlrunner.writer import XMLWriter
+    latest = last_attempts(filenames)
+    suites = {}
+    count, position, start_time, stop_time = 0, 0, None, None
+    with tempfile.TemporaryFile() as spool:
+        spooler = XMLWriter(spool, encoding)
+        for data in iter_tests(filenames):
+            info = load_test(data)
+            count += 1
+            start_time = min(info.start_time, start_time or info.start_time)
+            stop_time = max(info.stop_time, stop_time or info.stop_time)
+            if (info.outcome in (FAILURE, ERROR) and
+                    latest.get(info.test_id, 0) > info.rerun):
+                continue
+            offset = spool.tell()
+            _XMLTestResult._report_testcase(info, spooler)
+            spooler.flush()
+            lengths = [spool.tell() - offset]
+            for text in (info.stdout, info.stderr):
+                data = safe_unicode(text).encode('utf-8', 'surrogatepass') if text else b''
+                spool.write(data)
+                lengths.append(len(data))
+            suite = info.suite_doc or info.test_name
+            if suite not in suites:
+                suites[suite] = _SpooledSuite()
+            suites[suite].add(info.outcome, position, offset, lengths, info.elapsed_time)
+            position += 1
+
+        def read(offset, length):
+            spool.seek(offset)
+            return spool.read(length)
+
+        # The suites in the order of the first test of the lowest outcome,
+        # as aggregate() lists them
+        order = sorted(suites, key=lambda suite: min(suites[suite].first.items()))
+        counts = dict((suite, suites[suite].counts()) for suite in order)
+        elapsed = 0.0
+        for suite in order:
+            elapsed = counts[suite].time + elapsed
+        writer = XMLWriter(stream, encoding)
+        writer.declaration()
+        attributes = [
+            ('name', title),
+            ('tests', sum(suite.tests for suite in counts.values())),
+            ('time', '%.6f' % elapsed if suites else '0.000'),
+            ('failures', sum(suite.failures for suite in counts.values())),
+            ('errors', sum(suite.errors for suite in counts.values())),
+            ('skipped', sum(suite.skipped for suite in counts.values())),
+        ]
+        if not suites:
+            writer.element('testsuites', attributes, 0)
+        else:
+            writer.start('testsuites', attributes, 0)
+            for suite in order:
+                suite_counts = counts[suite]
+                writer.start('testsuite', [
+                    ('name', '%s-%s' % (suite, outsuffix) if outsuffix else suite),
+                    ('tests', suite_counts.tests),
+                    ('time', '%.6f' % suite_counts.time),
+                    ('failures', suite_counts.failures),
+                    ('errors', suite_counts.errors),
+                    ('skipped', suite_counts.skipped),
+                ], 1)
+                _XMLTestResult._report_testsuite_properties(writer, properties)
+                writer.flush()
+                for offset, length in suites[suite].sections(0):
+                    stream.write(read(offset, length))
+                for part, tag in ((1, 'system-out'), (2, 'system-err')):
+                    writer.cdata_element(tag, chunks=(
+                        read(offset, length).decode('utf-8', 'surrogatepass')
+                        for offset, length in suites[suite].sections(part) if length), depth=2)
+                writer.end('testsuite', 1)
+            writer.end('testsuites', 0)
+        writer.flush()
+    return count, start_time, stop_time
+
+
+def generate_reports(filenames, output=None, template=None, stream=sys.stderr, html=True):
+    """
+    Writes output.xml, and report.html unless `html` is False, of one or
+    more journals. Returns `(test entries, whether the runs finished)`.
+    """
+    from .TestRunner import TestRunner
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    run, end = read_runs(filenames)
+    output = output or os.path.dirname(filenames[0]) or '.'
+    runner = TestRunner(output=output, outsuffix=run.get('outsuffix') or '',
+                        report_title=run.get('title'), template=template,
+                        stream=stream)
+    properties = dict(run.get('properties') or {})
+    properties.update((end or {}).get('properties') or {})
+    if end is None:
+        properties['incomplete'] = 'true'
+    if not os.path.exists(output):
+        os.makedirs(output)
+    with open(os.path.join(output, 'output.xml'), 'wb') as report_file:
+        count, first_start, last_stop = write_xml_report(
+            filenames, report_file, runner.report_title, runner.outsuffix,
+            properties or None, runner.encoding)
+    if html:
+        start_time = run.get('start_time') or first_start or time.time()
+        stop_time = (end or {}).get('stop_time') or last_stop or start_time
+        runner.start_time = datetime.fromtimestamp(start_time)
+        runner.time_taken = timedelta(seconds=stop_time - start_time)
+        result = replay(_without_output(iter_tests(filenames)), runner._make_result())
+        result.properties = properties or None
+        result.generate_html_reports(runner)
+    return count, end is not None
+
+
+def merge_journals(filenames, merged):
+    """
+    Writes one journal with the tests of several journals, e.g. of the
+    shards of a run, copying their test lines as they are. Returns the
+    number of tests.
+    """
+    run, end = read_runs(filenames)
+    run['sources'] = [os.path.basename(filename) for filename in filenames]
+    count = 0
+    with open(merged, 'w', encoding='utf8') as journal:
+        journal.write(json.dumps(run, ensure_ascii=False, separators=(',', ':')) + '\n')
+        for filename in filenames:
+            for data, line in iter_journal(filename):
+                if data.get('type') == 'test':
+                    journal.write(line if line.endswith('\n') else line + '\n')
+                    count += 1
+        if end is not None:
+            journal.write(json.dumps(end, ensure_ascii=False, separators=(',', ':')) + '\n')
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Write the reports of (possibly unfinished) runs from their journals.')
+    parser.add_argument('journals', nargs='+', help='journal files, e.g. Results/journal.jsonl')
+    parser.add_argument('-o', '--output', help='report directory, default the journal directory')
+    parser.add_argument('--merge', metavar='JOURNAL',
+                        help='write the journals merged into one journal instead of the reports')
+    parser.add_argument('--no-html', action='store_true',
+                        help='only write output.xml, its memory does not grow with the tests')
+    args = parser.parse_args(argv)
+    if args.merge:
+        count = merge_journals(args.journals, args.merge)
+        print('{} test{} merged into {}'.format(count, '' if count == 1 else 's', args.merge))
+        return 0
+    count, finished = generate_reports(args.journals, args.output, html=not args.no_html)
+    print('{} test{} in the journal{}, run {}'.format(
+        count, '' if count == 1 else 's', '' if len(args.journals) == 1 else 's',
+        'finished' if finished else 'did not finish'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,410 @@
+# coding=utf8
+
+"""
+Parallel execution of a test suite.
+
+Tests are grouped by TestCase class and every class is handed to a worker
+as one job, so setUpClass/tearDownClass still run once per class.
+
+Process mode runs every class in a pool of processes; workers send their
+`_TestInfo` outcomes back to the parent, which merges them into a single
+result object. A worker stuck on a test past its time budget is killed
+and replaced, the rest of its job goes to the new worker.
+
+Thread mode is meant for I/O bound classes (e.g. API tests with
+CRFRequests): only classes marked with `threadsafe` run on the thread
+pool, everything else (Selenium classes) stays serial in the main thread.
+"""
+
+import importlib
+import io
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import connection
+from unittest import TestSuite
+from unittest.runner import _WritelnDecorator
+
+from .aio import run_suite
+from .threadsafe import capture_output
+from .utils import iter_tests, loaded_libraries, record_error
+from .watchdog import Watchdog, get_timeout, timeout_exc_info
+
+
+def threadsafe(cls):
+    """
+    Class decorator marking a TestCase class safe to run in thread mode.
+    A whole module can opt in with `CRF_THREADSAFE = True`; a class can
+    still opt out with `crf_threadsafe = False`.
+    """
+    cls.crf_threadsafe = True
+    return cls
+
+
+def is_threadsafe(cls):
+    value = getattr(cls, 'crf_threadsafe', None)
+    if value is None:
+        module = sys.modules.get(cls.__module__)
+        value = getattr(module, 'CRF_THREADSAFE', False)
+    return bool(value)
+
+
+class _RemoteTest(object):
+    """ Picklable stand-in for a test object run in another process. """
+
+    def __init__(self, test):
+        self.test_id = test.id()
+        self.description = str(test)
+
+    def id(self):
+        return self.test_id
+
+    def shortDescription(self):
+        return None
+
+    def __str__(self):
+        return self.description
+
+
+def _is_importable(cls):
+    try:
+        module = importlib.import_module(cls.__module__)
+    except ImportError:
+        return False
+    return getattr(module, cls.__name__, None) is cls
+
+
+def split_by_class(suite):
+    """
+    Group the tests of a suite into jobs, one job per TestCase class.
+
+    Returns an ordered mapping of `(module, class_name)` to the tests of
+    that class, and the list of tests that can't be rebuilt in a worker
+    (e.g. loader errors), which have to be run by the parent process.
+    """
+    jobs = OrderedDict()
+    local_tests = []
+    for test in iter_tests(suite):
+        cls = type(test)
+        if not _is_importable(cls):
+            local_tests.append(test)
+            continue
+        key = (cls.__module__, cls.__name__)
+        jobs.setdefault(key, []).append(test)
+    return jobs, local_tests
+
+
+def detach_info(test_info):
+    """
+    Drops everything from a `_TestInfo` which can't be sent to another
+    process: the result back-reference and the output store.
+    """
+    test_info.detach()
+    return test_info
+
+
+def export_result(result):
+    """ Converts a worker result into a picklable dict. """
+    return {
+        'attempts': [detach_info(info) for info in result.attempts],
+        'rerun': [test._testMethodName for test in result.rerun_queue],
+        'testRun': result.testRun,
+        'testsRun': result.testsRun,
+        'expectedFailures': [(_RemoteTest(test), err)
+                             for test, err in result.expectedFailures],
+        'unexpectedSuccesses': [_RemoteTest(test)
+                                for test in result.unexpectedSuccesses],
+        'shouldStop': result.shouldStop,
+        'libraries': loaded_libraries(),
+    }
+
+
+def make_result(options, stream):
+    """ Creates and configures a result object the way TestRunner.run does. """
+    result = options['resultclass'](
+        stream, options['descriptions'], options['verbosity'],
+        options['elapsed_times'])
+    result.failfast = options['failfast']
+    result.tb_locals = options['tb_locals']
+    result.rerun = options['rerun']
+    result.quarantined = options['quarantined']
+    result.quarantine_rerun = options['quarantine_rerun']
+    result.async_limit = options['async_limit']
+    result.test_timeout = options['test_timeout']
+    return result
+
+
+def run_job(module, class_name, method_names, options, attempt=0,
+            watchdog=None):
+    """
+    Runs the given methods of one TestCase class inside a worker. Failed
+    tests are not rerun here, they are sent back to the parent which
+    submits them again as a new job once they have a free worker.
+    """
+    cls = getattr(importlib.import_module(module), class_name)
+    tests = [cls(name) for name in method_names]
+    stream = _WritelnDecorator(io.StringIO())
+    result = make_result(options, stream)
+    result.watchdog = watchdog
+    if watchdog is not None:
+        # Lets the run deadline stop the rest of the job
+        watchdog.result = result
+    for test in tests:
+        if attempt:
+            result._attempts[test.id()] = attempt
+    run_suite(TestSuite(tests), result)
+    return export_result(result), stream.getvalue()
+
+
+class _WorkerWatchdog(Watchdog):
+    """ Watchdog of a worker process, reports progress to the parent. """
+
+    def __init__(self, conn, lock, test_timeout, run_deadline):
+        Watchdog.__init__(self, test_timeout, run_deadline)
+        self.conn = conn
+        self.send_lock = lock
+
+    def send(self, *event):
+        with self.send_lock:
+            self.conn.send(event)
+
+    def test_started(self, test):
+        self.send('start', test.id(), time.time())
+        Watchdog.test_started(self, test)
+
+    def on_timeout(self, test, reason, screenshot):
+        self.send('timeout', test.id(), reason, screenshot)
+
+
+def _worker_main(conn, options):
+    """ Main loop of a worker process: run jobs until told to stop. """
+    watchdog = _WorkerWatchdog(conn, threading.Lock(), options['test_timeout'],
+                               options['run_deadline'])
+    watchdog.start(None)
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        module, class_name, method_names, attempt = job
+        try:
+            exported, output = run_job(module, class_name, method_names,
+                                       options, attempt, watchdog)
+        except Exception:
+            watchdog.send('crash', traceback.format_exc())
+        else:
+            watchdog.send('done', exported, output)
+    watchdog.stop()
+
+
+class _Job(object):
+    """ The tests of one class, sent to a worker as a unit. """
+
+    def __init__(self, key, tests, attempt=0):
+        self.key = key
+        self.tests = tests
+        self.attempt = attempt
+
+    def find(self, test_id):
+        for test in self.tests:
+            if test.id() == test_id:
+                return test
+        return None
+
+
+class _Worker(object):
+    """ A worker process of the pool, and what it is busy with. """
+
+    def __init__(self, context, options):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main,
+                                       args=(child_conn, options), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        self.test_id = None
+        self.test_started = None
+        self.screenshot = ''
+
+    def submit(self, job):
+        self.job = job
+        self.test_id = None
+        self.screenshot = ''
+        names = [test._testMethodName for test in job.tests]
+        self.conn.send((job.key[0], job.key[1], names, job.attempt))
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(5)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class _ProcessPool(object):
+    """
+    A pool of worker processes able to kill and replace one stuck worker
+    without losing the others.
+    """
+
+    def __init__(self, result, runner):
+        self.result = result
+        self.runner = runner
+        self.options = runner.worker_options()
+        self.context = multiprocessing.get_context()
+        self.pending = deque()
+        self.workers = []
+
+    def add(self, job):
+        self.pending.append(job)
+
+    def run(self):
+        count = min(self.runner.workers, len(self.pending))
+        self.workers = [_Worker(self.context, self.options) for _ in range(count)]
+        try:
+            while self.pending or any(w.job for w in self.workers):
+                if self.result.shouldStop:
+                    self.pending.clear()
+                for worker in self.workers:
+                    if worker.job is None and self.pending:
+                        worker.submit(self.pending.popleft())
+                busy = [w.conn for w in self.workers if w.job is not None]
+                for conn in connection.wait(busy, timeout=0.5):
+                    worker = next(w for w in self.workers if w.conn is conn)
+                    try:
+                        event = conn.recv()
+                    except (EOFError, OSError):
+                        continue
+                    self._handle(worker, event)
+                self._check_workers()
+        finally:
+            for worker in self.workers:
+                worker.close()
+
+    def _handle(self, worker, event):
+        kind = event[0]
+        if kind == 'start':
+            worker.test_id, worker.test_started = event[1], event[2]
+        elif kind == 'timeout':
+            worker.screenshot = event[3]
+        elif kind == 'crash':
+            self.runner.stream.writeln(event[1])
+            job, worker.job = worker.job, None
+            record_error(self.result, job.tests,
+                         (RuntimeError, RuntimeError(event[1]), None))
+        elif kind == 'done':
+            exported, output = event[1], event[2]
+            job, worker.job = worker.job, None
+            self.runner.stream.write(output)
+            self.result.merge(exported)
+            if exported['rerun'] and not self.result.shouldStop:
+                rerun = set(exported['rerun'])
+                self.add(_Job(job.key, [t for t in job.tests
+                                        if t._testMethodName in rerun],
+                              job.attempt + 1))
+
+    def _deadline(self, worker, test):
+        """ When the parent gives up on the test a worker is running. """
+        deadlines = []
+        test_timeout = get_timeout(test, self.runner.test_timeout)
+        if test_timeout is not None:
+            deadlines.append(worker.test_started + test_timeout)
+        if self.runner.run_deadline is not None:
+            deadlines.append(self.runner.run_deadline)
+        if not deadlines:
+            return None
+        # Leave the watchdog of the worker time to recover on its own
+        return min(deadlines) + self.runner.kill_grace
+
+    def _check_workers(self):
+        now = time.time()
+        for index, worker in enumerate(self.workers):
+            if worker.job is None:
+                continue
+            test = worker.job.find(worker.test_id) if worker.test_id else None
+            if not worker.process.is_alive():
+                reason = 'Worker process died (exit code {})'.format(
+                    worker.process.exitcode)
+                self._replace(index, test, (RuntimeError, RuntimeError(reason), None))
+            elif test is not None:
+                deadline = self._deadline(worker, test)
+                if deadline is not None and now > deadline:
+                    reason = 'Worker killed, test stuck after its time budget'
+                    self._replace(index, test, timeout_exc_info(reason))
+
+    def _replace(self, index, test, exc_info):
+        """
+        Kill a worker, record its current test as an error and give the
+        rest of its job to a fresh worker. Tests of the job which already
+        finished are run again, their results died with the worker.
+        """
+        worker = self.workers[index]
+        job = worker.job
+        worker.kill()
+        self.runner.stream.writeln('{}: {}'.format(exc_info[1], worker.test_id))
+        if test is not None:
+            self.result._attempts[test.id()] = job.attempt
+            # The test ran from its start in the worker until the kill
+            record_error(self.result, [test], exc_info, worker.test_started)
+            self.result.errors[-1][0].screenshot = worker.screenshot
+            if test in self.result.rerun_queue:
+                self.result.rerun_queue.remove(test)
+                self.add(_Job(job.key, [test], job.attempt + 1))
+        remaining = [t for t in job.tests if t is not test]
+        if remaining:
+            self.pending.appendleft(_Job(job.key, remaining, job.attempt))
+        self.workers[index] = _Worker(self.context, self.options)
+
+
+def run_in_processes(test, result, runner):
+    """
+    Runs a test suite on a pool of `runner.workers` processes and merges
+    every finished job into `result`.
+    """
+    jobs, local_tests = split_by_class(test)
+    # Longest classes first, so no worker is left alone with a slow one
+    keys, costs = runner.schedule.order(jobs)
+    runner.schedule.predict_makespan(costs, runner.workers)
+    pool = _ProcessPool(result, runner)
+    for key in keys:
+        pool.add(_Job(key, jobs[key]))
+    pool.run()
+    if local_tests and not result.shouldStop:
+        run_suite(TestSuite(local_tests), result)
+
+
+def _run_thread_job(result, tests):
+    result.reset_local_state()
+    run_suite(TestSuite(tests), result)
+
+
+def run_in_threads(test, result, runner):
+    """
+    Runs the classes marked `threadsafe` on a pool of `runner.threads`
+    threads, while the other tests run serially in the main thread.
+    All of them report into the same (thread-safe) result.
+    """
+    jobs, serial_tests = split_by_class(test)
+    for key in list(jobs):
+        if not is_threadsafe(type(jobs[key][0])):
+            serial_tests.extend(jobs.pop(key))
+    keys, costs = runner.schedule.order(jobs)
+    runner.schedule.predict_makespan(costs, runner.threads)
+    with capture_output(result):
+        with ThreadPoolExecutor(max_workers=runner.threads) as executor:
+            futures = [executor.submit(_run_thread_job, result, jobs[key])
+                       for key in keys]
+            if serial_tests:
+                run_suite(TestSuite(serial_tests), result)
+            for future in futures:
+                future.result()
@@ -0,0 +1,71 @@
+# coding=utf8
+
+"""
+Helpers keeping the `_TestInfo` records of both result classes compact.
+
+Every record used to keep its own copy of the test stdout/stderr and the
+raw exc_info (traceback frames, with tb_locals all of their locals) until
+the reports were written. Errors are now turned into strings right away,
+and the output goes to one buffer per result object, spilled to a
+temporary file past `max_size`; the record only keeps
+`(store, offset, length)`.
+"""
+
+import sys
+import tempfile
+import threading
+
+# Test outcomes, same values as _TestInfo.SUCCESS...
+(SUCCESS, FAILURE, ERROR, SKIP) = range(4)
+# Bytes kept in memory before the buffer moves to a temporary file
+DEFAULT_MAX_SIZE = 1024 * 1024
+
+
+class OutputStore(object):
+    """ Append-only text buffer addressed by byte offsets. """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self._file = tempfile.SpooledTemporaryFile(max_size, mode='w+b')
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def add(self, text):
+        """ Store `text`, returns its reference. None and '' are kept as is. """
+        if not text:
+            return text
+        data = text.encode('utf-8', 'surrogatepass')
+        with self._lock:
+            offset = self._size
+            self._file.seek(offset)
+            self._file.write(data)
+            self._size += len(data)
+        return (self, offset, len(data))
+
+    def read(self, offset, length):
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(length)
+        return data.decode('utf-8', 'surrogatepass')
+
+    def close(self):
+        self._file.close()
+
+
+def load_output(ref):
+    """ The text of a reference returned by `OutputStore.add` (or plain text). """
+    if ref is None or isinstance(ref, str):
+        return ref
+    store, offset, length = ref
+    return store.read(offset, length)
+
+
+def error_strings(outcome, err):
+    """
+    `(error type name, message)` of a test outcome. `err` is an exc_info
+    for failures and errors, the reason of a skip.
+    """
+    if outcome == SKIP:
+        return None, err
+    if outcome in (FAILURE, ERROR) and err:
+        return sys.intern(err[0].__name__), str(err[1])
+    return None, None
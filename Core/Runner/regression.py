@@ -0,0 +1,126 @@
+# coding=utf8
+
+"""
+Detection of tests which got slower than they used to be.
+
+The baseline of a test is the elapsed time of its passed attempts in the
+last `runs` runs of the history database (see history.py). A passed test
+of the current run is a duration regression when, with at least
+`min_samples` baseline values, it is both
+
+    much slower     elapsed >= median * min_ratio and
+                    elapsed - median >= min_delta seconds
+    an outlier      robust z-score (elapsed - median) / (1.4826 * MAD)
+                    >= threshold, MAD being the median absolute deviation
+
+The runner checks the run against the history before writing the
+reports: regressions are listed in report.html and counted in the
+`duration_regressions` JUnit property. An `output.xml` can be checked
+as well, the exit code is 1 when there are regressions:
+
+    python -m Core.Runner.regression Results/output.xml --db Results/history.db
+"""
+
+import argparse
+import os
+import statistics
+import sys
+from collections import namedtuple
+
+from .history import HISTORY_FILE, History
+from .scheduler import load_timings
+
+Slowdown = namedtuple('Slowdown', 'test_id name class_name elapsed baseline ratio score samples')
+
+
+def slowdown_score(elapsed, samples):
+    """ `(median, robust z-score)` of a duration against its baseline samples. """
+    median = statistics.median(samples)
+    mad = statistics.median([abs(value - median) for value in samples])
+    # Identical samples would make any change infinitely significant
+    scale = max(1.4826 * mad, 0.05 * median, 0.01)
+    return median, (elapsed - median) / scale
+
+
+class RegressionCheck(object):
+    """ Compares test durations with their baseline from the history. """
+
+    def __init__(self, baseline, threshold=3.5, min_ratio=1.5, min_delta=1.0,
+                 min_samples=5):
+        # test id -> elapsed times of the passed attempts
+        self.baseline = baseline
+        self.threshold = threshold
+        self.min_ratio = min_ratio
+        self.min_delta = min_delta
+        self.min_samples = min_samples
+
+    @classmethod
+    def from_history(cls, filename=HISTORY_FILE, runs=20, skip=0, **options):
+        """ The check against the last `runs` runs, the newest `skip` runs left out. """
+        baseline = {}
+        if filename and os.path.isfile(filename):
+            with History(filename) as history:
+                baseline = history.durations(runs, skip)
+        return cls(baseline, **options)
+
+    def check(self, test_id, elapsed, name=None, class_name=None):
+        """ A `Slowdown` if the duration is a regression, else None. """
+        samples = self.baseline.get(test_id)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        median, score = slowdown_score(elapsed, samples)
+        if (elapsed >= median * self.min_ratio and elapsed - median >= self.min_delta
+                and score >= self.threshold):
+            return Slowdown(test_id, name or test_id, class_name or test_id.rpartition('.')[0],
+                            elapsed, median, elapsed / median if median else float('inf'),
+                            score, len(samples))
+        return None
+
+    def check_result(self, result):
+        """ The slowdowns of the passed tests of a result object, slowest first. """
+        slowdowns = []
+        for info in result.successes:
+            slowdown = self.check(info.test_id, info.elapsed_time, info.get_description(),
+                                  info.test_name)
+            if slowdown is not None:
+                slowdowns.append(slowdown)
+        return sorted(slowdowns, key=lambda slowdown: -slowdown.ratio)
+
+    def check_timings(self, timings):
+        """ The slowdowns of `{test_id: elapsed}` of passed tests, e.g. read
+            from an output.xml with `load_timings(filename, passed_only=True)`. """
+        slowdowns = [self.check(test_id, elapsed) for test_id, elapsed in timings.items()]
+        return sorted([slowdown for slowdown in slowdowns if slowdown is not None],
+                      key=lambda slowdown: -slowdown.ratio)
+
+
+def describe(slowdown):
+    return '{:9.2f}s  baseline {:.2f}s  x{:.1f}  {}'.format(
+        slowdown.elapsed, slowdown.baseline, slowdown.ratio, slowdown.name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check the test durations of an output.xml against the results history.')
+    parser.add_argument('output', help='output.xml to check')
+    parser.add_argument('--db', default=HISTORY_FILE, help='history database')
+    parser.add_argument('--runs', type=int, default=20, help='runs of the baseline')
+    parser.add_argument('--skip', type=int, default=1,
+                        help='newest runs left out of the baseline, by default the '
+                             'run of the output.xml if it is already in the history')
+    parser.add_argument('--threshold', type=float, default=3.5, help='robust z-score')
+    parser.add_argument('--min-ratio', type=float, default=1.5)
+    parser.add_argument('--min-delta', type=float, default=1.0, help='seconds')
+    args = parser.parse_args(argv)
+    checker = RegressionCheck.from_history(
+        args.db, args.runs, args.skip, threshold=args.threshold,
+        min_ratio=args.min_ratio, min_delta=args.min_delta)
+    slowdowns = checker.check_timings(load_timings(args.output, passed_only=True))
+    for slowdown in slowdowns:
+        print(describe(slowdown))
+    print('{} duration regression{}'.format(len(slowdowns), '' if len(slowdowns) == 1 else 's'))
+    return 1 if slowdowns else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# coding=utf8
+
+"""
+Duration-aware scheduling of parallel jobs.
+
+The `time` attribute of every `testcase` in a previous `output.xml` is used
+to estimate how long each test class will take, so the slowest classes can
+be handed out first (longest processing time first). This keeps one worker
+from being left alone with a slow GUI class at the end of the run.
+"""
+
+import heapq
+import os
+from xml.etree.ElementTree import iterparse
+
+
+# Estimate in seconds for a test with no history and nothing to compare to.
+DEFAULT_ESTIMATE = 1.0
+# Children of a `testcase` which did not pass
+NOT_PASSED = ('failure', 'error', 'skipped')
+
+
+def test_method_name(testcase_name):
+    """ Extract `test_xxx` from a testcase name like `U0001_标题 (test_xxx)`. """
+    if testcase_name.endswith(')') and ' (' in testcase_name:
+        return testcase_name.rsplit(' (', 1)[1][:-1]
+    return testcase_name
+
+
+def load_timings(filename, passed_only=False):
+    """
+    Reads the elapsed time of every test from an `output.xml`, keyed by
+    test id (`module.Class.test_method`). Returns an empty dict when the
+    file is missing or unreadable. `passed_only` leaves out the failed,
+    errored and skipped tests.
+    """
+    timings = {}
+    if not filename or not os.path.isfile(filename):
+        return timings
+    try:
+        for _, elem in iterparse(filename):
+            if elem.tag == 'testcase':
+                if passed_only and any(child.tag in NOT_PASSED for child in elem):
+                    elem.clear()
+                    continue
+                test_id = '{}.{}'.format(elem.get('classname'),
+                                         test_method_name(elem.get('name', '')))
+                try:
+                    timings[test_id] = float(elem.get('time', 0))
+                except ValueError:
+                    pass
+                elem.clear()
+            elif elem.tag == 'testsuite':
+                elem.clear()
+    except Exception:
+        # A broken report from a killed run: keep whatever was read.
+        pass
+    return timings
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class Schedule(object):
+    """
+    Orders jobs longest-first from historical test timings. Suites scheduled
+    one after the other (the quarantine lane after the others) add up to
+    the predicted makespan and the count of tests without history.
+    """
+
+    def __init__(self, timings=None, default=None):
+        self.timings = timings or {}
+        if default is None:
+            # Tests without history are assumed to be typical tests.
+            default = (_median(self.timings.values()) if self.timings
+                       else DEFAULT_ESTIMATE)
+        self.default = default
+        self.predicted_makespan = None
+        self.unknown = 0
+
+    @classmethod
+    def from_output(cls, filename, default=None):
+        return cls(load_timings(filename), default)
+
+    def estimate(self, test_id):
+        """ Expected duration of a single test. """
+        return self.timings.get(test_id, self.default)
+
+    def job_cost(self, tests):
+        """ Expected duration of a job made of the given tests. """
+        return sum(self.estimate(test.id()) for test in tests)
+
+    def order(self, jobs):
+        """
+        Returns the keys of `jobs` (a mapping of key to a list of tests)
+        sorted by expected duration, longest first. Ties keep loader order.
+        """
+        self.unknown += sum(1 for tests in jobs.values() for test in tests
+                            if test.id() not in self.timings)
+        costs = dict((key, self.job_cost(tests)) for key, tests in jobs.items())
+        keys = sorted(jobs, key=lambda key: -costs[key])
+        return keys, [costs[key] for key in keys]
+
+    def predict_makespan(self, costs, workers):
+        """
+        Simulates handing out jobs in the given order to the first idle
+        worker and returns the expected wall time of these jobs, added to
+        the predicted makespan of the run.
+        """
+        loads = [0.0] * max(1, min(workers, len(costs) or 1))
+        for cost in costs:
+            heapq.heapreplace(loads, loads[0] + cost)
+        self.predicted_makespan = (self.predicted_makespan or 0.0) + max(loads)
+        return max(loads)
+
+    def report(self, actual):
+        """ A one line summary of predicted versus actual makespan. """
+        if self.predicted_makespan is None:
+            return ''
+        return ('Predicted makespan: {:.2f}s, actual: {:.2f}s '
+                '({} test{} without history, estimated {:.2f}s each)').format(
+                    self.predicted_makespan, actual, self.unknown,
+                    self.unknown != 1 and 's' or '', self.default)
@@ -0,0 +1,137 @@
+# coding=utf8
+
+"""
+Smoke checks of the runners: each runs a small suite (a passing, a
+failing and a skipped test) into a temporary directory and checks the
+reports it wrote.
+
+    python -m Core.Runner.selfcheck
+
+The exit code is 1 when a check failed.
+"""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import unittest
+from unittest.runner import _WritelnDecorator
+
+
+class _Sample(unittest.TestCase):
+    """ Self check """
+
+    def test_01_pass(self):
+        """
+        S0001_passing test
+        操作步骤:
+        1、nothing
+        ======
+        预期结果:
+        1、it passes
+        """
+
+    def test_02_fail(self):
+        """ S0002_failing test """
+        self.fail('expected failure')
+
+    @unittest.skip('expected skip')
+    def test_03_skip(self):
+        """ S0003_skipped test """
+
+
+def _suite():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(_Sample)
+
+
+def _stream():
+    return _WritelnDecorator(io.StringIO())
+
+
+def _expect_files(output, *names):
+    for name in names:
+        path = os.path.join(output, name)
+        if not os.path.isfile(path) or not os.path.getsize(path):
+            raise AssertionError('{} was not written'.format(name))
+
+
+def check_html_runner(output):
+    """ The standalone HTMLTestRunner writes report.html. """
+    from .HtmlTestRunner import HTMLTestRunner
+    HTMLTestRunner(output=output, stream=_stream()).run(_suite())
+    _expect_files(output, 'report.html')
+
+
+def check_xml_runner(output):
+    """ The standalone XMLTestRunner writes output.xml. """
+    from .xmlrunner import XMLTestRunner
+    XMLTestRunner(output=output, outsuffix='', stream=_stream()).run(_suite())
+    _expect_files(output, 'output.xml')
+
+
+def check_test_runner(output):
+    """ TestRunner writes both reports. """
+    from .TestRunner import TestRunner
+    TestRunner(output=output, stream=_stream()).run(_suite())
+    _expect_files(output, 'output.xml', 'report.html')
+
+
+# A slow passed test, and failed, errored and skipped tests as slow
+REGRESSION_XML = u"""<?xml version="1.0" encoding="UTF-8"?>
+<testsuites>
+\t<testsuite name="Self check">
+\t\t<testcase classname="m.C" name="S0001_slow (test_01_pass)" time="60.0"/>
+\t\t<testcase classname="m.C" name="S0002_failed (test_02_fail)" time="60.0">
+\t\t\t<failure type="AssertionError" message="expected failure"/>
+\t\t</testcase>
+\t\t<testcase classname="m.C" name="S0003_timed out (test_03_error)" time="60.0">
+\t\t\t<error type="TestTimeout" message="Test time budget of 60s exceeded"/>
+\t\t</testcase>
+\t\t<testcase classname="m.C" name="S0004_skipped (test_04_skip)" time="60.0">
+\t\t\t<skipped message="expected skip"/>
+\t\t</testcase>
+\t</testsuite>
+</testsuites>
+"""
+
+
+def check_regression(output):
+    """ Only the passed tests of an output.xml are duration regressions. """
+    from .regression import RegressionCheck
+    from .scheduler import load_timings
+    filename = os.path.join(output, 'output.xml')
+    with open(filename, 'w', encoding='utf8') as xml_file:
+        xml_file.write(REGRESSION_XML)
+    baseline = dict(('m.C.test_0{}'.format(name), [1.0, 0.9, 1.1, 1.0, 1.0])
+                    for name in ('1_pass', '2_fail', '3_error', '4_skip'))
+    slowdowns = RegressionCheck(baseline).check_timings(
+        load_timings(filename, passed_only=True))
+    flagged = [slowdown.test_id for slowdown in slowdowns]
+    if flagged != ['m.C.test_01_pass']:
+        raise AssertionError('flagged {}'.format(flagged))
+
+
+CHECKS = (check_html_runner, check_xml_runner, check_test_runner, check_regression)
+
+
+def main(argv=None):
+    failed = 0
+    for check in CHECKS:
+        output = tempfile.mkdtemp(prefix='crf_selfcheck_')
+        try:
+            check(output)
+        except Exception:
+            failed += 1
+            print('FAIL {}'.format(check.__name__))
+            traceback.print_exc(file=sys.stdout)
+        else:
+            print('ok   {}'.format(check.__name__))
+        finally:
+            shutil.rmtree(output, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
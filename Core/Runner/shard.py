@@ -0,0 +1,255 @@
+# coding=utf8
+
+"""
+Deterministic sharding of a test suite across CI agents, and merging of
+the per-shard `output.xml` files into one `output.xml` and `report.html`.
+
+Sharding works on whole TestCase classes so setUpClass/tearDownClass run
+once per class. Without timings a class goes to shard
+`crc32(module.Class) % n`; with timings classes are spread longest-first
+over the least loaded shard. Both are stable as long as every agent sees
+the same suite (and the same timings file).
+
+Merge usage:
+    python -m Core.Runner.shard -o Results shard1/output.xml shard2/output.xml
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import zlib
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+from unittest import TestSuite
+from xml.etree.ElementTree import iterparse, tostring
+from xml.sax.saxutils import quoteattr
+
+from .HtmlTestRunner.result import (make_report_row, stream_html, use_data_report,
+                                     write_data_report)
+from .scheduler import test_method_name
+from .utils import iter_tests
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+OUTCOMES = {'failure': 1, 'error': 2, 'skipped': 3}
+
+
+def parse_shard(value):
+    """ Parse an `i/n` shard option, i is 1-based. Returns `(i, n)`. """
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', value or '')
+    if not match:
+        raise ValueError('Invalid shard "{}", expected i/n'.format(value))
+    index, total = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= total:
+        raise ValueError('Invalid shard "{}", i must be in 1..n'.format(value))
+    return index, total
+
+
+def _group_by_class(suite):
+    groups = OrderedDict()
+    for test in iter_tests(suite):
+        cls = type(test)
+        groups.setdefault('{}.{}'.format(cls.__module__, cls.__name__), []).append(test)
+    return groups
+
+
+def assign_shards(groups, total, schedule=None):
+    """ Map every class name of `groups` to a 0-based shard number. """
+    if schedule is None:
+        return dict((name, zlib.crc32(name.encode('utf-8')) % total)
+                    for name in groups)
+    costs = dict((name, schedule.job_cost(tests)) for name, tests in groups.items())
+    loads = [0.0] * total
+    shards = {}
+    for name in sorted(groups, key=lambda name: (-costs[name], name)):
+        shard = loads.index(min(loads))
+        shards[name] = shard
+        loads[shard] += costs[name]
+    return shards
+
+
+def shard_suite(suite, index, total, schedule=None):
+    """
+    Returns a new suite with only the tests of shard `index` of `total`
+    (1-based), keeping loader order.
+    """
+    groups = _group_by_class(suite)
+    shards = assign_shards(groups, total, schedule)
+    selected = TestSuite()
+    for name, tests in groups.items():
+        if shards[name] == index - 1:
+            selected.addTests(tests)
+    return selected
+
+
+def _read_totals(filename):
+    """ Read the attributes of the root `testsuites` element only. """
+    for _, elem in iterparse(filename, events=('start',)):
+        return dict(elem.attrib)
+    return {}
+
+
+def _parse_time(value):
+    try:
+        return datetime.strptime(value, TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def _testcase_row(elem):
+    """ Rebuild the html report row of a `testcase` element. """
+    step = elem.find('step')
+    expected = elem.find('expected')
+    outcome, error_name, error_message = 0, '', None
+    for child in elem:
+        if child.tag in OUTCOMES:
+            outcome = OUTCOMES[child.tag]
+            error_message = child.get('message')
+            if outcome != 3:
+                error_name = child.get('type', '')
+    return make_report_row(
+        elem.get('name', ''), elem.get('classname', ''),
+        step.get('message', '') if step is not None else '',
+        expected.get('message', '') if expected is not None else '',
+        outcome, error_name, error_message, float(elem.get('time', 0)),
+        elem.get('rerun', '0'), elem.get('screenshot', ''))
+
+
+def _test_number(row):
+    """ Same ordering as _HtmlTestResult.sort_test_list. """
+    try:
+        return int(test_method_name(row[0]).split('_')[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+class _SpooledRows(object):
+    """ The html report rows, one JSON line each in a temporary file. """
+
+    def __init__(self, spool):
+        self.spool = spool
+        # offset in the spool and _test_number of every row
+        self.offsets = array('q')
+        self.numbers = array('q')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, row):
+        self.offsets.append(self.spool.tell())
+        self.numbers.append(_test_number(row))
+        self.spool.write(json.dumps(row, ensure_ascii=False).encode('utf-8') + b'\n')
+
+    def __iter__(self):
+        """ The rows sorted by test number, read back one at a time. """
+        for index in sorted(range(len(self.numbers)), key=self.numbers.__getitem__):
+            self.spool.seek(self.offsets[index])
+            yield json.loads(self.spool.readline().decode('utf-8'))
+
+
+def merge_outputs(filenames, output, report_title='Test Report',
+                  template=None, encoding='UTF-8', report_mode='auto'):
+    """
+    Merge several `output.xml` files into `output/output.xml` and rebuild
+    `output/report.html`. The input files are streamed, only one testcase
+    element is held in memory at a time: it is written to output.xml as it
+    is read, its html report row to a temporary file, sorted by test number
+    once every file has been read.
+    """
+    totals = {'tests': 0, 'failures': 0, 'errors': 0, 'skipped': 0}
+    total_time = 0.0
+    for filename in filenames:
+        attrs = _read_totals(filename)
+        for key in totals:
+            totals[key] += int(attrs.get(key, 0))
+        total_time += float(attrs.get('time', 0))
+
+    if not os.path.exists(output):
+        os.makedirs(output)
+    with tempfile.TemporaryFile() as spool:
+        rows = _SpooledRows(spool)
+        counts = [0, 0, 0, 0]
+        start_time = stop_time = None
+        with open(os.path.join(output, 'output.xml'), 'w', encoding=encoding) as out:
+            out.write('<?xml version="1.0" encoding="{}"?>\n'.format(encoding))
+            out.write('<testsuites name={} tests="{}" time="{:.6f}" failures="{}" '
+                      'errors="{}" skipped="{}">\n'.format(
+                          quoteattr(report_title), totals['tests'], total_time,
+                          totals['failures'], totals['errors'], totals['skipped']))
+            for filename in filenames:
+                depth = 0
+                root = None
+                for event, elem in iterparse(filename, events=('start', 'end')):
+                    if event == 'start':
+                        depth += 1
+                        if depth == 1:
+                            root = elem
+                        elif depth == 2:
+                            out.write('\t<testsuite {}>\n'.format(' '.join(
+                                '{}={}'.format(k, quoteattr(v)) for k, v in elem.items())))
+                        continue
+                    depth -= 1
+                    if depth == 2:
+                        elem.tail = None
+                        out.write('\t\t{}\n'.format(tostring(elem, encoding='unicode')))
+                        if elem.tag == 'testcase':
+                            row = _testcase_row(elem)
+                            rows.add(row)
+                            counts[('success', 'danger', 'warning', 'info').index(row[3])] += 1
+                            start = _parse_time(elem.get('starttime'))
+                            stop = _parse_time(elem.get('stoptime'))
+                            if start and (start_time is None or start < start_time):
+                                start_time = start
+                            if stop and (stop_time is None or stop > stop_time):
+                                stop_time = stop
+                        elem.clear()
+                    elif depth == 1:
+                        out.write('\t</testsuite>\n')
+                        root.clear()
+            out.write('</testsuites>\n')
+
+        success, failures, errors, skips = counts
+        status = []
+        if success:
+            status.append('Pass: {}'.format(success))
+        if failures:
+            status.append('Fail: {}'.format(failures))
+        if errors:
+            status.append('Error: {}'.format(errors))
+        if skips:
+            status.append('Skip: {}'.format(skips))
+        headers = {
+            "start_time": str(start_time)[:19],
+            "duration": str(stop_time - start_time) if start_time and stop_time else '',
+            "status": ', '.join(status)
+        }
+        if use_data_report(report_mode, len(rows)):
+            write_data_report(output, 'report.html', rows, report_title, headers,
+                              sum(counts))
+            return
+        with open(os.path.join(output, 'report.html'), 'w', encoding='utf8') as report_file:
+            report_file.writelines(stream_html(template, title=report_title, headers=headers,
+                                               testcase_name='', tests_results=rows,
+                                               total_tests=sum(counts)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Merge per-shard output.xml files into one report.')
+    parser.add_argument('files', nargs='+', help='output.xml of every shard')
+    parser.add_argument('-o', '--output', default='Results',
+                        help='directory for the merged output.xml/report.html')
+    parser.add_argument('--title', default='Test Report', help='report title')
+    parser.add_argument('--template', default=None, help='html report template')
+    parser.add_argument('--report-mode', choices=('auto', 'table', 'data'), default='auto',
+                        help='report.html as one table or with its rows in data files')
+    args = parser.parse_args(argv)
+    merge_outputs(args.files, args.output, args.title, args.template,
+                  report_mode=args.report_mode)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
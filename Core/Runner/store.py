@@ -0,0 +1,178 @@
+# coding=utf8
+
+"""
+Store of the recorded test attempts, keyed by test id.
+
+The result classes kept `tested_fail_error` as a list checked with `in`
+for every outcome, and `_remove_test` removed superseded failures from
+`failures`/`errors` while iterating over them: quadratic with many
+reruns, and the entry right after a removed one was skipped.
+
+`ResultStore` records every attempt and indexes the listed failures and
+errors by test id, so dropping the failures of the earlier attempts of a
+test only touches that test's entries.
+`successes`, `failures`, `errors` and `skipped` of a result are
+`OutcomeView`s of the store and still behave like the lists unittest
+expects (len, iteration, indexing, append...).
+"""
+
+import itertools
+
+from .records import SUCCESS, FAILURE, ERROR
+
+OUTCOME_LISTS = ('successes', 'failures', 'errors', 'skipped')
+# Lists of the entries a later attempt supersedes
+FAILED_LISTS = ('failures', 'errors')
+
+
+def entry_test(entry):
+    """ `(test id, attempt)` of an outcome list entry: a _TestInfo, or a
+        `(test or _TestInfo, text)` tuple. """
+    test = entry[0] if isinstance(entry, tuple) else entry
+    test_id = getattr(test, 'test_id', None)
+    if test_id is None:
+        test_id = test.id()
+    return test_id, getattr(test, 'rerun', 0)
+
+
+class OutcomeView(object):
+    """ One outcome list of a `ResultStore`, in recording order. """
+
+    __slots__ = ('_store', '_kind')
+
+    def __init__(self, store, kind):
+        self._store = store
+        self._kind = kind
+
+    def _entries(self):
+        return self._store._lists[self._kind]
+
+    def __len__(self):
+        return len(self._entries())
+
+    def __iter__(self):
+        return iter(list(self._entries().values()))
+
+    def __reversed__(self):
+        return iter(list(reversed(self._entries().values())))
+
+    def __getitem__(self, index):
+        entries = self._entries()
+        if index == -1 and entries:
+            # The entry just recorded, e.g. to set its screenshot
+            return next(reversed(entries.values()))
+        return list(entries.values())[index]
+
+    def __contains__(self, entry):
+        return any(item is entry or item == entry for item in self._entries().values())
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, entry):
+        self._store.add(self._kind, entry)
+
+    def extend(self, entries):
+        for entry in entries:
+            self._store.add(self._kind, entry)
+
+    def remove(self, entry):
+        for key, item in self._entries().items():
+            if item is entry or item == entry:
+                self._store.discard(self._kind, key)
+                return
+        raise ValueError('{!r} is not in the list'.format(entry))
+
+    def clear(self):
+        for key in list(self._entries()):
+            self._store.discard(self._kind, key)
+
+
+class ResultStore(object):
+    """ Every attempt of every test, and the outcome lists as views of it. """
+
+    def __init__(self):
+        # every recorded attempt, including the superseded ones
+        self.attempts = []
+        # outcome list -> {key: entry}, in recording order
+        self._lists = dict((kind, {}) for kind in OUTCOME_LISTS)
+        # test id -> {key: (outcome list, attempt)} of its listed failures and errors
+        self._index = {}
+        self._keys = itertools.count()
+
+    def view(self, kind):
+        return OutcomeView(self, kind)
+
+    def record(self, info):
+        """ Records an attempt, the outcome lists are not changed. """
+        self.attempts.append(info)
+
+    def add(self, kind, entry, info=None):
+        """ Appends an entry to an outcome list, `info` is its _TestInfo if known. """
+        key = next(self._keys)
+        self._lists[kind][key] = entry
+        if kind not in FAILED_LISTS:
+            return
+        if info is None:
+            test_id, attempt = entry_test(entry)
+        else:
+            test_id, attempt = info.test_id, info.rerun
+        entries = self._index.get(test_id)
+        if entries is None:
+            entries = self._index[test_id] = {}
+        entries[key] = (kind, attempt)
+
+    def discard(self, kind, key):
+        entry = self._lists[kind].pop(key)
+        if kind not in FAILED_LISTS:
+            return
+        test_id, _ = entry_test(entry)
+        entries = self._index.get(test_id)
+        if entries is not None:
+            entries.pop(key, None)
+            if not entries:
+                del self._index[test_id]
+
+    def has_failed(self, test_id):
+        """ Whether failures or errors of the test are listed. """
+        return test_id in self._index
+
+    def supersede(self, test_id, attempt=None):
+        """
+        Drops the listed failures and errors of the test recorded by an
+        attempt before `attempt` (all of them when None).
+        """
+        entries = self._index.get(test_id)
+        if not entries:
+            return
+        for key, (kind, entry_attempt) in list(entries.items()):
+            if attempt is None or entry_attempt < attempt:
+                self.discard(kind, key)
+
+    def replay(self, info):
+        """
+        Records a finished attempt of another result (a worker, a journal)
+        and lists it like the add methods of the result classes do.
+        """
+        self.record(info)
+        if info.outcome == SUCCESS:
+            self.supersede(info.test_id, info.rerun)
+            self.add('successes', info, info)
+        elif info.outcome in (FAILURE, ERROR):
+            self.supersede(info.test_id, info.rerun)
+            self.add('failures' if info.outcome == FAILURE else 'errors',
+                     (info, info.get_error_info()), info)
+        else:
+            self.add('skipped', (info, info.error_message), info)
@@ -0,0 +1,67 @@
+# coding=utf8
+
+"""
+Metadata of a test method docstring, in the format of the README:
+
+    \"\"\"U0001_用例标题
+    操作步骤:
+    1、...
+    ======
+    预期结果:
+    1、...
+    \"\"\"
+
+Every docstring is parsed once and cached, the reporters and the test
+discovery all read the same `TestDoc`.
+"""
+
+import re
+
+_SEPARATOR = re.compile(r'======+')
+_cache = {}
+
+
+class TestDoc(object):
+    """ id, title, steps and expected result of a test docstring. """
+
+    __slots__ = ('id', 'title', 'steps', 'expected')
+
+    def __init__(self, id, title, steps, expected):
+        self.id = id
+        self.title = title
+        self.steps = steps
+        self.expected = expected
+
+    def __getstate__(self):
+        return (self.id, self.title, self.steps, self.expected)
+
+    def __setstate__(self, state):
+        self.id, self.title, self.steps, self.expected = state
+
+    def __repr__(self):
+        return 'TestDoc(id={!r}, title={!r})'.format(self.id, self.title)
+
+
+def parse_doc(doc):
+    """ Parse a docstring (cached), None and '' give an empty TestDoc. """
+    test_doc = _cache.get(doc)
+    if test_doc is not None:
+        return test_doc
+    first_line = doc.lstrip().split('\n', 1)[0].strip() if doc else ''
+    test_id, title = None, first_line
+    if '_' in first_line:
+        test_id, title = first_line.split('_', 1)
+        test_id = test_id.strip() or None
+    # The first line is the title, the rest are the steps, then after a
+    # line of at least 6 '=' the expected result
+    body = (doc if doc else '======').split('\n', 1)[-1]
+    match = _SEPARATOR.search(body)
+    parts = body.split(match.group(0) if match else '======', 1)
+    test_doc = TestDoc(test_id, title, parts[0], parts[1] if len(parts) > 1 else '')
+    _cache[doc] = test_doc
+    return test_doc
+
+
+def get_test_doc(test):
+    """ The TestDoc of a test case. """
+    return parse_doc(getattr(test, '_testMethodDoc', None))
@@ -0,0 +1,203 @@
+# coding=utf8
+
+"""
+Thread-safe result support.
+
+The result classes keep the state of the running test (start/stop time,
+the pending callback, captured output, class fixture bookkeeping of
+unittest.TestSuite...) in plain attributes, which only works while one
+test runs at a time. `ThreadSafeResult` moves that state into a context
+variable, so every thread (and every asyncio task) sees its own copy, and
+serializes the bookkeeping that touches the shared result lists.
+"""
+
+import io
+import sys
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from unittest.runner import _WritelnDecorator
+
+
+# (stdout, stderr) buffers of the test running in the current context
+_captured = ContextVar('captured', default=None)
+
+
+class _LocalState(object):
+    """ The per test state of a result object. """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.start_time = 0
+        self.stop_time = 0
+        self.callback = None
+        self._stdout_data = None
+        self._stderr_data = None
+        self._stdout_buffer = None
+        self._stderr_buffer = None
+        self._mirrorOutput = False
+        self._previousTestClass = None
+        self._testRunEntered = False
+        self._moduleSetUpFailed = False
+
+
+def _local_property(name):
+    def getter(self):
+        return getattr(self._local_state(), name)
+
+    def setter(self, value):
+        setattr(self._local_state(), name, value)
+    return property(getter, setter)
+
+
+class RoutedStream(object):
+    """
+    Replaces sys.stdout/sys.stderr while tests run concurrently. Writes go
+    to the capture buffer of the test running in the current context, or
+    to the original stream when no test is running there.
+    """
+
+    def __init__(self, original, index):
+        self.original = original
+        self.index = index
+
+    def _target(self):
+        captured = _captured.get()
+        return captured[self.index] if captured else self.original
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def getvalue(self):
+        captured = _captured.get()
+        if not captured:
+            raise AttributeError('getvalue')
+        return captured[self.index].getvalue()
+
+    def __getattr__(self, attr):
+        return getattr(self._target(), attr)
+
+
+@contextmanager
+def capture_output(result):
+    """ Route sys.stdout/sys.stderr per test while `result` runs concurrently. """
+    if result.concurrent:
+        # Already routed by an outer concurrent mode
+        yield result
+        return
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = RoutedStream(stdout, 0)
+    sys.stderr = RoutedStream(stderr, 1)
+    result.concurrent = True
+    try:
+        yield result
+    finally:
+        result.concurrent = False
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+class ThreadSafeResult(object):
+    """
+    Mixin for the result classes that lets several tests be in flight at
+    the same time, each in its own thread or asyncio task.
+    """
+
+    start_time = _local_property('start_time')
+    stop_time = _local_property('stop_time')
+    callback = _local_property('callback')
+    _stdout_data = _local_property('_stdout_data')
+    _stderr_data = _local_property('_stderr_data')
+    _stdout_buffer = _local_property('_stdout_buffer')
+    _stderr_buffer = _local_property('_stderr_buffer')
+    _mirrorOutput = _local_property('_mirrorOutput')
+    _previousTestClass = _local_property('_previousTestClass')
+    _testRunEntered = _local_property('_testRunEntered')
+    _moduleSetUpFailed = _local_property('_moduleSetUpFailed')
+
+    def __init__(self, *args, **kwargs):
+        self._state = ContextVar('result_state', default=None)
+        self._lock = threading.RLock()
+        self.concurrent = False
+        super(ThreadSafeResult, self).__init__(*args, **kwargs)
+
+    def _local_state(self):
+        state = self._state.get()
+        if state is None:
+            state = _LocalState()
+            self._state.set(state)
+        return state
+
+    def reset_local_state(self):
+        """ Start from a clean state, e.g. when a worker thread picks a new job. """
+        self._state.set(_LocalState())
+
+    @property
+    def stream(self):
+        return self._local_state().stream or self._shared_stream
+
+    @stream.setter
+    def stream(self, value):
+        self._shared_stream = value
+
+    def _setupStdout(self):
+        if not self.concurrent:
+            return super(ThreadSafeResult, self)._setupStdout()
+        if self.buffer:
+            if self._stderr_buffer is None:
+                self._stderr_buffer = io.StringIO()
+                self._stdout_buffer = io.StringIO()
+            _captured.set((self._stdout_buffer, self._stderr_buffer))
+
+    def _restoreStdout(self):
+        if not self.concurrent:
+            return super(ThreadSafeResult, self)._restoreStdout()
+        if self.buffer:
+            _captured.set(None)
+            for buffer in (self._stdout_buffer, self._stderr_buffer):
+                buffer.seek(0)
+                buffer.truncate()
+
+    def startTest(self, test):
+        with self._lock:
+            if self.concurrent:
+                # Progress lines of this test are written in one piece
+                # when it stops, so concurrent tests don't interleave.
+                self._local_state().stream = _WritelnDecorator(io.StringIO())
+            super(ThreadSafeResult, self).startTest(test)
+
+    def stopTest(self, test):
+        with self._lock:
+            super(ThreadSafeResult, self).stopTest(test)
+            state = self._local_state()
+            if state.stream is not None:
+                self._shared_stream.write(state.stream.getvalue())
+                self._shared_stream.flush()
+                state.stream = None
+
+    def addSuccess(self, test):
+        with self._lock:
+            super(ThreadSafeResult, self).addSuccess(test)
+
+    def addFailure(self, test, err):
+        with self._lock:
+            super(ThreadSafeResult, self).addFailure(test, err)
+
+    def addError(self, test, err):
+        with self._lock:
+            super(ThreadSafeResult, self).addError(test, err)
+
+    def addSubTest(self, testcase, test, err):
+        with self._lock:
+            super(ThreadSafeResult, self).addSubTest(testcase, test, err)
+
+    def addSkip(self, test, reason):
+        with self._lock:
+            super(ThreadSafeResult, self).addSkip(test, reason)
+
+    def addExpectedFailure(self, test, err):
+        with self._lock:
+            super(ThreadSafeResult, self).addExpectedFailure(test, err)
+
+    def addUnexpectedSuccess(self, test):
+        with self._lock:
+            super(ThreadSafeResult, self).addUnexpectedSuccess(test)
@@ -0,0 +1,36 @@
+# coding=utf8
+
+""" Helpers shared by the execution modes of the runner. """
+
+import sys
+from unittest import TestSuite
+
+
+def iter_tests(suite):
+    """ Flatten a (nested) test suite into single test cases. """
+    for test in suite:
+        if isinstance(test, TestSuite):
+            for sub_test in iter_tests(test):
+                yield sub_test
+        else:
+            yield test
+
+
+def record_error(result, tests, exc_info, started=None):
+    """
+    Reports every given test as an error, e.g. when its job crashed.
+    `started` is the time the tests started, if they ran until now.
+    """
+    for test in tests:
+        result.startTest(test)
+        if started is not None:
+            result.start_time = started
+        result.addError(test, exc_info)
+        result.stopTest(test)
+
+
+def loaded_libraries():
+    """ Keyword libraries the tests of this process have loaded so far. """
+    keywords = sys.modules.get('Core.Keywords')
+    loaded = getattr(keywords, 'loaded_libraries', None)
+    return loaded() if loaded is not None else []
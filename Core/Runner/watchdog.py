@@ -0,0 +1,236 @@
+# coding=utf8
+
+"""
+Per-test and per-run time budgets.
+
+A watchdog thread keeps an eye on the tests running in this process. When
+a test runs out of time it takes a screenshot, tears the browser down
+(which usually unblocks a hung WebDriver call) and raises `TestTimeout` in
+the thread running the test. The result then records the test as an ERROR
+and the run goes on. A test stuck in C code can't be interrupted this way;
+in process mode the parent kills and replaces the worker instead.
+
+The budget of a test counts from startTest, but `TestTimeout` is only
+raised while the code of the test runs (setUp, the test method, tearDown,
+cleanups), where TestCase.run catches it. Raised in the result callbacks
+it would escape TestCase.run. The thread only starts once a test has a
+budget.
+
+A test method or TestCase class can have its own budget:
+
+    @timeout(600)
+    def test_U0001(self):
+        ...
+"""
+
+import ctypes
+import inspect
+import threading
+import time
+
+
+# The methods of TestCase.run calling the code of the test, each one inside
+# a testPartExecutor which records the exceptions it raises
+TEST_PARTS = ('_callSetUp', '_callTestMethod', '_callTearDown', '_callCleanup')
+
+
+class TestTimeout(Exception):
+    """ Raised in a test which ran out of its time budget. """
+
+
+def timeout(seconds):
+    """ Decorator giving a test method or TestCase class its own time budget. """
+    def decorator(obj):
+        obj.crf_timeout = seconds
+        return obj
+    return decorator
+
+
+def get_timeout(test, default=None):
+    """ Time budget of a test: method, then class, then the runner default. """
+    method = getattr(test, getattr(test, '_testMethodName', ''), None)
+    for obj in (method, type(test)):
+        value = getattr(obj, 'crf_timeout', None)
+        if value is not None:
+            return value
+    return default
+
+
+def timeout_exc_info(reason, err=None):
+    """
+    Builds the exc_info recorded for a timed out test. The traceback of the
+    error the test actually died with, if any, shows where it was stuck.
+    """
+    if err is not None and err[0] is not TestTimeout:
+        reason = '{} ({}: {})'.format(reason, err[0].__name__, err[1])
+    exc = TestTimeout(reason)
+    return (TestTimeout, exc, err[2] if err is not None else None)
+
+
+def _raise_in_thread(ident, exctype):
+    """ Asynchronously raise `exctype` in a thread, None clears a pending one. """
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(ident),
+        ctypes.py_object(exctype) if exctype is not None else None)
+
+
+def _call_with_timeout(func, seconds):
+    """ Call `func` in a helper thread, give up on it after `seconds`. """
+    returned = []
+
+    def target():
+        try:
+            returned.append(func())
+        except Exception:
+            pass
+    helper = threading.Thread(target=target, daemon=True)
+    helper.start()
+    helper.join(seconds)
+    return returned[0] if returned else None
+
+
+class _Running(object):
+    """ A test being watched. """
+
+    def __init__(self, test, timeout):
+        self.test = test
+        self.started = time.time()
+        self.timeout = timeout
+        self.fired = False
+        # True while a part of the test (TEST_PARTS) runs
+        self.armed = False
+
+
+class Watchdog(object):
+    """ Enforces the time budgets of the tests running in this process. """
+
+    # Seconds given to screenshot and browser teardown of a hung test
+    DRIVER_TIMEOUT = 10
+
+    def __init__(self, test_timeout=None, run_deadline=None, interval=0.5):
+        self.test_timeout = test_timeout
+        self.run_deadline = run_deadline
+        self.interval = interval
+        self.result = None
+        self._running = {}
+        self._timeouts = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, result):
+        """ Watches the tests of `result`, the thread starts with the first budget. """
+        self.result = result
+        if self.test_timeout is not None or self.run_deadline is not None:
+            self._start_thread()
+
+    def _start_thread(self):
+        with self._lock:
+            if self._thread is None and not self._stopped.is_set():
+                self._thread = threading.Thread(target=self._watch, name='watchdog',
+                                                daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def test_started(self, test):
+        method = getattr(test, getattr(test, '_testMethodName', ''), None)
+        if inspect.iscoroutinefunction(method):
+            # Async tests share a thread, they are timed out by the event loop
+            return
+        timeout = get_timeout(test, self.test_timeout)
+        if timeout is None and self.run_deadline is None:
+            return
+        self._start_thread()
+        self._timeouts.pop(test.id(), None)
+        for name in TEST_PARTS:
+            part = getattr(test, name, None)
+            if part is not None:
+                setattr(test, name, self._guard(part))
+        with self._lock:
+            self._running[threading.get_ident()] = _Running(test, timeout)
+
+    def test_stopped(self, test):
+        ident = threading.get_ident()
+        for name in TEST_PARTS:
+            vars(test).pop(name, None)
+        with self._lock:
+            running = self._running.pop(ident, None)
+            if running is not None and running.fired:
+                # The test ended on its own, drop a timeout not raised yet
+                _raise_in_thread(ident, None)
+
+    def _guard(self, part):
+        """ `part` of a test, the timeout armed while it runs. """
+        def guarded(*args, **kwargs):
+            self._arm(True)
+            try:
+                return part(*args, **kwargs)
+            finally:
+                self._arm(False)
+        return guarded
+
+    def _arm(self, armed):
+        ident = threading.get_ident()
+        with self._lock:
+            watched = self._running.get(ident)
+            if watched is None:
+                return
+            watched.armed = armed
+            if not armed and watched.fired:
+                # The part ended on its own, drop a timeout not raised yet
+                _raise_in_thread(ident, None)
+
+    def timed_out(self, test):
+        return test.id() in self._timeouts
+
+    def pop_timeout(self, test):
+        """ Returns `(reason, screenshot)` if the test ran out of time. """
+        return self._timeouts.pop(test.id(), None)
+
+    def on_timeout(self, test, reason, screenshot):
+        """ Called after a test has been timed out, hook for subclasses. """
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            now = time.time()
+            run_expired = self.run_deadline is not None and now > self.run_deadline
+            if run_expired and self.result is not None and not self.result.shouldStop:
+                self.result.stop()
+            with self._lock:
+                running = list(self._running.items())
+            for ident, watched in running:
+                if watched.fired or not watched.armed:
+                    continue
+                if run_expired:
+                    reason = 'Run time budget exceeded'
+                elif (watched.timeout is not None and
+                        now - watched.started > watched.timeout):
+                    reason = 'Test time budget of {}s exceeded'.format(watched.timeout)
+                else:
+                    continue
+                self._fire(ident, watched, reason)
+
+    def _fire(self, ident, watched, reason):
+        test = watched.test
+        driver = getattr(test, 'driver', None)
+        capture = getattr(driver, 'capture_page_screenshot', None)
+        close = getattr(driver, 'close_all_browsers', None)
+        screenshot = ''
+        if capture is not None:
+            screenshot = _call_with_timeout(capture, self.DRIVER_TIMEOUT) or ''
+        with self._lock:
+            if self._running.get(ident) is not watched or not watched.armed:
+                # The part ended in the meantime, the next one is watched again
+                return
+            watched.fired = True
+            self._timeouts[test.id()] = (reason, screenshot)
+        if close is not None:
+            _call_with_timeout(close, self.DRIVER_TIMEOUT)
+        with self._lock:
+            if self._running.get(ident) is watched and watched.armed:
+                _raise_in_thread(ident, TestTimeout)
+        self.on_timeout(test, reason, screenshot)
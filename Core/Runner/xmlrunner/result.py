@@ -7,9 +7,15 @@ import traceback
 import six
 import re
 from os import path
-from six.moves import StringIO
 
 from .unittest import TestResult, _TextTestResult, failfast
+from unittest import TestSuite
+from collections import OrderedDict
+from ..aggregate import Counts, aggregate
+from ..records import OutputStore, error_strings, load_output
+from ..store import OUTCOME_LISTS, ResultStore
+from ..testdoc import get_test_doc
+from .writer import XMLWriter
 
 
 # Matches invalid XML1.0 unicode characters, like control characters:
@@ -86,8 +92,19 @@ class _TestInfo(object):
     """
     This class keeps useful information about the execution of a
     test method.
+
+    Records are compact: errors are kept as strings instead of live
+    tracebacks (and their frame locals), the captured output as a
+    reference into the output store of the result, and the result
+    back-reference is dropped once the test has finished.
     """
 
+    __slots__ = ('test_result', 'outcome', 'start_time', 'stop_time',
+                 'elapsed_time', 'error_type', 'error_message', '_stdout',
+                 '_stderr', 'screenshot', 'rerun', 'test_description',
+                 'test_exception_info', 'suite_doc', 'doc', 'test_name',
+                 'test_id')
+
     # Possible test outcomes
     (SUCCESS, FAILURE, ERROR, SKIP) = range(4)
 
@@ -97,27 +114,47 @@ class _TestInfo(object):
         self.start_time = 0
         self.stop_time = 0
         self.elapsed_time = 0
-        self.err = err
-        self.stdout = test_result._stdout_data
-        self.stderr = test_result._stderr_data
+        self.error_type, self.error_message = error_strings(outcome, err)
+        store = test_result.output_store
+        self._stdout = store.add(test_result._stdout_data)
+        self._stderr = store.add(test_result._stderr_data)
         self.screenshot = ''
         self.rerun = 0
-        test_description = self.test_result.getDescription(test_method)
-        self.test_description = test_description.split()[0] if len(test_description.split())<3 else test_description.split()[-1]
+        words = self.test_result.getDescription(test_method).split()
+        self.test_description = words[0] if len(words) < 3 else words[-1]
 
         self.test_exception_info = (
             '' if outcome in (self.SUCCESS, self.SKIP)
             else self.test_result._exc_info_to_string(
-                self.err, test_method)
+                err, test_method)
         )
         
         self.suite_doc = test_method.__doc__
-        self.test_doc = test_method._testMethodDoc
-        self.test_name = testcase_name(test_method)
+        self.doc = get_test_doc(test_method)
+        self.test_name = sys.intern(testcase_name(test_method))
         self.test_id = test_method.id()
         if subTest:
             self.test_id = subTest.id()
 
+    @property
+    def stdout(self):
+        return load_output(self._stdout)
+
+    @property
+    def stderr(self):
+        return load_output(self._stderr)
+
+    def detach(self):
+        """ Make the record self-contained, e.g. to send it to another process. """
+        self.test_result = None
+        self._stdout = self.stdout
+        self._stderr = self.stderr
+
+    def attach(self, store):
+        """ Move inline output of a detached record into `store`. """
+        self._stdout = store.add(self.stdout)
+        self._stderr = store.add(self.stderr)
+
     def id(self):
         return self.test_id
 
@@ -128,6 +165,7 @@ class _TestInfo(object):
             self.test_result.stop_time - self.test_result.start_time
         self.start_time = self.test_result.start_time
         self.stop_time = self.test_result.stop_time
+        self.test_result = None
 
     def get_description(self):
         """
@@ -153,13 +191,21 @@ class _XMLTestResult(_TextTestResult):
                  elapsed_times=True, properties=None, infoclass=None):
         _TextTestResult.__init__(self, stream, descriptions, verbosity)
         self.rerun = 0
-        self.retry = 0
+        # failed tests waiting to be rerun once the suite has finished
+        self.rerun_queue = []
+        # test id -> attempt being run, missing means first attempt
+        self._attempts = {}
+        # every recorded attempt and the outcome lists, indexed by test id
+        self.store = ResultStore()
+        self.attempts = self.store.attempts
+        self.successes, self.failures, self.errors, self.skipped = (
+            self.store.view(kind) for kind in OUTCOME_LISTS)
         self.tb_locals = False
         self.buffer = True  # we are capturing test output
         self._stdout_data = None
         self._stderr_data = None
-        self.successes = []
-        self.tested_fail_error = []
+        # captured output of every recorded test
+        self.output_store = OutputStore()
         self.callback = None
         self.elapsed_times = elapsed_times
         self.properties = properties  # junit testsuite properties
@@ -200,11 +246,15 @@ class _XMLTestResult(_TextTestResult):
         """
         Called before execute each test method.
         """
-        if self.retry == 0:
+        attempt = self._attempt(test)
+        if attempt == 0:
             self.testRun += 1
         self.start_time = time.time()
         TestResult.startTest(self, test)
 
+        if attempt and (self.showAll or self.dots):
+            self.stream.write('Rerun {} time...'.format(attempt))
+
         if self.showAll:
             self.stream.write('  ' + self.getDescription(test))
             self.stream.write(" ... ")
@@ -233,12 +283,43 @@ class _XMLTestResult(_TextTestResult):
             self.callback()
             self.callback = None
 
-        if self.rerun > self.retry:
-            self.retry += 1
-            self.stream.write('Rerun {} time...'.format(self.retry))
-            test(self)
-        else:
-            self.retry = 0
+    def _attempt(self, test):
+        """ Return the attempt number of a test, 0 for the first run. """
+        return self._attempts.get(test.id(), 0)
+
+    def _rerun_budget(self, test):
+        """ Number of reruns a failed test gets. """
+        return self.rerun
+
+    def _schedule_rerun(self, test):
+        """ Queue a failed test to be rerun after the suite has finished. """
+        if self._attempt(test) >= self._rerun_budget(test):
+            return
+        if any(queued.id() == test.id() for queued in self.rerun_queue):
+            return
+        self.rerun_queue.append(test)
+
+    def run_reruns(self):
+        """
+        Rerun the queued failed tests, round by round, until they pass or
+        run out of attempts. Tests of the same class are grouped so their
+        class fixtures are set up again once per round.
+        """
+        while self.rerun_queue and not self.shouldStop:
+            tests, self.rerun_queue = self.rerun_queue, []
+            by_class = OrderedDict()
+            for test in tests:
+                self._attempts[test.id()] = self._attempt(test) + 1
+                by_class.setdefault(type(test), []).append(test)
+            # The class fixtures were torn down at the end of the last round
+            self._previousTestClass = None
+            self._moduleSetUpFailed = False
+            self._run_suite(
+                TestSuite([test for group in by_class.values() for test in group]))
+
+    def _run_suite(self, suite):
+        """ Run a suite against this result, hook for other execution modes. """
+        suite(self)
 
     def addSuccess(self, test):
         """
@@ -246,13 +327,11 @@ class _XMLTestResult(_TextTestResult):
         """
         self._save_output_data()
         testinfo = self.infoclass(self, test)
-        testinfo.rerun = self.retry
+        testinfo.rerun = self._attempt(test)
+        self._record(testinfo)
         self._prepare_callback(
             testinfo, self.successes, 'OK', '.'
         )
-        self.retry = self.rerun
-        if testinfo.test_id in self.tested_fail_error:
-            self._remove_test(testinfo.test_id)
 
     @failfast
     def addFailure(self, test, err):
@@ -262,17 +341,15 @@ class _XMLTestResult(_TextTestResult):
         self._save_output_data()
         testinfo = self.infoclass(
             self, test, self.infoclass.FAILURE, err)
-        if testinfo.test_id in self.tested_fail_error:
-            self._remove_test(testinfo.test_id)
         try:
             testinfo.screenshot = test.driver.capture_page_screenshot()
             test.driver.close_browser()
         except Exception as e:
             pass
-        testinfo.rerun = self.retry
-        self.failures.append((testinfo,
-            self._exc_info_to_string(err, test)))
-        self.tested_fail_error.append(testinfo.test_id)
+        testinfo.rerun = self._attempt(test)
+        self._record(testinfo)
+        self.failures.append((testinfo, testinfo.get_error_info()))
+        self._schedule_rerun(test)
         self._prepare_callback(testinfo, [], 'FAIL', 'F')
 
     @failfast
@@ -283,17 +360,15 @@ class _XMLTestResult(_TextTestResult):
         self._save_output_data()
         testinfo = self.infoclass(
             self, test, self.infoclass.ERROR, err)
-        if testinfo.test_id in self.tested_fail_error:
-            self._remove_test(testinfo.test_id)
         try:
             testinfo.screenshot = test.driver.capture_page_screenshot()
             test.driver.close_browser()
         except Exception as e:
             pass
-        testinfo.rerun = self.retry
-        self.errors.append((testinfo,
-            self._exc_info_to_string(err, test)))
-        self.tested_fail_error.append(testinfo.test_id)
+        testinfo.rerun = self._attempt(test)
+        self._record(testinfo)
+        self.errors.append((testinfo, testinfo.get_error_info()))
+        self._schedule_rerun(test)
         self._prepare_callback(testinfo, [], 'ERROR', 'E')
 
     def addSubTest(self, testcase, test, err):
@@ -304,19 +379,18 @@ class _XMLTestResult(_TextTestResult):
             self._save_output_data()
             testinfo = self.infoclass(
                 self, testcase, self.infoclass.ERROR, err, subTest=test)
-            if testinfo.test_id in self.tested_fail_error:
-                self._remove_test(testinfo.test_id)
             try:
                 testinfo.screenshot = test.driver.capture_page_screenshot()
                 test.driver.close_browser()
             except Exception as e:
                 pass
-            testinfo.rerun = self.retry
+            testinfo.rerun = self._attempt(testcase)
+            self._record(testinfo)
             self.errors.append((
                 testinfo,
-                self._exc_info_to_string(err, testcase)
+                testinfo.get_error_info()
             ))
-            self.tested_fail_error.append(testinfo.test_id)
+            self._schedule_rerun(testcase)
             self._prepare_callback(testinfo, [], 'ERROR', 'E')
 
     def addSkip(self, test, reason):
@@ -326,17 +400,19 @@ class _XMLTestResult(_TextTestResult):
         self._save_output_data()
         testinfo = self.infoclass(
             self, test, self.infoclass.SKIP, reason)
+        testinfo.rerun = self._attempt(test)
+        self.store.record(testinfo)
         self.skipped.append((testinfo, reason))
         self._prepare_callback(testinfo, [], 'SKIP', 'S')
-        self.retry = self.rerun
 
-    def _remove_test(self, test_id):
-        for test in self.failures:
-            if test[0].test_id == test_id:
-                self.failures.remove(test)
-        for test in self.errors:
-            if test[0].test_id == test_id:
-                self.errors.remove(test)
+    def _record(self, testinfo):
+        """ Records an attempt, it supersedes the failures of the earlier attempts. """
+        self.store.record(testinfo)
+        self._remove_test(testinfo.test_id, testinfo.rerun)
+
+    def _remove_test(self, test_id, attempt=None):
+        """ Drops the failures and errors of the test recorded before `attempt`. """
+        self.store.supersede(test_id, attempt)
 
     def printErrorList(self, flavour, errors):
         """
@@ -357,93 +433,47 @@ class _XMLTestResult(_TextTestResult):
         used during the report generation, where a XML report will be created
         for each TestCase.
         """
-        tests_by_testcase = {}
-        for tests in (self.successes, self.failures, self.errors,
-                      self.skipped):
-            for test_info in tests:
-                if isinstance(test_info, tuple):
-                    # This is a skipped, error or a failure test case
-                    test_info = test_info[0]
-                testcase_name = test_info.suite_doc if test_info.suite_doc else test_info.test_name
-                if testcase_name not in tests_by_testcase:
-                    tests_by_testcase[testcase_name] = []
-                tests_by_testcase[testcase_name].append(test_info)
-
-        return tests_by_testcase
-
-    def _report_testsuite_properties(xml_testsuite, xml_document, properties):
+        return aggregate(self).suites
+
+    def _report_testsuite_properties(writer, properties, depth=2):
         if properties:
-            xml_properties = xml_document.createElement('properties')
-            xml_testsuite.appendChild(xml_properties)
+            writer.start('properties', depth=depth)
             for key, value in properties.items():
-                prop = xml_document.createElement('property')
-                prop.setAttribute('name', str(key))
-                prop.setAttribute('value', str(value))
-                xml_properties.appendChild(prop)
+                writer.element('property', [('name', str(key)), ('value', str(value))],
+                               depth + 1)
+            writer.end('properties', depth)
 
     _report_testsuite_properties = staticmethod(_report_testsuite_properties)
 
-    def _report_testsuite(suite_name, tests, xml_document, parentElement,
-                          properties):
+    def _report_testsuite(suite_name, tests, writer, properties, counts=None):
         """
-        Appends the testsuite section to the XML document.
+        Writes the testsuite section of the XML report, `counts` are the
+        `aggregate.Counts` of the tests.
         """
-        testsuite = xml_document.createElement('testsuite')
-        parentElement.appendChild(testsuite)
-
-        testsuite.setAttribute('name', suite_name)
-        testsuite.setAttribute('tests', str(len(tests)))
-
-        testsuite.setAttribute(
-            'time', '%.6f' % sum(map(lambda e: e.elapsed_time, tests))
-        )
-        failures = filter(lambda e: e.outcome == e.FAILURE, tests)
-        failures = len(list(failures))
-        testsuite.setAttribute('failures', str(failures))
-
-        errors = filter(lambda e: e.outcome == e.ERROR, tests)
-        errors = len(list(errors))
-        testsuite.setAttribute('errors', str(errors))
-
-        skips = filter(lambda e: e.outcome == _TestInfo.SKIP, tests)
-        skips = len(list(skips))
-        testsuite.setAttribute('skipped', str(skips))
- 
-        parentElement.setAttribute('tests', str(int(parentElement.getAttribute('tests'))+len(tests)))
-        parentElement.setAttribute('failures', str(int(parentElement.getAttribute('failures'))+failures))
-        parentElement.setAttribute('errors', str(int(parentElement.getAttribute('errors'))+errors))
-        parentElement.setAttribute('skipped', str(int(parentElement.getAttribute('skipped'))+skips))
-        parentElement.setAttribute('time', '%.6f' % (sum(map(lambda e: e.elapsed_time, tests))+float(parentElement.getAttribute('time'))))
-
-        _XMLTestResult._report_testsuite_properties(
-            testsuite, xml_document, properties)
-
-        for test in tests:
-            _XMLTestResult._report_testcase(test, testsuite, xml_document)
-
-        systemout = xml_document.createElement('system-out')
-        testsuite.appendChild(systemout)
+        if counts is None:
+            counts = Counts()
+            for test in tests:
+                counts.add(test)
+        writer.start('testsuite', [
+            ('name', suite_name),
+            ('tests', counts.tests),
+            ('time', '%.6f' % counts.time),
+            ('failures', counts.failures),
+            ('errors', counts.errors),
+            ('skipped', counts.skipped),
+        ], 1)
 
-        stdout = StringIO()
-        for test in tests:
-            # Merge the stdout from the tests in a class
-            if test.stdout is not None:
-                stdout.write(test.stdout)
-        _XMLTestResult._createCDATAsections(
-            xml_document, systemout, stdout.getvalue())
-
-        systemerr = xml_document.createElement('system-err')
-        testsuite.appendChild(systemerr)
+        _XMLTestResult._report_testsuite_properties(writer, properties)
 
-        stderr = StringIO()
         for test in tests:
-            # Merge the stderr from the tests in a class
-            if test.stderr is not None:
-                stderr.write(test.stderr)
-        _XMLTestResult._createCDATAsections(
-            xml_document, systemerr, stderr.getvalue())
+            _XMLTestResult._report_testcase(test, writer)
 
-        return testsuite
+        # The stdout/stderr of the tests in a class, merged
+        writer.cdata_element('system-out', chunks=(
+            safe_unicode(test.stdout) for test in tests if test.stdout is not None), depth=2)
+        writer.cdata_element('system-err', chunks=(
+            safe_unicode(test.stderr) for test in tests if test.stderr is not None), depth=2)
+        writer.end('testsuite', 1)
 
     _report_testsuite = staticmethod(_report_testsuite)
 
@@ -455,84 +485,84 @@ class _XMLTestResult(_TextTestResult):
 
     _test_method_name = staticmethod(_test_method_name)
 
-    def _createCDATAsections(xmldoc, node, text):
-        text = safe_unicode(text)
-        pos = text.find(']]>')
-        while pos >= 0:
-            tmp = text[0:pos+2]
-            cdata = xmldoc.createCDATASection(tmp)
-            node.appendChild(cdata)
-            text = text[pos+2:]
-            pos = text.find(']]>')
-        cdata = xmldoc.createCDATASection(text)
-        node.appendChild(cdata)
-
-    _createCDATAsections = staticmethod(_createCDATAsections)
-
-    def _report_testcase(test_result, xml_testsuite, xml_document):
+    def _report_testcase(test_result, writer):
         """
-        Appends a testcase section to the XML document.
+        Writes a testcase section of the XML report.
         """
-        testcase = xml_document.createElement('testcase')
-        xml_testsuite.appendChild(testcase)
-
         class_name = re.sub(r'^__main__.', '', test_result.id())
         class_name = class_name.rpartition('.')[0]
-        testcase.setAttribute('classname', class_name)
-        testcase.setAttribute(
-            'name', '{} ({})'.format(_XMLTestResult._test_method_name(test_result.test_description), test_result.test_id.split('.')[-1])
-        )
-
-        testcase.setAttribute('starttime', datetime.fromtimestamp(test_result.start_time).strftime('%Y-%m-%d %H:%M:%S.%f'))
-        testcase.setAttribute('stoptime', datetime.fromtimestamp(test_result.stop_time).strftime('%Y-%m-%d %H:%M:%S.%f'))
-        testcase.setAttribute('time', '%.6f' % test_result.elapsed_time)
-        testcase.setAttribute('status', "PASS")
-        testcase.setAttribute('rerun', str(test_result.rerun))
-        testcase.setAttribute('screenshot', test_result.screenshot)
-        property_step = xml_document.createElement('step')
-        property_expected = xml_document.createElement('expected')
-        testcase.appendChild(property_step)
-        testcase.appendChild(property_expected)
-        test_doc = test_result.test_doc        
-        test_doc = test_doc if test_doc else '======'
-        test_doc = test_doc.split('\n', 1)[-1]
-        sep = re.findall(r'(======+)', test_doc)[0] if len(re.findall(r'(======+)', test_doc)) != 0 else '======'
-        test_doc = test_doc.split(sep, 1)
-        detail_step = test_doc[0]
-        expected = test_doc[1] if len(test_doc) > 1 else ''
-        property_step.setAttribute('message', detail_step)
-        property_expected.setAttribute('message', expected.strip())
-
-        if (test_result.outcome != test_result.SUCCESS):
-            elem_name = ('failure', 'error', 'skipped')[test_result.outcome-1]
-            failure = xml_document.createElement(elem_name)
-            testcase.appendChild(failure)
-            if test_result.outcome != test_result.SKIP:
-                testcase.setAttribute('status', "FAIL")
-                failure.setAttribute(
-                    'type',
-                    safe_unicode(test_result.err[0].__name__)
-                )
-                failure.setAttribute(
-                    'message',
-                    safe_unicode(test_result.err[1])
-                )
-                error_info = safe_unicode(test_result.get_error_info())
-                _XMLTestResult._createCDATAsections(
-                    xml_document, failure, error_info)
-            else:
-                testcase.setAttribute('status', "SKIP")
-                failure.setAttribute('type', 'skip')
-                failure.setAttribute('message', safe_unicode(test_result.err))
+        if test_result.outcome == test_result.SUCCESS:
+            status = 'PASS'
+        elif test_result.outcome == test_result.SKIP:
+            status = 'SKIP'
+        else:
+            status = 'FAIL'
+        writer.start('testcase', [
+            ('classname', class_name),
+            ('name', '{} ({})'.format(_XMLTestResult._test_method_name(test_result.test_description), test_result.test_id.split('.')[-1])),
+            ('starttime', datetime.fromtimestamp(test_result.start_time).strftime('%Y-%m-%d %H:%M:%S.%f')),
+            ('stoptime', datetime.fromtimestamp(test_result.stop_time).strftime('%Y-%m-%d %H:%M:%S.%f')),
+            ('time', '%.6f' % test_result.elapsed_time),
+            ('status', status),
+            ('rerun', str(test_result.rerun)),
+            ('screenshot', test_result.screenshot),
+        ], 2)
+        writer.element('step', [('message', test_result.doc.steps)], 3)
+        writer.element('expected', [('message', test_result.doc.expected.strip())], 3)
+
+        if test_result.outcome == test_result.SKIP:
+            writer.element('skipped', [
+                ('type', 'skip'),
+                ('message', safe_unicode(test_result.error_message)),
+            ], 3)
+        elif test_result.outcome != test_result.SUCCESS:
+            elem_name = ('failure', 'error')[test_result.outcome-1]
+            writer.cdata_element(elem_name, [
+                ('type', safe_unicode(test_result.error_type)),
+                ('message', safe_unicode(test_result.error_message)),
+            ], [safe_unicode(test_result.get_error_info())], 3)
+        writer.end('testcase', 2)
 
     _report_testcase = staticmethod(_report_testcase)
 
-    def generate_reports(self, test_runner):
+    def _write_report(self, test_runner, model, stream):
+        writer = XMLWriter(stream, test_runner.encoding)
+        writer.declaration()
+        totals = model.totals
+        # The time of the testsuites is the sum of the suite times
+        elapsed = 0.0
+        for counts in model.suite_counts.values():
+            elapsed = counts.time + elapsed
+        attributes = [
+            ('name', test_runner.report_title),
+            ('tests', totals.tests),
+            ('time', '%.6f' % elapsed if model.suites else '0.000'),
+            ('failures', totals.failures),
+            ('errors', totals.errors),
+            ('skipped', totals.skipped),
+        ]
+        if not model.suites:
+            writer.element('testsuites', attributes, 0)
+        else:
+            writer.start('testsuites', attributes, 0)
+            for suite, tests in model.suites.items():
+                suite_name = suite
+                if test_runner.outsuffix:
+                    # not checking with 'is not None', empty means no suffix.
+                    suite_name = '%s-%s' % (suite, test_runner.outsuffix)
+                self._report_testsuite(suite_name, tests, writer, self.properties,
+                                       model.suite_counts[suite])
+            writer.end('testsuites', 0)
+        writer.flush()
+
+    def generate_reports(self, test_runner, model=None):
         """
         Generates the XML reports to a given XMLTestRunner object.
+        `model` is the `aggregate.ResultModel` of this result, built when
+        not given.
         """
-        from xml.dom.minidom import Document
-        all_results = self._get_info_by_testcase()
+        if model is None:
+            model = aggregate(self)
 
         outputHandledAsString = \
             isinstance(test_runner.output, six.string_types)
@@ -540,43 +570,15 @@ class _XMLTestResult(_TextTestResult):
         if (outputHandledAsString and not os.path.exists(test_runner.output)):
             os.makedirs(test_runner.output)
 
-        doc = Document()
-        testsuite = doc.createElement('testsuites')
-        doc.appendChild(testsuite)
-        parentElement = testsuite
-            
-        parentElement.setAttribute('name', test_runner.report_title)
-        parentElement.setAttribute('tests', '0')
-        parentElement.setAttribute('time', '0.000')
-        parentElement.setAttribute('failures', '0')
-        parentElement.setAttribute('errors', '0')
-        parentElement.setAttribute('skipped', '0')
- 
-        for suite, tests in all_results.items():
-            suite_name = suite
-            if test_runner.outsuffix:
-                # not checking with 'is not None', empty means no suffix.
-                suite_name = '%s-%s' % (suite, test_runner.outsuffix)
-
-            # Build the XML file
-            testsuite = _XMLTestResult._report_testsuite(
-                suite_name, tests, doc, parentElement, self.properties
-            )
-        xml_content = doc.toprettyxml(
-            indent='\t',
-            encoding=test_runner.encoding
-        )
-
         if outputHandledAsString:
             filename = path.join(
                 test_runner.output,
                 'output.xml')
             with open(filename, 'wb') as report_file:
-                report_file.write(xml_content)
-
-        if not outputHandledAsString:
+                self._write_report(test_runner, model, report_file)
+        else:
             # Assume that test_runner.output is a stream
-            test_runner.output.write(xml_content)
+            self._write_report(test_runner, model, test_runner.output)
 
     def _exc_info_to_string(self, err, test):
         """Converts a sys.exc_info()-style tuple of values into a string."""
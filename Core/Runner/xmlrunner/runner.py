@@ -68,6 +68,7 @@ class XMLTestRunner(TextTestRunner):
             # Execute tests
             start_time = time.time()
             test(result)
+            result.run_reruns()
             stop_time = time.time()
             time_taken = stop_time - start_time
 
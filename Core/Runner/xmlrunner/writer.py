@@ -0,0 +1,100 @@
+"""
+Streaming XML writer for the JUnit report.
+
+`_XMLTestResult.generate_reports` used to build the whole `testsuites`
+tree with minidom and then serialize it with `toprettyxml`, holding the
+run twice in memory. This writer emits the elements to the output as
+they are produced, in the layout `toprettyxml(indent='\t')` gave, so
+memory is bounded by the largest single test output.
+
+Line breaks and tabs in attribute values are written as character
+references, minidom wrote them raw and XML parsers turned them into
+spaces (the `step`/`expected` messages lost their lines).
+"""
+
+_ATTRIBUTE_ESCAPES = {
+    ord('&'): '&amp;',
+    ord('<'): '&lt;',
+    ord('>'): '&gt;',
+    ord('"'): '&quot;',
+    ord('\n'): '&#10;',
+    ord('\r'): '&#13;',
+    ord('\t'): '&#9;',
+}
+
+
+def escape_attribute(value):
+    """ Escapes an attribute value, None is written as an empty value. """
+    if value is None:
+        return ''
+    return str(value).translate(_ATTRIBUTE_ESCAPES)
+
+
+class XMLWriter(object):
+    """
+    Writes elements to a binary stream, `depth` is the indentation level.
+    Attributes are `(name, value)` pairs, written in order.
+    """
+
+    def __init__(self, stream, encoding='utf-8', indent='\t', buffer_size=64 * 1024):
+        self.stream = stream
+        self.encoding = encoding
+        self.indent = indent
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            self.stream.write(data.encode(self.encoding, 'xmlcharrefreplace'))
+
+    def declaration(self):
+        self.write('<?xml version="1.0" encoding="{}"?>\n'.format(self.encoding))
+
+    def _tag(self, tag, attributes, depth):
+        self.write(self.indent * depth + '<' + tag + ''.join(
+            ' {}="{}"'.format(name, escape_attribute(value))
+            for name, value in attributes))
+
+    def start(self, tag, attributes=(), depth=0):
+        """ `<tag ...>` on its own line, the children follow. """
+        self._tag(tag, attributes, depth)
+        self.write('>\n')
+
+    def end(self, tag, depth=0):
+        self.write('{}</{}>\n'.format(self.indent * depth, tag))
+
+    def element(self, tag, attributes=(), depth=0):
+        """ An empty element `<tag .../>`. """
+        self._tag(tag, attributes, depth)
+        self.write('/>\n')
+
+    def cdata_element(self, tag, attributes=(), chunks=(), depth=0):
+        """
+        `<tag ...><![CDATA[...]]></tag>` with the text of `chunks` (strings,
+        None is skipped) as one CDATA section. A `]]>` in the text, even
+        across chunks, is split into two sections.
+        """
+        self._tag(tag, attributes, depth)
+        self.write('><![CDATA[')
+        # Trailing ']' of the previous chunk, may start a ']]>'
+        pending = ''
+        for chunk in chunks:
+            if not chunk:
+                continue
+            data = pending + chunk
+            keep = len(data) - len(data.rstrip(']'))
+            keep = min(keep, 2)
+            pending = data[len(data) - keep:] if keep else ''
+            data = data[:len(data) - keep]
+            self.write(data.replace(']]>', ']]]]><![CDATA[>'))
+        self.write(pending + ']]></{}>\n'.format(tag))
@@ -2,30 +2,107 @@
 # coding=utf8
 
 
+import argparse
+import os
+import sys
 from unittest import TestSuite, TestLoader
 from Core.Runner.TestRunner import TestRunner
 from Core.Runner.xmlrunner import XMLTestRunner
 from Core.Runner.HtmlTestRunner import HTMLTestRunner
-# 导入测试用例
-from TestCase.UserSystem.UserGUI import UserGUI
+from Core.Runner.scheduler import Schedule
+from Core.Runner.shard import parse_shard, shard_suite
+from Core.Runner.discovery import discover
+from Core.Runner.flaky import Quarantine
+from Core.Runner.impact import read_changed, select_impacted
 
 
-# 加载所有测试用例
-def test_suites():
-    test_loader = TestLoader()
-    test_suite = TestSuite()
-    # test_suite.addTest(UserGUI('test_U0001'))
-    test_suite.addTests([
-        test_loader.loadTestsFromTestCase(UserGUI),
-    ])
-    return test_suite
+# 加载测试用例: 自动发现 TestCase 目录下的用例, 只导入选中的用例模块
+# selection 可以是模块/类/方法名、用例编号或通配符, 如 ['UserGUI', 'U0001', 'U02*']
+def test_suites(selection=None):
+    return discover('TestCase', selection)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='执行测试用例')
+    parser.add_argument('tests', nargs='*',
+                        help='只执行指定用例, 可以是模块/类/方法名、用例编号或通配符, 如 UserGUI U0001 U02*, 默认全部')
+    # 分片执行, 如 Jenkins 多节点: --shard 1/4 ... --shard 4/4
+    parser.add_argument('--shard', help='只执行第 i 个分片, 格式 i/n')
+    parser.add_argument('--balance', metavar='OUTPUT_XML',
+                        help='按历史 output.xml 中的耗时均衡分片, 所有节点需使用同一文件')
+    parser.add_argument('--workers', type=int, default=1, help='并行执行的进程数')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='标记为 threadsafe 的测试类(如接口用例)并行执行的线程数')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='单个测试用例的超时时间(秒), 超时记为 ERROR 并继续执行')
+    parser.add_argument('--run-timeout', type=float, default=None,
+                        help='整个执行的超时时间(秒), 超时后不再执行剩余用例')
+    parser.add_argument('--output', default='Results', help='测试结果目录')
+    # 每个用例执行完成后立即写入 journal.jsonl, 执行中途被杀掉时可以用
+    # python -m Core.Runner.journal Results/journal.jsonl 生成报告
+    parser.add_argument('--no-journal', action='store_true',
+                        help='不记录 journal.jsonl (执行中断时用于恢复测试结果)')
+    # 每次执行的结果追加到 SQLite 数据库, 可查询最慢用例、各测试类耗时 p95、最近几次结果:
+    # python -m Core.Runner.history slowest / p95 / last U0001
+    parser.add_argument('--history', default=None,
+                        help='历史结果数据库, 默认 <output>/history.db')
+    parser.add_argument('--no-history', action='store_true', help='不记录历史结果')
+    # 根据历史结果中重试后才通过、结果反复变化的比例计算不稳定程度, 超过阈值的用例
+    # 在其它用例(包括重试)执行完后单独执行, 重试次数更多, 失败不影响执行结果
+    # python -m Core.Runner.flaky 查看各用例的不稳定程度
+    parser.add_argument('--quarantine-threshold', type=float, default=0.3,
+                        help='不稳定程度超过该值(0~1)的用例隔离执行, 默认 0.3')
+    parser.add_argument('--quarantine-rerun', type=int, default=4, help='隔离用例的失败重试次数')
+    parser.add_argument('--no-quarantine', action='store_true', help='不隔离不稳定的用例')
+    # 影响分析: --record-impact 记录每个用例用到的项目文件(.py 及 Resource/TestData 等),
+    # --changed-files 只执行用到改动文件的用例和没有记录过的用例, 如
+    # git diff --name-only origin/master | python RunTestSuites.py --changed-files -
+    parser.add_argument('--record-impact', action='store_true',
+                        help='记录每个用例用到的文件, 用例逐个执行(不使用进程/线程并行)')
+    parser.add_argument('--changed-files', metavar='FILE',
+                        help='改动文件列表(每行一个, - 表示标准输入), 只执行受影响的用例')
+    parser.add_argument('--impact-map', default=None,
+                        help='用例与文件的对应关系, 默认 <output>/impact.json')
+    parser.add_argument('--report-mode', choices=('auto', 'table', 'data'), default='auto',
+                        help='report.html 格式: table 所有用例在一个表格中, data 用例数据单独存放、'
+                             '分页显示(适合几万条用例), auto 超过2000条用例时使用 data')
+    return parser.parse_args(argv)
 
 # 执行测试
-def main():
+def run(args, stream=sys.stderr):
+    test_suite = test_suites(args.tests)
+    impact_map = args.impact_map or os.path.join(args.output, 'impact.json')
+    if args.changed_files:
+        test_suite = select_impacted(test_suite, read_changed(args.changed_files), impact_map)
+        stream.write('Tests impacted by the changed files: {}\n'.format(
+            test_suite.countTestCases()))
+    if args.shard:
+        index, total = parse_shard(args.shard)
+        schedule = Schedule.from_output(args.balance) if args.balance else None
+        test_suite = shard_suite(test_suite, index, total, schedule)
     # rerun  失败重试次数
     # tb_locals  日志中是否打印变量值
-    runner = TestRunner(output='Results', verbosity=2, tb_locals=True, rerun=2)
-    runner.run(test_suites())
+    # workers  并行执行的进程数, 按测试类分配到各进程
+    # threads  并行执行的线程数, 只对标记为 threadsafe 的测试类生效
+    # test_timeout/run_timeout  单个用例/整个执行的超时时间(秒)
+    # journal  每个用例完成后追加记录的文件
+    # history  执行结束后追加本次结果的历史数据库
+    journal = None if args.no_journal else os.path.join(args.output, 'journal.jsonl')
+    history = None if args.no_history else args.history or os.path.join(args.output, 'history.db')
+    # impact  记录用例用到的文件
+    # quarantine  按历史结果隔离的不稳定用例
+    quarantine = None
+    if history and not args.no_quarantine:
+        quarantine = Quarantine.from_history(history, args.quarantine_threshold)
+    runner = TestRunner(output=args.output, verbosity=2, tb_locals=True, rerun=2,
+                        workers=args.workers, threads=args.threads,
+                        test_timeout=args.timeout, run_timeout=args.run_timeout,
+                        journal=journal, report_mode=args.report_mode, history=history,
+                        quarantine=quarantine, quarantine_rerun=args.quarantine_rerun,
+                        impact=impact_map if args.record_impact else None, stream=stream)
+    return runner.run(test_suite)
+
+def main(argv=None):
+    run(parse_args(argv))
 
 if __name__ == '__main__':
     main()